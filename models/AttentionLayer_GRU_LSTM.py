@@ -2,6 +2,7 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 '''
 class AttentionLayer_GRU_LSTM(nn.Module):
@@ -26,38 +27,187 @@ class AttentionLayer_GRU_LSTM(nn.Module):
 
 
 class AttentionLayerGRULSTM(nn.Module):
-    def __init__(self, in_channels, out_channels, n_heads=1):
+    def __init__(self, in_channels, out_channels, n_heads=1, causal=False, window=None, chunk_size=None):
+        """
+        :param causal: позиция видит только себя и предыдущие
+        :param window: позиция видит только соседние ближе window (с causal - window предыдущих, включая себя)
+        :param chunk_size: считать внимание блоками запросов по chunk_size: память - chunk_size x (число ключей
+            блока), а не L x L. По умолчанию блоки включаются только для window
+        """
         super(AttentionLayerGRULSTM, self).__init__()
         self.n_heads = n_heads
         self.head_dim = out_channels // n_heads
+        self.out_channels = out_channels
+        self.causal = causal
+        self.window = window
+        self.chunk_size = chunk_size
 
         # Make sure that the embedding dimension of model is a multiple of number of heads.
         assert (
             self.head_dim * n_heads == out_channels
         ), "out_channels must be divisible by n_heads."
 
-        self.linear_query = nn.Linear(in_channels, out_channels, bias=False)
-        self.linear_key = nn.Linear(in_channels, out_channels, bias=False)
-        self.linear_value = nn.Linear(in_channels, out_channels, bias=False)
+        # Q, K и V - одна проекция и одно умножение матриц
+        self.linear_qkv = nn.Linear(in_channels, 3 * out_channels, bias=False)
         self.linear_out = nn.Linear(out_channels, out_channels, bias=False)
 
-        self.softmax = nn.Softmax(dim=-1)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Чекпоинты с отдельными linear_query / linear_key / linear_value
+        names = [prefix + f'linear_{name}.weight' for name in ('query', 'key', 'value')]
+        if all(name in state_dict for name in names):
+            state_dict[prefix + 'linear_qkv.weight'] = torch.cat([state_dict.pop(name) for name in names])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-    def forward(self, x):
+    def _heads(self, x):
+        # (batch, L, in) -> три тензора (batch, heads, L, head_dim)
         batch_size = x.size(0)
+        qkv = self.linear_qkv(x).view(batch_size, -1, 3, self.n_heads, self.head_dim).permute(2, 0, 3, 1, 4)
+        return qkv[0], qkv[1], qkv[2]
+
+    def mask(self, query_start, query_end, key_start, key_end, device=None):
+        """
+        Маска допустимых пар (запросы, ключи) для диапазонов позиций; None - ограничений нет.
+        """
+        if not self.causal and self.window is None:
+            return None
+        query = torch.arange(query_start, query_end, device=device)[:, None]
+        key = torch.arange(key_start, key_end, device=device)[None, :]
+        allowed = torch.ones(len(query), key.size(1), dtype=torch.bool, device=device)
+        if self.causal:
+            allowed &= key <= query
+        if self.window is not None:
+            allowed &= (query - key < self.window) if self.causal else ((query - key).abs() < self.window)
+        return allowed
+
+    def _chunked(self, query, key, value, chunk_size):
+        # Блоки запросов; для window ключи блока - только полоса вокруг него
+        length = query.size(2)
+        out = torch.empty_like(query)
+        for start in range(0, length, chunk_size):
+            end = min(start + chunk_size, length)
+            key_start, key_end = 0, length
+            if self.window is not None:
+                key_start = max(0, start - self.window + 1)
+                key_end = end if self.causal else min(length, end + self.window - 1)
+            elif self.causal:
+                key_end = end
+            out[:, :, start:end] = F.scaled_dot_product_attention(
+                query[:, :, start:end], key[:, :, key_start:key_end], value[:, :, key_start:key_end],
+                attn_mask=self.mask(start, end, key_start, key_end, device=query.device))
+        return out
 
-        query = self.linear_query(x).view(batch_size, -1, self.n_heads, self.head_dim).permute(0, 2, 1, 3)
-        key = self.linear_key(x).view(batch_size, -1, self.n_heads, self.head_dim).permute(0, 2, 1, 3)
-        value = self.linear_value(x).view(batch_size, -1, self.n_heads, self.head_dim).permute(0, 2, 1, 3)
-
-        attention_scores = torch.matmul(query, key.transpose(-2, -1))
-        attention_scores = attention_scores / (self.head_dim ** 0.5)  # Scale the attention scores
-        attention_scores = self.softmax(attention_scores)
+    def forward(self, x):
+        batch_size = x.size(0)
+        query, key, value = self._heads(x)
 
-        attention_output = torch.matmul(attention_scores, value)
-        attention_output = attention_output.permute(0, 2, 1, 3).contiguous().view(batch_size, -1, self.n_heads * self.head_dim)
+        # scaled_dot_product_attention не хранит матрицу L x L (flash-ядро на CPU);
+        # для window и chunk_size - блоки запросов с полосой ключей
+        if self.window is not None or self.chunk_size is not None:
+            attention_output = self._chunked(query, key, value, self.chunk_size or 256)
+        else:
+            attention_output = F.scaled_dot_product_attention(query, key, value, is_causal=self.causal)
+        attention_output = attention_output.permute(0, 2, 1, 3).contiguous().view(batch_size, -1, self.out_channels)
 
         # Pass through output linear layer
         x = self.linear_out(attention_output)
 
-        return x
\ No newline at end of file
+        return x
+
+
+def reference_attention(layer, x):
+    """
+    Прежний расчёт слоя: полная матрица оценок (batch, heads, L, L), маска и Softmax.
+    Для проверки эквивалентности и сравнения памяти.
+    """
+    batch_size, length = x.size(0), x.size(1)
+    query, key, value = layer._heads(x)
+    attention_scores = torch.matmul(query, key.transpose(-2, -1)) / (layer.head_dim ** 0.5)
+    mask = layer.mask(0, length, 0, length, device=x.device)
+    if mask is not None:
+        attention_scores = attention_scores.masked_fill(~mask, float('-inf'))
+    attention_scores = torch.softmax(attention_scores, dim=-1)
+    attention_output = torch.matmul(attention_scores, value)
+    attention_output = attention_output.permute(0, 2, 1, 3).contiguous().view(batch_size, -1, layer.out_channels)
+    return layer.linear_out(attention_output)
+
+
+def equivalence_check(batch_size=4, length=300, channels=32, n_heads=4, seed=0, tolerance=1e-5):
+    """
+    Расхождение слоя с прежним расчётом (значения и градиенты) для всех режимов масок и бэкендов,
+    а также после загрузки чекпоинта с отдельными linear_query / linear_key / linear_value.
+    :param tolerance: допустимая абсолютная разница; при превышении - AssertionError
+    :return: словарь {режим: наибольшая абсолютная разница}
+    """
+    torch.manual_seed(seed)
+    x = torch.randn(batch_size, length, channels)
+    result = {}
+    modes = {'full': {}, 'causal': {'causal': True}, 'window': {'window': 17},
+             'causal_window': {'causal': True, 'window': 17}, 'chunked': {'chunk_size': 64},
+             'causal_chunked': {'causal': True, 'chunk_size': 64}}
+    for name, options in modes.items():
+        layer = AttentionLayerGRULSTM(channels, channels, n_heads=n_heads, **options)
+        inputs = [x.clone().requires_grad_(), x.clone().requires_grad_()]
+        fast, slow = layer(inputs[0]), reference_attention(layer, inputs[1])
+        fast.square().sum().backward()
+        slow.square().sum().backward()
+        result[name] = max((fast - slow).abs().max().item(), (inputs[0].grad - inputs[1].grad).abs().max().item())
+
+    # Чекпоинт прежнего формата: те же веса, разложенные на три проекции
+    layer = AttentionLayerGRULSTM(channels, channels, n_heads=n_heads)
+    query, key, value = layer.linear_qkv.weight.detach().chunk(3)
+    old_state = {'linear_query.weight': query, 'linear_key.weight': key, 'linear_value.weight': value,
+                 'linear_out.weight': layer.linear_out.weight.detach()}
+    loaded = AttentionLayerGRULSTM(channels, channels, n_heads=n_heads)
+    loaded.load_state_dict(old_state)
+    with torch.no_grad():
+        result['old_checkpoint'] = (loaded(x) - reference_attention(layer, x)).abs().max().item()
+
+    failed = {name: difference for name, difference in result.items() if not difference < tolerance}
+    assert not failed, f"Difference above {tolerance}: {failed}"
+    return result
+
+
+def _status_kb(field):
+    with open('/proc/self/status') as status:
+        return next(int(line.split()[1]) for line in status if line.startswith(field + ':'))
+
+
+def _peak_memory(variant, batch_size, length, channels, n_heads, options):
+    # Запускается в отдельном процессе: прирост пикового RSS за один прямой проход, МБ (Linux)
+    torch.manual_seed(0)
+    layer = AttentionLayerGRULSTM(channels, channels, n_heads=n_heads, **options)
+    x = torch.randn(batch_size, length, channels)
+    # Пик после импорта torch выше нужного слою: сбрасываем VmHWM до текущего RSS
+    with open('/proc/self/clear_refs', 'w') as clear_refs:
+        clear_refs.write('5')
+    before = _status_kb('VmRSS')
+    with torch.no_grad():
+        layer(x) if variant == 'fused' else reference_attention(layer, x)
+    return (_status_kb('VmHWM') - before) / 1024
+
+
+def memory_benchmark(lengths=(1024, 4096, 8192), batch_size=2, channels=64, n_heads=4, options=None):
+    """
+    Пиковая память прямого прохода прежнего расчёта и слоя (каждый замер - в новом процессе).
+    :param options: параметры слоя (causal, window, chunk_size)
+    :return: список словарей length, reference_mb, fused_mb
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    rows = []
+    context = multiprocessing.get_context('spawn')
+    for length in lengths:
+        row = {'length': length}
+        for variant in ('reference', 'fused'):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                row[variant + '_mb'] = pool.submit(_peak_memory, variant, batch_size, length, channels, n_heads,
+                                                   options or {}).result()
+        print(row)
+        rows.append(row)
+    return rows
+
+
+if __name__ == '__main__':
+    print(equivalence_check())
+    memory_benchmark()
@@ -1,11 +1,7 @@
 import torch
 import torch.nn as nn
 import torch_geometric.nn as pyg_nn
-
-import torch.nn as nn
-import torch_geometric.nn as pyg_nn
-
-from torch_geometric.nn import GATConv
+from torch_geometric.nn.conv.gcn_conv import gcn_norm
 
 '''
 class ImprovedGATLayer(nn.Module):
@@ -91,26 +87,80 @@ class GCN_CONV(pyg_nn.MessagePassing):
 
 
 class GCN_CONV(pyg_nn.MessagePassing):
-    def __init__(self, in_channels, out_channels, activation=None, use_batch_norm=False, residual=False):
+    def __init__(self, in_channels, out_channels, activation=None, use_batch_norm=False, residual=False,
+                 normalize=False, cached=False):
+        """
+        :param normalize: симметричная нормировка D^-1/2 (A + I) D^-1/2, как в GCNConv
+        :param cached: граф статичен - матрица смежности (с нормировкой и весами рёбер) строится один раз
+            как torch.sparse CSR, и свёртка - одно умножение разреженной матрицы на плотную вместо
+            gather/scatter в propagate. Кэш сбрасывается сам при подмене или изменении на месте
+            edge_index / edge_weight; reset_cache() - явный сброс после правки графа
+        """
         super(GCN_CONV, self).__init__(aggr='add')
         self.linear = nn.Linear(in_channels, out_channels)
         self.use_batch_norm = use_batch_norm
         self.batch_norm = nn.BatchNorm1d(out_channels) if use_batch_norm else None
         self.activation = activation or nn.ReLU()
         self.residual = residual
+        self.normalize = normalize
+        self.cached = cached
+        self._adjacency = None
+        self._adjacency_key = None
 
         # For residual connection, the in_channels and out_channels must be same
         if self.residual and in_channels != out_channels:
             raise ValueError("For residual connections, in_channels and out_channels must be the same.")
 
-    def forward(self, x, edge_index, edge_weight):
+    def reset_cache(self):
+        """
+        Сбрасывает сохранённую матрицу смежности: следующий forward построит её заново.
+        """
+        self._adjacency = None
+        self._adjacency_key = None
+
+    def adjacency(self, edge_index, edge_weight, num_nodes, dtype=None):
+        """
+        Матрица смежности torch.sparse CSR (N, N): строка - вершина-приёмник, как в propagate.
+        Кратные рёбра складываются, как при aggr='add'.
+        """
+        if self.normalize:
+            edge_index, edge_weight = gcn_norm(edge_index, edge_weight, num_nodes, add_self_loops=True,
+                                               dtype=dtype)
+        if edge_weight is None:
+            edge_weight = torch.ones(edge_index.size(1), dtype=dtype, device=edge_index.device)
+        adjacency = torch.sparse_coo_tensor(edge_index.flip(0), edge_weight.to(dtype), (num_nodes, num_nodes))
+        return adjacency.coalesce().to_sparse_csr()
+
+    def _cached_adjacency(self, edge_index, edge_weight, num_nodes, dtype):
+        # Подмена тензоров рёбер или их изменение на месте (_version) сбрасывает кэш сама
+        key = (edge_index.data_ptr(), edge_index._version, tuple(edge_index.shape), num_nodes, dtype,
+               None if edge_weight is None else (edge_weight.data_ptr(), edge_weight._version))
+        if self._adjacency is None or self._adjacency_key != key:
+            self._adjacency = self.adjacency(edge_index, edge_weight, num_nodes, dtype)
+            self._adjacency_key = key
+        return self._adjacency
+
+    def forward(self, x, edge_index, edge_weight=None):
         out = self.linear(x)
 
         # Residual connection
         if self.residual:
             out += x
 
-        out = self.propagate(edge_index, x=out, edge_weight=edge_weight)
+        # Обучаемые веса рёбер идут через propagate: градиент по значениям CSR torch считает плотным
+        if self.cached and (edge_weight is None or not edge_weight.requires_grad):
+            if out.dtype in (torch.bfloat16, torch.float16):
+                # Умножение CSR на CPU есть только для float32/float64 (bf16 autocast)
+                adjacency = self._cached_adjacency(edge_index, edge_weight, out.size(-2), torch.float32)
+                with torch.autocast(out.device.type, enabled=False):
+                    out = sparse_matmul(adjacency, out.float()).to(out.dtype)
+            else:
+                out = sparse_matmul(self._cached_adjacency(edge_index, edge_weight, out.size(-2), out.dtype), out)
+        else:
+            if self.normalize:
+                edge_index, edge_weight = gcn_norm(edge_index, edge_weight, out.size(-2), add_self_loops=True,
+                                                   dtype=out.dtype)
+            out = self.propagate(edge_index, x=out, edge_weight=edge_weight)
 
         if self.use_batch_norm:
             out = self.batch_norm(out)
@@ -121,6 +171,17 @@ class GCN_CONV(pyg_nn.MessagePassing):
         return x_j if edge_weight is None else x_j * edge_weight.view(-1, 1)
 
 
+def sparse_matmul(adjacency, x):
+    """
+    adjacency @ x по оси вершин (-2) для x формы (..., N, F): ведущие оси сворачиваются в признаки.
+    """
+    if x.dim() == 2:
+        return adjacency @ x
+    moved = x.movedim(-2, 0)
+    out = adjacency @ moved.reshape(moved.size(0), -1)
+    return out.reshape(moved.shape).movedim(0, -2)
+
+
 # gcn_layer = GCN_CONV(in_channels=16, out_channels=16, activation=nn.LeakyReLU(), use_batch_norm=True, residual=True)
 
 '''
@@ -1,27 +1,35 @@
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from models.GCN_CONV import GCN_CONV
 from models.AttentionLayer_GRU_LSTM import AttentionLayerGRULSTM
 
 
 class GCN_LSTM(nn.Module):
     def __init__(self, in_channels=1, hidden_channels=100, num_gcn_layers=3, num_rnn_layers=3, num_features=9, horizon=1,
-                 dropout=0):
+                 dropout=0, normalize=False, cached=False, gradient_checkpointing=False):
+        """
+        :param normalize: симметричная нормировка смежности в GCN-слоях
+        :param cached: граф статичен - GCN-слои хранят готовую разреженную матрицу смежности
+        :param gradient_checkpointing: при обучении активации GCN-слоёв не хранятся до backward,
+            а пересчитываются (память на глубокий стек - как на один слой, ценой второго прямого прохода)
+        """
         super(GCN_LSTM, self).__init__()
         self.num_features = num_features
         self.horizon = horizon
+        self.gradient_checkpointing = gradient_checkpointing
         self.layers = nn.ModuleList()
         self.batch_norms = nn.ModuleList()
         self.dropouts = nn.ModuleList()
 
         # Добавляем первый слой GCN
-        self.layers.append(GCN_CONV(in_channels, hidden_channels))
+        self.layers.append(GCN_CONV(in_channels, hidden_channels, normalize=normalize, cached=cached))
         self.batch_norms.append(nn.BatchNorm1d(hidden_channels))
         self.dropouts.append(nn.Dropout(dropout))
 
         # Добавляем остальные GCN-слои
         for _ in range(num_gcn_layers - 2):
-            self.layers.append(GCN_CONV(hidden_channels, hidden_channels))
+            self.layers.append(GCN_CONV(hidden_channels, hidden_channels, normalize=normalize, cached=cached))
             self.batch_norms.append(nn.BatchNorm1d(hidden_channels))
             self.dropouts.append(nn.Dropout(dropout))
 
@@ -37,7 +45,16 @@ class GCN_LSTM(nn.Module):
         # Выходной линейный слой, предсказывающий horizon шагов по num_features на каждый шаг
         self.output_layer = nn.Linear(hidden_channels, num_features * horizon)
 
+    def reset_cache(self):
+        # Вызывать после изменения рёбер графа при cached=True
+        for layer in self.layers:
+            layer.reset_cache()
+
     def forward(self, x, edge_index, edge_weight):
+        # Вход (batch, time, nodes, features) - пространственно-временной режим
+        if x.dim() == 4:
+            return self.forward_sequence(x, edge_index, edge_weight)
+
         # Проходим через GCN-слои
         for i, layer in enumerate(self.layers):
             x = layer(x, edge_index, edge_weight)
@@ -63,7 +80,77 @@ class GCN_LSTM(nn.Module):
 
         return x
 
+    def forward_sequence(self, x, edge_index, edge_weight=None, nodes=None):
+        """
+        Прогноз по окнам временных рядов на всех вершинах за один проход.
+        GCN-слои обрабатывают все batch x time снимки графа сразу (общая матрица смежности),
+        LSTM идёт по времени отдельно для каждой вершины (batch x nodes последовательностей).
+        :param x: (batch, time, nodes, in_channels)
+        :param nodes: индексы вершин, для которых нужен прогноз (None - все); LSTM считается только по ним
+        :return: прогноз (batch, horizon, nodes, num_features)
+        """
+        return self.temporal(self.spatial(x, edge_index, edge_weight), nodes=nodes)
+
+    def spatial(self, x, edge_index, edge_weight=None):
+        """
+        GCN-слои по всем снимкам (..., nodes, in_channels) -> (..., nodes, hidden_channels).
+        """
+        for i in range(len(self.layers)):
+            # Пересчитывается только свёртка: повторный BatchNorm в режиме обучения
+            # второй раз обновил бы running_mean / running_var
+            if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+                x = checkpoint(self.layers[i], x, edge_index, edge_weight, use_reentrant=False)
+            else:
+                x = self.layers[i](x, edge_index, edge_weight)
+            x = self._gcn_activation(i, x)
+        return x
+
+    def _gcn_activation(self, i, x):
+        # BatchNorm1d по каналам: все снимки и вершины - одна пачка
+        x = self.batch_norms[i](x.reshape(-1, x.size(-1))).view(x.shape)
+        x = torch.relu(x)
+        return self.dropouts[i](x)
+
+    def temporal(self, x, nodes=None):
+        """
+        Временная часть forward_sequence: LSTM, внимание и выходной слой по выходам GCN (batch, time, nodes, hidden).
+        """
+        if nodes is not None:
+            x = x[:, :, nodes]
+        batch_size, num_nodes = x.size(0), x.size(2)
+
+        # Последовательности по вершинам: (batch * nodes, time, hidden)
+        x = x.permute(0, 2, 1, 3).reshape(batch_size * num_nodes, x.size(1), x.size(-1))
+        x, _ = self.lstm(x)
+        return self.readout(x, batch_size, num_nodes)
+
+    def readout(self, x, batch_size, num_nodes):
+        """
+        Прогноз по выходам LSTM (batch * nodes, time, hidden) -> (batch, horizon, nodes, num_features).
+        """
+        # Внимание по шагам времени, затем Max Pooling по времени
+        x = self.attention_layer(x)
+        x = self.global_max_pooling(x.transpose(1, 2)).squeeze(-1)
 
-model = GCN_LSTM()
-num_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
-print(num_params)
\ No newline at end of file
+        x = self.output_layer(x)
+        # Порядок выходов линейного слоя - (num_features, horizon), как в forward
+        x = x.view(batch_size, num_nodes, self.num_features, self.horizon)
+        return x.permute(0, 3, 1, 2)
+
+
+def sliding_windows(series, window, horizon=1, stride=1):
+    """
+    Окна для обучения forward_sequence без копирования (view через unfold).
+    :param series: ряд снимков графа (time, nodes, features)
+    :param window: длина входного окна
+    :param horizon: число шагов прогноза после окна
+    :return: (входы (W, window, nodes, features), цели (W, horizon, nodes, features))
+    """
+    windows = series.unfold(0, window + horizon, stride).permute(0, 3, 1, 2)
+    return windows[:, :window], windows[:, window:]
+
+
+if __name__ == '__main__':
+    model = GCN_LSTM()
+    num_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    print(num_params)
\ No newline at end of file
@@ -0,0 +1,226 @@
+import copy
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+'''
+Экспорт GCN_LSTM для прогноза на CPU и пакетный запуск экспортированной модели.
+
+Граф дорог статичен, поэтому нормированные матрицы смежности GCN-слоёв вшиваются в модуль
+буферами, и экспортированной модели нужны только снимки признаков (batch, time, nodes, features).
+TorchScript-файл загружается одним torch (без torch_geometric и кода моделей); Linear (и по желанию LSTM)
+можно перевести в динамический int8 (quantize_dynamic). ONNX - без квантования, смежность
+там - scatter по рёбрам, потому что разреженных тензоров в ONNX нет.
+
+Сравнение задержки и точности: python -m models.inference
+'''
+
+
+class StaticGraphModel(nn.Module):
+    """
+    GCN_LSTM.forward_sequence с вшитым графом: forward(x) -> прогноз (batch, horizon, nodes, num_features).
+    """
+
+    def __init__(self, model, edge_index, num_nodes, edge_weight=None, aggregation='sparse'):
+        """
+        :param model: GCN_LSTM (в том числе после quantize_dynamic)
+        :param aggregation: 'sparse' - torch.sparse CSR и одно умножение, 'scatter' - scatter по рёбрам (для ONNX)
+        """
+        super(StaticGraphModel, self).__init__()
+        self.model = model.eval()
+        self.aggregation = aggregation
+        for i, layer in enumerate(model.layers):
+            adjacency = layer.adjacency(edge_index, edge_weight, num_nodes, dtype=torch.float32)
+            if aggregation == 'sparse':
+                self.register_buffer(f'adjacency_{i}', adjacency)
+            else:
+                adjacency = adjacency.to_sparse_coo().coalesce()
+                self.register_buffer(f'row_{i}', adjacency.indices()[0])
+                self.register_buffer(f'col_{i}', adjacency.indices()[1])
+                self.register_buffer(f'weight_{i}', adjacency.values())
+
+    def _aggregate(self, i, x):
+        if self.aggregation == 'sparse':
+            from models.GCN_CONV import sparse_matmul
+
+            return sparse_matmul(getattr(self, f'adjacency_{i}'), x)
+        row, col, weight = getattr(self, f'row_{i}'), getattr(self, f'col_{i}'), getattr(self, f'weight_{i}')
+        messages = x.index_select(-2, col) * weight.unsqueeze(-1)
+        # scatter_add, а не index_add_: в ONNX он переводится в ScatterElements(reduction='add')
+        index = row.view(-1, 1).expand(messages.shape)
+        return torch.zeros_like(x).scatter_add(-2, index, messages)
+
+    def forward(self, x):
+        # Те же операции, что GCN_CONV.forward и GCN_LSTM.forward_sequence в режиме eval
+        for i, layer in enumerate(self.model.layers):
+            out = layer.linear(x)
+            if layer.residual:
+                out = out + x
+            out = self._aggregate(i, out)
+            if layer.use_batch_norm:
+                out = layer.batch_norm(out.reshape(-1, out.size(-1))).view(out.shape)
+            out = layer.activation(out)
+            x = torch.relu(self.model.batch_norms[i](out.reshape(-1, out.size(-1))).view(out.shape))
+        return self.model.temporal(x)
+
+
+def quantize(model, lstm=False):
+    """
+    Копия модели с динамическим int8 для Linear (веса int8, активации квантуются на лету).
+    :param lstm: квантовать и LSTM; при небольших hidden_channels квантованный LSTM на CPU
+        медленнее fp32 (oneDNN), поэтому по умолчанию выключено
+    """
+    layers = {nn.Linear, nn.LSTM} if lstm else {nn.Linear}
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).eval(), layers, dtype=torch.qint8)
+
+
+def export_torchscript(model, edge_index, num_nodes, example, path=None, edge_weight=None, quantized=False,
+                       quantize_lstm=False):
+    """
+    Трассировка GCN_LSTM с вшитым графом в TorchScript.
+    :param example: пример входа (batch, time, nodes, features); размер batch при запуске может быть любым
+    :param path: файл для torch.jit.save (None - не сохранять)
+    :param quantized: динамическое int8 для Linear
+    :param quantize_lstm: при quantized - и для LSTM
+    :return: ScriptModule
+    """
+    model = quantize(model, lstm=quantize_lstm) if quantized else copy.deepcopy(model).eval()
+    module = StaticGraphModel(model, edge_index, num_nodes, edge_weight=edge_weight)
+    with torch.no_grad():
+        traced = torch.jit.trace(module, example, check_trace=False)
+    if path is not None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        torch.jit.save(traced, str(path))
+    return traced
+
+
+def export_onnx(model, edge_index, num_nodes, example, path, edge_weight=None, opset_version=17):
+    """
+    Экспорт в ONNX (без квантования; агрегация - scatter по рёбрам). Нужен пакет onnx.
+    """
+    module = StaticGraphModel(copy.deepcopy(model).eval(), edge_index, num_nodes, edge_weight=edge_weight,
+                              aggregation='scatter')
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    torch.onnx.export(module, (example,), str(path), input_names=['x'], output_names=['forecast'],
+                      dynamic_axes={'x': {0: 'batch'}, 'forecast': {0: 'batch'}}, opset_version=opset_version,
+                      dynamo=False)
+
+
+class InferenceRunner:
+    """
+    Пакетный прогноз экспортированной моделью: граф уже внутри модели, на вход - много снимков за вызов.
+    """
+
+    def __init__(self, model, batch_size=64, threads=None):
+        """
+        :param model: путь к .pt (TorchScript) или .onnx, либо готовый модуль
+        :param batch_size: число окон в одном проходе модели
+        :param threads: число потоков torch / onnxruntime (None - по умолчанию)
+        """
+        self.batch_size = batch_size
+        self.session = None
+        if threads is not None:
+            torch.set_num_threads(threads)
+        if isinstance(model, (str, Path)) and str(model).endswith('.onnx'):
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            if threads is not None:
+                options.intra_op_num_threads = threads
+            self.session = onnxruntime.InferenceSession(str(model), options, providers=['CPUExecutionProvider'])
+        elif isinstance(model, (str, Path)):
+            self.model = torch.jit.load(str(model), map_location='cpu')
+        else:
+            self.model = model
+        if self.session is None:
+            self.model.eval()
+
+    def _run(self, x):
+        if self.session is not None:
+            return torch.from_numpy(self.session.run(None, {'x': x.numpy()})[0])
+        with torch.inference_mode():
+            return self.model(x)
+
+    def predict(self, snapshots):
+        """
+        :param snapshots: окна (S, time, nodes, features), numpy или torch
+        :return: прогноз (S, horizon, nodes, num_features)
+        """
+        snapshots = torch.as_tensor(snapshots, dtype=torch.float32)
+        return torch.cat([self._run(snapshots[start:start + self.batch_size].contiguous())
+                          for start in range(0, len(snapshots), self.batch_size)])
+
+    def benchmark(self, snapshots, repeats=5, warmup=1):
+        """
+        Задержка одного прохода (пачка batch_size окон) и пропускная способность.
+        :return: словарь latency_ms (медиана), latency_p95_ms, throughput (окон в секунду)
+        """
+        snapshots = torch.as_tensor(snapshots, dtype=torch.float32)
+        batch = snapshots[:self.batch_size].contiguous()
+        for _ in range(warmup):
+            self._run(batch)
+        latencies = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            self._run(batch)
+            latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        self.predict(snapshots)
+        total = time.perf_counter() - start
+        return {'latency_ms': 1000 * float(np.median(latencies)),
+                'latency_p95_ms': 1000 * float(np.percentile(latencies, 95)),
+                'throughput': len(snapshots) / total}
+
+
+def drift(reference, prediction):
+    """
+    Отклонение прогноза от eager-модели: наибольшая абсолютная и относительная RMS-ошибка.
+    """
+    difference = (prediction - reference).float()
+    return {'max_abs': difference.abs().max().item(),
+            'relative_rms': (difference.square().mean().sqrt() / reference.float().square().mean().sqrt()).item()}
+
+
+def benchmark(num_nodes=1000, num_edges=4000, window=12, horizon=3, features=3, hidden_channels=64, windows=64,
+              batch_size=16, directory='cache/inference_benchmark', seed=0):
+    """
+    Задержка, пропускная способность и дрейф точности eager-модели, TorchScript fp32 и int8
+    на случайном графе.
+    :return: список словарей по вариантам
+    """
+    from models.GCN_LSTM import GCN_LSTM
+
+    torch.manual_seed(seed)
+    edge_index = torch.randint(0, num_nodes, (2, num_edges))
+    edge_weight = torch.rand(num_edges)
+    model = GCN_LSTM(in_channels=features, hidden_channels=hidden_channels, num_features=features, horizon=horizon,
+                     normalize=True, cached=True).eval()
+    snapshots = torch.randn(windows, window, num_nodes, features)
+
+    class Eager(nn.Module):
+        def forward(self, x):
+            return model.forward_sequence(x, edge_index, edge_weight)
+
+    directory = Path(directory)
+    runners = {'eager': InferenceRunner(Eager(), batch_size=batch_size)}
+    for name, quantized, quantize_lstm in (('torchscript', False, False), ('torchscript_int8', True, False),
+                                           ('torchscript_int8_lstm', True, True)):
+        path = directory / f'{name}.pt'
+        export_torchscript(model, edge_index, num_nodes, snapshots[:batch_size], path, edge_weight=edge_weight,
+                           quantized=quantized, quantize_lstm=quantize_lstm)
+        runners[name] = InferenceRunner(path, batch_size=batch_size)
+
+    reference = runners['eager'].predict(snapshots)
+    rows = []
+    for name, runner in runners.items():
+        row = {'model': name, **runner.benchmark(snapshots), **drift(reference, runner.predict(snapshots))}
+        print(row)
+        rows.append(row)
+    return rows
+
+
+if __name__ == '__main__':
+    benchmark()
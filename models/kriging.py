@@ -1,102 +1,161 @@
 import numpy as np
 import pandas as pd
 import networkx as nx
-from pykrige.ok import OrdinaryKriging
-from geopy.distance import geodesic
-import matplotlib.pyplot as plt
+
+from models.local_kriging import LocalKriging, write_ascii_grid
+from models.network_kriging import NetworkDistances, NetworkKriging, network_arrays, split_edges
+from utils.detour_index import node_indices
+from utils.edge_candidates import EdgeCandidates
+
+# Пример: кригинг трафика по наблюдениям на участках дорог и оценка новых дорожек.
+# Запуск из корня репозитория: python -m models.kriging
+
 
 # === 1. Подготовка данных ===
 
-# Данные о дорожной сети (узлы и рёбра)
-nodes_data = pd.DataFrame({
-    'node_id': [1, 2, 3, 4],
-    'x': [100, 200, 300, 400],  # Координата x (долгота)
-    'y': [100, 200, 300, 400]   # Координата y (широта)
-})
-
-edges_data = pd.DataFrame({
-    'start_node': [1, 2, 3],
-    'end_node': [2, 3, 4],
-    'traffic': [50, 80, 60]     # Трафик на каждом участке дороги
-})
-
-# Данные о точках интереса (например, школы или больницы)
-points_of_interest = pd.DataFrame({
-    'poi_id': [1, 2],
-    'x': [150, 350],
-    'y': [150, 350]
-})
+def example_data():
+    """
+    Данные о дорожной сети (узлы и рёбра) и точках интереса (например, школы или больницы).
+    """
+    nodes_data = pd.DataFrame({
+        'node_id': [1, 2, 3, 4],
+        'x': [100, 200, 300, 400],  # Координата x в метрах (UTM, см. build_graph)
+        'y': [100, 200, 300, 400]   # Координата y в метрах
+    })
+
+    edges_data = pd.DataFrame({
+        'start_node': [1, 2, 3],
+        'end_node': [2, 3, 4],
+        'traffic': [50, 80, 60]     # Трафик на каждом участке дороги
+    })
+
+    points_of_interest = pd.DataFrame({
+        'poi_id': [1, 2],
+        'x': [150, 350],
+        'y': [150, 350]
+    })
+    return nodes_data, edges_data, points_of_interest
+
 
 # === 2. Создание графа дорожной сети ===
 
-G = nx.Graph()
+def build_graph(nodes_data, edges_data, crs='EPSG:32637'):
+    # Координаты примера - метры в метрической проекции, а не долгота и широта
+    G = nx.Graph(crs=crs)
 
-# Добавляем узлы в граф
-for _, row in nodes_data.iterrows():
-    G.add_node(row['node_id'], pos=(row['x'], row['y']))
+    # Добавляем узлы в граф
+    for _, row in nodes_data.iterrows():
+        G.add_node(row['node_id'], pos=(row['x'], row['y']), x=row['x'], y=row['y'])
+
+    # Добавляем рёбра в граф; длина участка - по координатам узлов
+    for _, row in edges_data.iterrows():
+        start, end = G.nodes[row['start_node']], G.nodes[row['end_node']]
+        G.add_edge(row['start_node'], row['end_node'], traffic=row['traffic'],
+                   length=float(np.hypot(end['x'] - start['x'], end['y'] - start['y'])))
+    return G
 
-# Добавляем рёбра в граф
-for _, row in edges_data.iterrows():
-    G.add_edge(row['start_node'], row['end_node'], traffic=row['traffic'])
 
 # === 3. Построение модели кригинга ===
 
-# Извлечение координат и значений трафика для кригинга
-x_coords = nodes_data['x'].values
-y_coords = nodes_data['y'].values
-traffic_data = edges_data['traffic'].values
+def traffic_model(nodes_data, edges_data, n_neighbours=32, variogram_model='linear', variogram_parameters=None):
+    """
+    Локальный кригинг трафика: наблюдения - середины участков дорог.
+    """
+    position = nodes_data.set_index('node_id')[['x', 'y']]
+    start = position.loc[edges_data['start_node']].to_numpy(dtype=np.float64)
+    end = position.loc[edges_data['end_node']].to_numpy(dtype=np.float64)
+    middle = (start + end) / 2
+    return LocalKriging(middle[:, 0], middle[:, 1], edges_data['traffic'].to_numpy(dtype=np.float64),
+                        variogram_model=variogram_model, variogram_parameters=variogram_parameters,
+                        n_neighbours=n_neighbours)
+
+
+def network_traffic_model(G, nodes_data, edges_data, cutoff=1000.0, cache=None, n_neighbours=32,
+                          variogram_model='exponential', variogram_parameters=None):
+    """
+    Кригинг трафика по сети: наблюдения - вершины в серединах участков, прогноз - в узлах графа.
+    Расстояния по сети считаются один раз (и сохраняются в cache, если он задан).
+    :return: (модель, позиции узлов в матрице расстояний)
+    """
+    matrix, xy, keys = network_arrays(G, xy=nodes_data.set_index('node_id').loc[list(G.nodes), ['x', 'y']].to_numpy())
+    n_nodes = matrix.shape[0]
+    u = node_indices(None, keys, list(edges_data['start_node']))
+    v = node_indices(None, keys, list(edges_data['end_node']))
+    matrix, xy, middle = split_edges(matrix, xy, u, v)
+    sites = np.concatenate([middle, np.arange(n_nodes)])
+    if cache is None:
+        distances = NetworkDistances.build(matrix, xy, sites, cutoff)
+    else:
+        distances = NetworkDistances.cached(cache, matrix, xy, sites, cutoff)
+    model = NetworkKriging(distances, np.arange(len(middle)), edges_data['traffic'].to_numpy(dtype=np.float64),
+                           variogram_model=variogram_model, variogram_parameters=variogram_parameters,
+                           n_neighbours=n_neighbours)
+    return model, np.arange(len(middle), len(sites))
 
-# Создание модели кригинга
-ok = OrdinaryKriging(
-    x_coords, y_coords, traffic_data,
-    variogram_model="linear",
-    verbose=False,
-    enable_plotting=False
-)
 
 # === 4. Интерполяция трафика на потенциальных новых дорожках ===
 
-# Задаем сетку координат для предсказания значений
-gridx = np.linspace(0, 500, 100)
-gridy = np.linspace(0, 500, 100)
+def interpolate(model, gridx, gridy, raster_path=None, workers=1):
+    """
+    Прогноз трафика на сетке; при raster_path сетка сохраняется в ESRI ASCII Grid.
+    """
+    z, ss = model.predict_grid(gridx, gridy, workers=workers)
+    if raster_path is not None:
+        write_ascii_grid(raster_path, z, gridx, gridy)
+    return z, ss
 
-# Выполняем интерполяцию кригинга
-z, ss = ok.execute("grid", gridx, gridy)
 
-# Визуализация предсказаний
-plt.imshow(z, origin="lower", extent=(0, 500, 0, 500))
-plt.scatter(points_of_interest['x'], points_of_interest['y'], color='red', label='POI')
-plt.colorbar(label="Предсказанный трафик")
-plt.legend()
-plt.title("Карта предсказанного трафика для новых дорожек")
-plt.xlabel("Долгота")
-plt.ylabel("Широта")
-plt.show()
+def plot_traffic(z, points_of_interest, extent=(0, 500, 0, 500)):
+    # Визуализация предсказаний
+    import matplotlib.pyplot as plt
 
-# === 5. Добавление новых дорожек в граф ===
+    plt.imshow(z, origin="lower", extent=extent)
+    plt.scatter(points_of_interest['x'], points_of_interest['y'], color='red', label='POI')
+    plt.colorbar(label="Предсказанный трафик")
+    plt.legend()
+    plt.title("Карта предсказанного трафика для новых дорожек")
+    plt.xlabel("x, м")
+    plt.ylabel("y, м")
+    plt.show()
 
-# Добавляем новый узел и ребро на основе предсказаний кригинга
-new_node_id = max(nodes_data['node_id']) + 1
-G.add_node(new_node_id, pos=(250, 250))  # Пример новой точки с координатами (250, 250)
-G.add_edge(2, new_node_id, traffic=70)   # Пример нового ребра с предсказанным трафиком
 
-# === 6. Пересчёт детур индекса ===
+# === 5-6. Кандидаты в новые дорожки и пересчёт детур индекса ===
 
-def calculate_detour_index(graph, source, target, weight='traffic'):
+def rank_candidates(G, source_nodes, target_nodes, candidate_u, candidate_v, candidate_weight, weight='traffic'):
     """
-    Рассчитывает детур индекс между двумя узлами в графе.
+    Граф не меняется: каждое ребро-кандидат оценивается по изменению детур индексов пар.
     """
-    try:
-        network_distance = nx.shortest_path_length(graph, source=source, target=target, weight=weight)
-        source_coords = (graph.nodes[source]['pos'][1], graph.nodes[source]['pos'][0])
-        target_coords = (graph.nodes[target]['pos'][1], graph.nodes[target]['pos'][0])
-        euclidean_distance = geodesic(source_coords, target_coords).meters
-        return network_distance / euclidean_distance
-    except (nx.NetworkXNoPath, nx.NodeNotFound):
-        return None
-
-# Пример расчёта детур индекса для нового пути
-source_node = 1
-target_node = new_node_id
-detour_index = calculate_detour_index(G, source_node, target_node)
-print(f"Детур индекс между узлами {source_node} и {target_node}: {detour_index}")
+    candidates = EdgeCandidates(G, source_nodes, target_nodes, weight=weight)
+    return candidates, candidates.rank(candidate_u, candidate_v, candidate_weight)
+
+
+def main():
+    nodes_data, edges_data, points_of_interest = example_data()
+    G = build_graph(nodes_data, edges_data)
+
+    model = traffic_model(nodes_data, edges_data, variogram_parameters=[1.0, 0.0])
+    gridx = np.linspace(0, 500, 100)
+    gridy = np.linspace(0, 500, 100)
+    z, ss = interpolate(model, gridx, gridy)
+    plot_traffic(z, points_of_interest)
+
+    # Тот же трафик по сети: прогноз в узлах учитывает только связность дорог
+    network_model, node_sites = network_traffic_model(G, nodes_data, edges_data, variogram_model='linear',
+                                                      variogram_parameters=[1.0, 0.0])
+    node_traffic, _ = network_model.predict(node_sites)
+    print(dict(zip(G.nodes, node_traffic.tolist())))
+
+    candidate_u = [1, 1, 2]
+    candidate_v = [3, 4, 4]
+    candidate_traffic = [70, 90, 75]  # Пример трафика на новых рёбрах по предсказаниям кригинга
+    candidates, ranking = rank_candidates(G, [1, 1, 2], [3, 4, 4], candidate_u, candidate_v, candidate_traffic)
+    print(ranking)
+
+    # Принимаем лучшее ребро и смотрим детур индексы пар после него
+    best = ranking.index[0]
+    detour_index = candidates.accept(candidate_u[best], candidate_v[best], candidate_traffic[best])
+    print(f"Детур индексы после добавления ребра {candidate_u[best]}-{candidate_v[best]}: {detour_index}")
+
+
+if __name__ == '__main__':
+    main()
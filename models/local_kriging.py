@@ -0,0 +1,313 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from pykrige import variogram_models
+from pykrige.ok import OrdinaryKriging
+from scipy import sparse
+from scipy.linalg import lu_factor, lu_solve
+from scipy.optimize import least_squares
+from scipy.spatial import cKDTree
+
+VARIOGRAM_MODELS = {
+    'linear': variogram_models.linear_variogram_model,
+    'power': variogram_models.power_variogram_model,
+    'gaussian': variogram_models.gaussian_variogram_model,
+    'spherical': variogram_models.spherical_variogram_model,
+    'exponential': variogram_models.exponential_variogram_model,
+    'hole-effect': variogram_models.hole_effect_variogram_model,
+}
+
+
+def fit_variogram(x, y, z, variogram_model='linear', sample=2000, seed=0, nlags=6):
+    """
+    Параметры вариограммы по случайной подвыборке наблюдений (подбор pykrige).
+    Полная выборка не нужна: эмпирическая вариограмма по тысячам точек уже устойчива,
+    а pykrige считает все попарные расстояния.
+    :return: список параметров в формате pykrige
+    """
+    x, y, z = (np.asarray(values, dtype=np.float64) for values in (x, y, z))
+    if len(z) > sample:
+        chosen = np.random.default_rng(seed).choice(len(z), sample, replace=False)
+        x, y, z = x[chosen], y[chosen], z[chosen]
+    model = OrdinaryKriging(x, y, z, variogram_model=variogram_model, nlags=nlags,
+                            verbose=False, enable_plotting=False)
+    return list(model.variogram_model_parameters)
+
+
+def fit_variogram_model(lags, semivariance, variogram_model='exponential'):
+    """
+    Параметры вариограммы по эмпирической вариограмме (лаги и полудисперсии) - тот же подбор,
+    что в pykrige (least_squares с soft_l1, те же начальные значения и границы), но без координат:
+    годится для сетевых расстояний.
+    :param lags: средние расстояния по лагам
+    :param semivariance: полудисперсии по лагам
+    :return: список параметров в формате pykrige
+    """
+    lags, semivariance = np.asarray(lags, dtype=np.float64), np.asarray(semivariance, dtype=np.float64)
+    low, high = semivariance.min(), semivariance.max()
+    if variogram_model == 'linear':
+        x0 = [(high - low) / (lags.max() - lags.min()), low]
+        bounds = ([0.0, 0.0], [np.inf, high])
+    elif variogram_model == 'power':
+        x0 = [(high - low) / (lags.max() - lags.min()), 1.1, low]
+        bounds = ([0.0, 0.001, 0.0], [np.inf, 1.999, high])
+    else:
+        # Частичный порог (sill - nugget), радиус и самородок
+        x0 = [high - low, 0.25 * lags.max(), low]
+        bounds = ([0.0, 0.0, 0.0], [10.0 * high, lags.max(), high])
+    function = VARIOGRAM_MODELS[variogram_model]
+    result = least_squares(lambda parameters: function(parameters, lags) - semivariance, x0,
+                           bounds=bounds, loss='soft_l1')
+    return list(result.x)
+
+
+class LocalKriging:
+    """
+    Обычный кригинг в скользящем окне: каждая точка прогноза решает свою систему
+    по k ближайшим наблюдениям (cKDTree) вместо одной системы размера n по всем наблюдениям.
+
+    Системы (k + 1) x (k + 1) решаются пачками по chunk_size точек, поэтому пиковая память -
+    chunk_size * (k + 1)^2 чисел; пачки можно раздать пулу процессов.
+    Матрица кригинга и результат - как в pykrige.OrdinaryKriging.
+    """
+
+    def __init__(self, x, y, z, variogram_model='linear', variogram_parameters=None, n_neighbours=32,
+                 sample=2000, seed=0):
+        """
+        :param x, y: координаты наблюдений (лучше в метрической проекции)
+        :param z: значения наблюдений (например, трафик)
+        :param variogram_model: модель вариограммы pykrige
+        :param variogram_parameters: параметры модели; None - подбор по подвыборке
+        :param n_neighbours: число ближайших наблюдений в окне
+        :param sample: размер подвыборки для подбора вариограммы
+        """
+        self.xy = np.column_stack([np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)])
+        self.z = np.asarray(z, dtype=np.float64)
+        self.variogram_model = variogram_model
+        self.variogram_function = VARIOGRAM_MODELS[variogram_model]
+        if variogram_parameters is None:
+            variogram_parameters = fit_variogram(x, y, z, variogram_model, sample=sample, seed=seed)
+        self.variogram_parameters = list(variogram_parameters)
+        self.n_neighbours = min(n_neighbours, len(self.z))
+        self.tree = cKDTree(self.xy)
+        self.eps = 1e-10
+
+    def _variogram(self, distance):
+        return self.variogram_function(self.variogram_parameters, distance)
+
+    def _weights_chunk(self, points):
+        # Веса кригинга (M, k + 1), номера наблюдений окна (M, k) и правая часть системы для пачки точек
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        k = self.n_neighbours
+        distance, neighbours = self.tree.query(points, k=k)
+        distance, neighbours = distance.reshape(len(points), k), neighbours.reshape(len(points), k)
+
+        # Матрица кригинга для каждого окна: -gamma между наблюдениями, строка и столбец единиц
+        window = self.xy[neighbours]
+        pairwise = np.linalg.norm(window[:, :, None, :] - window[:, None, :, :], axis=-1)
+        a = np.zeros((len(points), k + 1, k + 1))
+        a[:, :k, :k] = -self._variogram(pairwise)
+        a[:, np.arange(k), np.arange(k)] = 0.0
+        a[:, k, :k] = 1.0
+        a[:, :k, k] = 1.0
+
+        b = np.ones((len(points), k + 1))
+        b[:, :k] = -self._variogram(distance)
+        # Точное совпадение с наблюдением: как exact_values в pykrige
+        b[:, :k][distance <= self.eps] = 0.0
+
+        weights = np.linalg.solve(a, b[:, :, None])[:, :, 0]
+        return weights, neighbours, b
+
+    def predict_chunk(self, points):
+        """
+        Прогноз и дисперсия кригинга для пачки точек (M, 2).
+        """
+        weights, neighbours, b = self._weights_chunk(points)
+        values = np.sum(weights[:, :self.n_neighbours] * self.z[neighbours], axis=1)
+        variance = np.sum(weights * -b, axis=1)
+        return values, variance
+
+    def weight_matrix(self, x, y, chunk_size=4096):
+        """
+        Веса кригинга как разреженная матрица (точки, наблюдения): прогноз - weight_matrix @ z.
+        Веса не зависят от значений наблюдений.
+        :return: (CSR-матрица весов, дисперсии кригинга)
+        """
+        points = np.column_stack([np.ravel(x), np.ravel(y)]).astype(np.float64)
+        k = self.n_neighbours
+        rows, cols, data, variance = [], [], [], []
+        for start in range(0, len(points), chunk_size):
+            weights, neighbours, b = self._weights_chunk(points[start:start + chunk_size])
+            rows.append(np.repeat(np.arange(start, start + len(weights)), k))
+            cols.append(neighbours.ravel())
+            data.append(weights[:, :k].ravel())
+            variance.append(np.sum(weights * -b, axis=1))
+        if not rows:
+            return sparse.csr_matrix((0, len(self.z))), np.empty(0)
+        matrix = sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                   shape=(len(points), len(self.z)))
+        return matrix, np.concatenate(variance)
+
+    def predict(self, x, y, chunk_size=4096, workers=1):
+        """
+        Прогноз в произвольных точках.
+        :param chunk_size: число точек в пачке
+        :param workers: число процессов (1 - без пула, None - по числу ядер)
+        :return: (значения, дисперсии) формы x
+        """
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        points = np.column_stack([x.ravel(), y.ravel()])
+        bounds = list(range(0, len(points), chunk_size)) + [len(points)]
+        chunks = [points[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+        workers = workers or os.cpu_count()
+        if workers == 1 or len(chunks) < 2:
+            results = [self.predict_chunk(chunk) for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self,)) as pool:
+                results = list(pool.map(_predict_chunk, chunks))
+
+        if not results:
+            return np.empty(x.shape), np.empty(x.shape)
+        values, variance = (np.concatenate(parts) for parts in zip(*results))
+        return values.reshape(x.shape), variance.reshape(x.shape)
+
+    def predict_grid(self, gridx, gridy, chunk_size=4096, workers=1):
+        """
+        Прогноз на прямоугольной сетке, как ok.execute('grid', gridx, gridy).
+        :return: (значения, дисперсии) формы (len(gridy), len(gridx))
+        """
+        x, y = np.meshgrid(np.asarray(gridx, dtype=np.float64), np.asarray(gridy, dtype=np.float64))
+        return self.predict(x, y, chunk_size=chunk_size, workers=workers)
+
+
+class SensorKriging:
+    """
+    Кригинг для неподвижных датчиков и неподвижных точек прогноза, когда меняются только значения.
+
+    Веса обычного кригинга зависят только от положения датчиков, точек и вариограммы, поэтому
+    считаются один раз: система по всем датчикам раскладывается (LU) и хранится, веса точек
+    прогноза - матрица (точки, датчики). Шаг по времени - одно умножение матрицы на вектор,
+    пачка шагов - одно умножение матриц.
+    """
+
+    def __init__(self, weights, variance):
+        """
+        :param weights: матрица весов (точки, датчики), плотная или scipy.sparse
+        :param variance: дисперсии кригинга точек (NaN - прогноз невозможен)
+        """
+        self.weights = weights
+        self.variance = np.asarray(variance, dtype=np.float64)
+        self.undefined = np.isnan(self.variance)
+        self.xy = None
+        self.factor = None
+
+    @classmethod
+    def planar(cls, x, y, target_x, target_y, z=None, variogram_model='linear', variogram_parameters=None,
+               n_neighbours=None, sample=2000, seed=0, chunk_size=4096):
+        """
+        :param x, y: координаты датчиков
+        :param target_x, target_y: координаты точек прогноза
+        :param z: значения одного шага для подбора вариограммы (не нужны, если задан variogram_parameters)
+        :param n_neighbours: None - одна система по всем датчикам (как pykrige), иначе окно
+            из n_neighbours ближайших датчиков (разреженные веса, LocalKriging)
+        """
+        if variogram_parameters is None:
+            if z is None:
+                raise ValueError("Either z or variogram_parameters is required to set up the variogram.")
+            variogram_parameters = fit_variogram(x, y, z, variogram_model, sample=sample, seed=seed)
+        if n_neighbours is not None:
+            model = LocalKriging(x, y, np.zeros(len(np.ravel(x))), variogram_model=variogram_model,
+                                 variogram_parameters=variogram_parameters, n_neighbours=n_neighbours)
+            return cls(*model.weight_matrix(target_x, target_y, chunk_size=chunk_size))
+
+        kriging = cls(np.empty((0, len(np.ravel(x)))), np.empty(0))
+        kriging.variogram_function = VARIOGRAM_MODELS[variogram_model]
+        kriging.variogram_parameters = list(variogram_parameters)
+        kriging.xy = np.column_stack([np.ravel(x), np.ravel(y)]).astype(np.float64)
+        n = len(kriging.xy)
+        a = np.zeros((n + 1, n + 1))
+        a[:n, :n] = -kriging._variogram(np.linalg.norm(kriging.xy[:, None, :] - kriging.xy[None, :, :], axis=-1))
+        np.fill_diagonal(a[:n, :n], 0.0)
+        a[n, :n] = 1.0
+        a[:n, n] = 1.0
+        kriging.factor = lu_factor(a)
+        kriging.weights, kriging.variance = kriging.target_weights(target_x, target_y, chunk_size=chunk_size)
+        kriging.undefined = np.isnan(kriging.variance)
+        return kriging
+
+    @classmethod
+    def from_model(cls, model, *targets, chunk_size=4096):
+        """
+        Веса из готовой модели с методом weight_matrix (LocalKriging, NetworkKriging).
+        :param targets: аргументы weight_matrix модели (x, y или позиции точек)
+        """
+        return cls(*model.weight_matrix(*targets, chunk_size=chunk_size))
+
+    def _variogram(self, distance):
+        return self.variogram_function(self.variogram_parameters, distance)
+
+    def target_weights(self, x, y, chunk_size=4096):
+        """
+        Веса для новых точек по сохранённому разложению системы (только для системы по всем датчикам).
+        :return: (плотная матрица весов (точки, датчики), дисперсии)
+        """
+        if self.factor is None:
+            raise ValueError("The kriging system is not factorized: use SensorKriging.planar without n_neighbours.")
+        points = np.column_stack([np.ravel(x), np.ravel(y)]).astype(np.float64)
+        n = len(self.xy)
+        weights, variance = [], []
+        for start in range(0, len(points), chunk_size):
+            distance = np.linalg.norm(points[start:start + chunk_size, None, :] - self.xy[None, :, :], axis=-1)
+            b = np.ones((n + 1, len(distance)))
+            b[:n] = -self._variogram(distance).T
+            # Точное совпадение с датчиком: как exact_values в pykrige
+            b[:n][distance.T <= 1e-10] = 0.0
+            solution = lu_solve(self.factor, b)
+            weights.append(solution[:n].T)
+            variance.append(np.sum(solution * -b, axis=0))
+        if not weights:
+            return np.empty((0, n)), np.empty(0)
+        return np.concatenate(weights), np.concatenate(variance)
+
+    def predict(self, z):
+        """
+        :param z: значения датчиков одного шага (n,) или пачки шагов (T, n)
+        :return: прогноз в точках (M,) или (T, M)
+        """
+        z = np.asarray(z, dtype=np.float64)
+        values = self.weights @ z if z.ndim == 1 else (self.weights @ z.T).T
+        values = np.asarray(values)
+        if self.undefined.any():
+            values[..., self.undefined] = np.nan
+        return values
+
+
+def _init_worker(model):
+    # Модель (дерево и наблюдения) передаётся в каждый процесс один раз
+    global _worker_model
+    _worker_model = model
+
+
+def _predict_chunk(points):
+    return _worker_model.predict_chunk(points)
+
+
+def write_ascii_grid(path, values, gridx, gridy, nodata=-9999.0):
+    """
+    Сохраняет сетку прогноза в растр ESRI ASCII Grid (читается GDAL/QGIS).
+    :param values: массив (len(gridy), len(gridx)), строки - по возрастанию gridy
+    :param gridx, gridy: центры ячеек с постоянным шагом
+    """
+    gridx, gridy = np.asarray(gridx, dtype=np.float64), np.asarray(gridy, dtype=np.float64)
+    dx = float(gridx[-1] - gridx[0]) / max(len(gridx) - 1, 1)
+    dy = float(gridy[-1] - gridy[0]) / max(len(gridy) - 1, 1)
+    header = [f'ncols {len(gridx)}', f'nrows {len(gridy)}',
+              f'xllcorner {float(gridx[0]) - dx / 2!r}', f'yllcorner {float(gridy[0]) - dy / 2!r}']
+    header += [f'cellsize {dx!r}'] if np.isclose(dx, dy) else [f'dx {dx!r}', f'dy {dy!r}']
+    header.append(f'NODATA_value {float(nodata)!r}')
+    # В ASCII Grid первая строка - северная
+    rows = np.where(np.isfinite(values), values, nodata)[::-1]
+    np.savetxt(path, rows, header='\n'.join(header), comments='', fmt='%.6g')
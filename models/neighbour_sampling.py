@@ -0,0 +1,309 @@
+import copy
+import queue
+import threading
+from collections import namedtuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch_geometric.nn.conv.gcn_conv import gcn_norm
+
+from models.GCN_LSTM import GCN_LSTM, sliding_windows
+
+'''
+Обучение GCN_LSTM мини-батчами по вершинам для графов масштаба города на CPU.
+
+Для пачки вершин-целей выбираются k-хоп окрестности (не больше fanout входящих рёбер на вершину
+и хоп), GCN-слои считаются только на этом подграфе, LSTM - только по целям. Память на шаг
+определяется размером пачки и fanout, а не размером города. Следующая пачка готовится в фоновом
+потоке, пока модель считает текущую.
+
+Нормировка смежности (normalize) считается один раз по всему графу: степени в подграфе неполные,
+поэтому модель строится с normalize=False и получает уже нормированные веса рёбер.
+'''
+
+Subgraph = namedtuple('Subgraph', ['nodes', 'edge_index', 'edge_weight', 'num_targets'])
+
+
+class NeighbourSampler:
+    """
+    Выборка k-хоп окрестностей с ограничением fanout: для каждой вершины фронта берётся
+    не больше fanout случайных входящих рёбер. Цели в подграфе идут первыми.
+    С полным fanout (-1) выход GCN с len(fanouts) слоями для целей совпадает с полным графом.
+    """
+
+    def __init__(self, edge_index, num_nodes, fanouts, edge_weight=None, normalize=False, rescale=True, seed=0):
+        """
+        :param edge_index: рёбра (2, E) источник -> приёмник, как в propagate
+        :param num_nodes: число вершин графа
+        :param fanouts: число входящих рёбер на вершину для каждого хопа (-1 - все), по числу GCN-слоёв
+        :param edge_weight: веса рёбер (None - единичные)
+        :param normalize: нормировка D^-1/2 (A + I) D^-1/2 по всему графу, как GCN_CONV(normalize=True)
+        :param rescale: при выборке k из d рёбер веса умножаются на d / k (несмещённая оценка суммы)
+        :param seed: зерно выборок; пачка определяется (seed, эпоха, номер пачки)
+        """
+        if normalize:
+            edge_index, edge_weight = gcn_norm(edge_index, edge_weight, num_nodes, add_self_loops=True)
+        source, target = (part.cpu().numpy() for part in edge_index)
+        weight = np.ones(len(source), dtype=np.float32) if edge_weight is None else \
+            edge_weight.detach().cpu().numpy().astype(np.float32)
+
+        # Входящие рёбра по приёмникам (CSR)
+        order = np.argsort(target, kind='stable')
+        self.source = source[order]
+        self.weight = weight[order]
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(target, minlength=num_nodes))])
+        self.num_nodes = num_nodes
+        self.fanouts = list(fanouts)
+        self.rescale = rescale
+        self.seed = seed
+
+    def sample(self, targets, rng):
+        """
+        :param targets: индексы вершин-целей
+        :param rng: numpy Generator
+        :return: Subgraph с локальной нумерацией (цели - 0..len(targets)-1)
+        """
+        targets = np.asarray(targets, dtype=np.int64)
+        frontier, seen = targets, targets
+        edge_source, edge_target, edge_weight = [], [], []
+        for fanout in self.fanouts:
+            start, degree = self.indptr[frontier], np.diff(self.indptr)[frontier]
+            group = np.repeat(np.arange(len(frontier)), degree)
+            edges = np.arange(len(group)) - np.repeat(np.cumsum(degree) - degree, degree) + np.repeat(start, degree)
+            scale = np.ones(len(edges), dtype=np.float32)
+            if fanout >= 0:
+                # Случайный порядок рёбер внутри каждой вершины, берутся первые fanout соседей;
+                # петля (своя вершина, например из gcn_norm) не сосед и остаётся всегда
+                loop = self.source[edges] == frontier[group]
+                order = np.lexsort((rng.random(len(edges)), ~loop, group))
+                edges, group, loop = edges[order], group[order], loop[order]
+                loops = np.bincount(group[loop], minlength=len(frontier))
+                rank = np.arange(len(group)) - np.repeat(np.cumsum(degree) - degree, degree) - loops[group]
+                keep = loop | (rank < fanout)
+                if self.rescale:
+                    neighbours = (degree - loops)[group]
+                    scale = np.where(loop, 1.0, np.maximum(neighbours / max(fanout, 1), 1.0)).astype(np.float32)[keep]
+                edges, group = edges[keep], group[keep]
+            edge_source.append(self.source[edges])
+            edge_target.append(frontier[group])
+            edge_weight.append(self.weight[edges] * scale)
+            frontier = np.setdiff1d(np.unique(self.source[edges]), seen)
+            seen = np.concatenate([seen, frontier])
+
+        nodes = seen
+        sorter = np.argsort(nodes, kind='stable')
+        source = np.concatenate(edge_source) if edge_source else np.empty(0, dtype=np.int64)
+        target = np.concatenate(edge_target) if edge_target else np.empty(0, dtype=np.int64)
+        local = [sorter[np.searchsorted(nodes, part, sorter=sorter)] for part in (source, target)]
+        return Subgraph(torch.from_numpy(nodes), torch.from_numpy(np.stack(local)),
+                        torch.from_numpy(np.concatenate(edge_weight) if edge_weight else np.empty(0, np.float32)),
+                        len(targets))
+
+    def batches(self, nodes, batch_size, epoch=0):
+        """
+        Пачки целей в случайном порядке и их подграфы (генератор).
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        order = np.random.default_rng([self.seed, epoch]).permutation(nodes)
+        for number, start in enumerate(range(0, len(order), batch_size)):
+            yield self.sample(order[start:start + batch_size], np.random.default_rng([self.seed, epoch, number]))
+
+
+def prefetch(iterable, depth=2):
+    """
+    Итератор, который готовит следующие depth элементов в фоновом потоке.
+    numpy и индексация torch отпускают GIL, поэтому выборка идёт параллельно со счётом модели.
+    """
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Ждём места в очереди, пока потребитель не остановился
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as error:  # ошибка выборки поднимается в основном потоке
+            put(error)
+        put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # Потребитель остановился раньше (break, исключение): отпускаем поток и освобождаем очередь
+        stop.set()
+        while producer.is_alive():
+            try:
+                buffer.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def _steps(inputs, targets, sampler, nodes, node_batch_size, window_batch_size, epoch, seed):
+    # Шаги эпохи: (пачка окон, подграф) -> готовые тензоры подграфа
+    windows = torch.randperm(len(inputs), generator=torch.Generator().manual_seed(seed * 1000003 + epoch))
+    for start in range(0, len(windows), window_batch_size):
+        chosen = windows[start:start + window_batch_size]
+        if sampler is None:
+            yield inputs[chosen], targets[chosen], None
+            continue
+        for subgraph in sampler.batches(nodes, node_batch_size, epoch=epoch * 1000003 + start):
+            yield (inputs[chosen][:, :, subgraph.nodes], targets[chosen][:, :, subgraph.nodes[:subgraph.num_targets]],
+                   subgraph)
+
+
+def train(model, inputs, targets, edge_index, num_nodes, edge_weight=None, fanouts=None, node_batch_size=None,
+          window_batch_size=32, epochs=1, lr=1e-3, normalize=False, nodes=None, seed=0, prefetch_depth=2,
+          verbose=True):
+    """
+    Обучение GCN_LSTM.forward_sequence по окнам: полным графом (node_batch_size=None)
+    или мини-батчами по вершинам с выборкой окрестностей.
+    :param inputs: окна (W, time, N, in_channels), например из sliding_windows
+    :param targets: цели (W, horizon, N, num_features)
+    :param fanouts: fanout на хоп (None - все рёбра); длина - число GCN-слоёв модели
+    :param node_batch_size: число вершин-целей в пачке (None - полный граф)
+    :param normalize: нормировать смежность по всему графу (модель - с normalize=False)
+    :param nodes: вершины, по которым считается ошибка (None - все)
+    :param verbose: печатать ошибку после каждой эпохи
+    :return: список средних ошибок по эпохам
+    """
+    torch.manual_seed(seed)
+    fanouts = [-1] * len(model.layers) if fanouts is None else fanouts
+    nodes = np.arange(num_nodes) if nodes is None else np.asarray(nodes)
+    sampler = None
+    if node_batch_size is not None:
+        sampler = NeighbourSampler(edge_index, num_nodes, fanouts, edge_weight=edge_weight, normalize=normalize,
+                                   seed=seed)
+    elif normalize:
+        edge_index, edge_weight = gcn_norm(edge_index, edge_weight, num_nodes, add_self_loops=True)
+    full_nodes = None if len(nodes) == num_nodes else torch.as_tensor(nodes)
+
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    history = []
+    model.train()
+    for epoch in range(epochs):
+        total, count = 0.0, 0
+        steps = _steps(inputs, targets, sampler, nodes, node_batch_size, window_batch_size, epoch, seed)
+        for x, y, subgraph in prefetch(steps, depth=prefetch_depth):
+            optimizer.zero_grad()
+            if subgraph is None:
+                out = model.forward_sequence(x, edge_index, edge_weight, nodes=full_nodes)
+                if full_nodes is not None:
+                    y = y[:, :, full_nodes]
+            else:
+                out = model.forward_sequence(x, subgraph.edge_index, subgraph.edge_weight,
+                                             nodes=torch.arange(subgraph.num_targets))
+            loss = F.mse_loss(out, y)
+            loss.backward()
+            optimizer.step()
+            total += loss.item() * y.numel()
+            count += y.numel()
+        history.append(total / max(count, 1))
+        if verbose:
+            print(f"epoch {epoch}: loss {history[-1]:.6f}")
+    return history
+
+
+@torch.no_grad()
+def predict_minibatch(model, inputs, edge_index, num_nodes, edge_weight=None, node_batch_size=1024,
+                      window_batch_size=32, normalize=False, seed=0):
+    """
+    Прогноз по всем вершинам пачками с полными окрестностями (без выборки рёбер).
+    :return: (W, horizon, N, num_features)
+    """
+    model.eval()
+    sampler = NeighbourSampler(edge_index, num_nodes, [-1] * len(model.layers), edge_weight=edge_weight,
+                               normalize=normalize, seed=seed)
+    result = None
+    for start in range(0, len(inputs), window_batch_size):
+        x = inputs[start:start + window_batch_size]
+        for subgraph in sampler.batches(np.arange(num_nodes), node_batch_size):
+            out = model.forward_sequence(x[:, :, subgraph.nodes], subgraph.edge_index, subgraph.edge_weight,
+                                         nodes=torch.arange(subgraph.num_targets))
+            if result is None:
+                result = torch.empty(len(inputs), out.size(1), num_nodes, out.size(-1))
+            result[start:start + len(x), :, subgraph.nodes[:subgraph.num_targets]] = out
+    return result
+
+
+def parity_check(size=8, steps=240, window=12, horizon=2, hidden_channels=16, epochs=5, node_batch_size=16,
+                 fanouts=(4, 4), seed=0, tolerance=1e-5, mse_factor=1.5):
+    """
+    Проверка на малом графе (решётка size x size, синтетическая диффузия по рёбрам):
+    1) прогноз пачками с полными окрестностями совпадает с прогнозом полным графом (разница меньше tolerance);
+    2) ошибка на отложенных окнах после обучения мини-батчами (с fanout) не больше mse_factor ошибки полного графа.
+    При нарушении любого условия - AssertionError.
+    :return: словарь с расхождением прогнозов и ошибками обеих моделей
+    """
+    generator = torch.Generator().manual_seed(seed)
+    num_nodes = size * size
+    node = torch.arange(num_nodes).view(size, size)
+    pairs = torch.cat([torch.stack([node[:, :-1].flatten(), node[:, 1:].flatten()]),
+                       torch.stack([node[:-1].flatten(), node[1:].flatten()])], dim=1)
+    edge_index = torch.cat([pairs, pairs.flip(0)], dim=1)
+
+    # Диффузия с шумом: значение вершины тянется к среднему соседей
+    degree = torch.bincount(edge_index[1], minlength=num_nodes).float()
+    series = torch.zeros(steps, num_nodes, 1)
+    state = torch.rand(num_nodes, generator=generator)
+    for t in range(steps):
+        neighbours = torch.zeros(num_nodes).index_add_(0, edge_index[1], state[edge_index[0]]) / degree
+        state = 0.6 * neighbours + 0.3 * state + 0.1 * torch.rand(num_nodes, generator=generator)
+        series[t, :, 0] = state
+    inputs, targets = sliding_windows(series, window, horizon)
+    split = int(0.8 * len(inputs))
+
+    torch.manual_seed(seed)
+    full = GCN_LSTM(in_channels=1, hidden_channels=hidden_channels, num_gcn_layers=len(fanouts) + 1,
+                    num_rnn_layers=1, num_features=1, horizon=horizon)
+    sampled = copy.deepcopy(full)
+
+    full.eval()
+    with torch.no_grad():
+        expected = full.forward_sequence(inputs[split:], *gcn_norm(edge_index, None, num_nodes))
+    got = predict_minibatch(full, inputs[split:], edge_index, num_nodes, node_batch_size=node_batch_size,
+                            normalize=True)
+    forward_difference = (expected - got).abs().max().item()
+
+    # Одинаковое число шагов оптимизатора: полный граф - пачками окон поменьше
+    window_batch_size = 32
+    train(full, inputs[:split], targets[:split], edge_index, num_nodes, epochs=epochs, normalize=True, seed=seed,
+          window_batch_size=max(1, window_batch_size * node_batch_size // num_nodes), verbose=False)
+    train(sampled, inputs[:split], targets[:split], edge_index, num_nodes, fanouts=list(fanouts),
+          node_batch_size=node_batch_size, window_batch_size=window_batch_size, epochs=epochs, normalize=True,
+          seed=seed, verbose=False)
+    errors = {}
+    for name, model in (('full', full), ('minibatch', sampled)):
+        prediction = predict_minibatch(model, inputs[split:], edge_index, num_nodes, node_batch_size=node_batch_size,
+                                       normalize=True)
+        errors[name] = F.mse_loss(prediction, targets[split:]).item()
+
+    result = {'forward_difference': forward_difference, 'full_mse': errors['full'],
+              'minibatch_mse': errors['minibatch']}
+    assert forward_difference < tolerance, f"Mini-batch forward differs from full graph by {forward_difference}"
+    assert errors['minibatch'] <= mse_factor * errors['full'], \
+        f"Mini-batch MSE {errors['minibatch']} is above {mse_factor} x full-graph MSE {errors['full']}"
+    return result
+
+
+if __name__ == '__main__':
+    print(parity_check())
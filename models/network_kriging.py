@@ -0,0 +1,461 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from models.local_kriging import VARIOGRAM_MODELS, LocalKriging, fit_variogram, fit_variogram_model
+from utils.compact_graph import CompactGraph
+from utils.detour_index import network_matrix
+from utils.snapping import NodeIndex
+
+'''
+Кригинг по сети дорог: вариограмма и веса строятся по длине кратчайшего пути, а не по прямой,
+поэтому наблюдения за рекой или железной дорогой не влияют на прогноз, пока до них далеко по сети.
+
+Расстояния между точками (наблюдения и точки прогноза) считаются один раз: Дейкстра из каждой
+точки останавливается на cutoff, результат - разреженная матрица, которая сохраняется на диск
+и переиспользуется всеми прогнозами. Пары дальше cutoff в матрицу не попадают: вариограмма
+подбирается по лагам до cutoff, поэтому её ранг не больше cutoff, и для них берётся gamma(cutoff).
+
+Сравнение с плоским кригингом на синтетическом городе: python -m models.network_kriging
+'''
+
+TINY = np.finfo(np.float64).tiny
+
+
+def network_arrays(G, weight='length', xy=None):
+    """
+    Матрица смежности и метрические координаты вершин графа.
+    :param G: CompactGraph, NetworkXView или networkx-граф дорожной сети
+    :param xy: координаты вершин в метрах (None - проекция UTM по центру графа)
+    :return: (матрица смежности, xy (N, 2), ключи вершин или None)
+    """
+    graph, keys, matrix = network_matrix(G, weight=weight)
+    if xy is None:
+        xy = NodeIndex.from_graph(graph, node_type=None).xy
+    return matrix, np.asarray(xy, dtype=np.float64), keys
+
+
+def split_edges(matrix, xy, u, v):
+    """
+    Добавляет вершину в середину каждого ребра (u, v) - туда ставятся наблюдения трафика на участках.
+    Исходные рёбра остаются, расстояния между старыми вершинами не меняются.
+    :param u, v: индексы концов рёбер
+    :return: (новая матрица, новые xy, индексы вершин-середин)
+    """
+    u, v = np.asarray(u, dtype=np.int64), np.asarray(v, dtype=np.int64)
+    n, m = matrix.shape[0], len(u)
+    half = np.asarray(matrix[u, v]).ravel() / 2
+    if (half <= 0).any():
+        raise ValueError("Some of the edges to split are not in the graph.")
+    middle = np.arange(n, n + m)
+    rows = np.concatenate([u, middle, v, middle])
+    cols = np.concatenate([middle, u, middle, v])
+    extra = sparse.csr_matrix((np.tile(half, 4), (rows, cols)), shape=(n + m, n + m))
+    matrix = sparse.bmat([[matrix, None], [None, sparse.csr_matrix((m, m))]], format='csr') + extra
+    return matrix, np.concatenate([xy, (xy[u] + xy[v]) / 2]), middle
+
+
+def _init_worker(state):
+    # Матрица и дерево передаются в каждый процесс один раз
+    global _worker_state
+    _worker_state = state
+
+
+def _chunk_distances(state, chunk):
+    # Расстояния от вершин чанка до всех вершин-точек в пределах cutoff: (строки, столбцы, длины)
+    nodes, cutoff = state['nodes'], state['cutoff']
+    sources = nodes[chunk]
+    if state['tree'] is not None:
+        # Путь не длиннее cutoff не выходит из круга радиуса cutoff: Дейкстра по подграфу вокруг чанка
+        xy = state['xy']
+        low, high = xy[sources].min(axis=0), xy[sources].max(axis=0)
+        local = np.sort(np.asarray(state['tree'].query_ball_point((low + high) / 2,
+                                                                  np.linalg.norm(high - low) / 2 + cutoff),
+                                   dtype=np.int64))
+        matrix = state['matrix'][local][:, local]
+    else:
+        local = np.arange(state['matrix'].shape[0])
+        matrix = state['matrix']
+    distance = dijkstra(matrix, directed=False, indices=np.searchsorted(local, sources), limit=cutoff)
+
+    position = state['position'][local]
+    columns = np.flatnonzero(position >= 0)
+    block = distance[:, columns]
+    row, column = np.nonzero(np.isfinite(block))
+    # Нулевые длины (совпадающие точки) sparse считает отсутствием пары
+    return chunk[row], position[columns[column]], np.maximum(block[row, column], TINY)
+
+
+def _run_chunk(chunk):
+    return _chunk_distances(_worker_state, chunk)
+
+
+def _digest(*arrays):
+    digest = hashlib.sha1()
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+class NetworkDistances:
+    """
+    Разреженная матрица длин кратчайших путей между точками (вершинами графа), обрезанная на cutoff.
+    Отсутствующая пара - путь длиннее cutoff или его нет.
+    """
+
+    def __init__(self, distance, sites, cutoff, key=None):
+        """
+        :param distance: матрица (S, S) длин путей; совпадающие точки хранятся как TINY
+        :param sites: вершины графа, соответствующие точкам
+        :param cutoff: предел длины пути, м
+        :param key: хэш графа и точек, по которому проверяется кэш
+        """
+        self.distance = sparse.csr_matrix(distance)
+        self.distance.sort_indices()
+        self.sites = np.asarray(sites, dtype=np.int64)
+        self.cutoff = float(cutoff)
+        self.key = key
+
+    @staticmethod
+    def key_of(matrix, sites, cutoff):
+        return _digest(matrix.indptr, matrix.indices, matrix.data, np.asarray(sites, dtype=np.int64),
+                       np.float64(cutoff))
+
+    @classmethod
+    def build(cls, matrix, xy, sites, cutoff, local=True, chunk_size=256, workers=1):
+        """
+        :param matrix: матрица смежности графа (веса - длины рёбер, м)
+        :param xy: метрические координаты вершин графа
+        :param sites: вершины-точки (наблюдения и точки прогноза, повторы допустимы)
+        :param cutoff: предел длины пути, м
+        :param local: Дейкстра по подграфу вокруг чанка; верно, только если ребро не короче
+            расстояния по прямой между его концами (для длин в метрах - всегда)
+        :param chunk_size: число вершин-источников в чанке
+        :param workers: число процессов (1 - без пула, None - по числу ядер)
+        """
+        from utils.detour_surface import plan_chunks
+
+        matrix = sparse.csr_matrix(matrix)
+        sites = np.asarray(sites, dtype=np.int64)
+        # Дейкстра - по одному разу из каждой различной вершины, точки получают строки своих вершин
+        nodes, inverse = np.unique(sites, return_inverse=True)
+        position = np.full(matrix.shape[0], -1, dtype=np.int64)
+        position[nodes] = np.arange(len(nodes))
+        state = {'matrix': matrix, 'xy': xy, 'nodes': nodes, 'position': position, 'cutoff': cutoff,
+                 'tree': cKDTree(xy) if local else None}
+        chunks = plan_chunks(np.asarray(xy)[nodes], np.arange(len(nodes)), cutoff, chunk_size)
+
+        workers = workers or os.cpu_count()
+        if workers == 1 or len(chunks) < 2:
+            results = [_chunk_distances(state, chunk) for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(state,)) as pool:
+                results = list(pool.map(_run_chunk, chunks))
+
+        rows, cols, data = (np.concatenate(parts) for parts in zip(*results))
+        between_nodes = sparse.csr_matrix((data, (rows, cols)), shape=(len(nodes), len(nodes)))
+        expand = sparse.csr_matrix((np.ones(len(sites)), (np.arange(len(sites)), inverse)),
+                                   shape=(len(sites), len(nodes)))
+        return cls(expand @ between_nodes @ expand.T, sites, cutoff, key=cls.key_of(matrix, sites, cutoff))
+
+    # --- хранение ---
+
+    def save(self, directory):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        sparse.save_npz(directory / 'distance.npz', self.distance)
+        np.save(directory / 'sites.npy', self.sites)
+        (directory / 'meta.json').write_text(json.dumps({'cutoff': self.cutoff, 'key': self.key}))
+
+    @classmethod
+    def load(cls, directory):
+        directory = Path(directory)
+        meta = json.loads((directory / 'meta.json').read_text())
+        return cls(sparse.load_npz(directory / 'distance.npz'), np.load(directory / 'sites.npy'),
+                   meta['cutoff'], key=meta['key'])
+
+    @classmethod
+    def cached(cls, directory, matrix, xy, sites, cutoff, **kwargs):
+        """
+        Матрица из кэша, если он построен для того же графа, точек и cutoff; иначе build и save.
+        """
+        directory = Path(directory)
+        if (directory / 'meta.json').exists():
+            meta = json.loads((directory / 'meta.json').read_text())
+            if meta['key'] == cls.key_of(sparse.csr_matrix(matrix), sites, cutoff):
+                return cls.load(directory)
+        distances = cls.build(matrix, xy, sites, cutoff, **kwargs)
+        distances.save(directory)
+        return distances
+
+    # --- запросы ---
+
+    def between(self, rows, cols):
+        """
+        Длины путей для пар точек (массивы одинаковой формы); inf для пар дальше cutoff.
+        """
+        return _lookup(self.distance, _pair_keys(self.distance), rows, cols)
+
+
+def _pair_keys(matrix):
+    # Упорядоченные ключи row * S + col ненулевых элементов CSR с отсортированными индексами
+    rows = np.repeat(np.arange(matrix.shape[0], dtype=np.int64), np.diff(matrix.indptr))
+    return rows * matrix.shape[1] + matrix.indices
+
+
+def _lookup(matrix, keys, rows, cols):
+    query = np.asarray(rows, dtype=np.int64) * matrix.shape[1] + np.asarray(cols, dtype=np.int64)
+    found = np.minimum(np.searchsorted(keys, query), max(len(keys) - 1, 0))
+    if not len(keys):
+        return np.full(query.shape, np.inf)
+    return np.where(keys[found] == query, matrix.data[found], np.inf)
+
+
+def _nearest(rows, k):
+    # k ближайших столбцов в каждой строке CSR: (расстояния, столбцы) формы (B, k), дополненные inf и -1
+    row = np.repeat(np.arange(rows.shape[0]), np.diff(rows.indptr))
+    order = np.lexsort((rows.data, row))
+    row, column, value = row[order], rows.indices[order], rows.data[order]
+    rank = np.arange(len(row)) - rows.indptr[row]
+    keep = rank < k
+    distance = np.full((rows.shape[0], k), np.inf)
+    neighbours = np.full((rows.shape[0], k), -1, dtype=np.int64)
+    distance[row[keep], rank[keep]] = value[keep]
+    neighbours[row[keep], rank[keep]] = column[keep]
+    return distance, neighbours
+
+
+def fit_network_variogram(distances, observed, z, variogram_model='exponential', nlags=12):
+    """
+    Параметры вариограммы по парам наблюдений ближе cutoff (подбор по эмпирической вариограмме, как в pykrige).
+    :param observed: точки-наблюдения (позиции в distances)
+    :return: список параметров в формате pykrige
+    """
+    z = np.asarray(z, dtype=np.float64)
+    pairs = sparse.triu(distances.distance[observed][:, observed], k=1).tocoo()
+    lag = np.minimum((pairs.data / distances.cutoff * nlags).astype(np.int64), nlags - 1)
+    count = np.bincount(lag, minlength=nlags)
+    filled = count > 0
+    lags = np.bincount(lag, weights=pairs.data, minlength=nlags)[filled] / count[filled]
+    semivariance = np.bincount(lag, weights=0.5 * (z[pairs.row] - z[pairs.col]) ** 2,
+                               minlength=nlags)[filled] / count[filled]
+    return fit_variogram_model(lags, semivariance, variogram_model)
+
+
+class NetworkKriging:
+    """
+    Обычный кригинг в скользящем окне по сетевым расстояниям: окно - k ближайших по сети наблюдений,
+    матрица системы - вариограмма от длин путей из NetworkDistances, как в LocalKriging.
+
+    Вариограммы, допустимые на плоскости, на графе не всегда дают положительно определённую матрицу;
+    безопасный выбор - экспоненциальная модель.
+    """
+
+    def __init__(self, distances, observed, z, variogram_model='exponential', variogram_parameters=None,
+                 n_neighbours=32, nlags=12):
+        """
+        :param distances: NetworkDistances по наблюдениям и точкам прогноза
+        :param observed: позиции наблюдений в distances
+        :param z: значения наблюдений
+        :param variogram_parameters: параметры модели; None - подбор по сетевым расстояниям
+        :param n_neighbours: число ближайших по сети наблюдений в окне
+        """
+        self.distances = distances
+        self.observed = np.asarray(observed, dtype=np.int64)
+        self.z = np.asarray(z, dtype=np.float64)
+        self.variogram_model = variogram_model
+        self.variogram_function = VARIOGRAM_MODELS[variogram_model]
+        if variogram_parameters is None:
+            variogram_parameters = fit_network_variogram(distances, self.observed, self.z, variogram_model,
+                                                         nlags=nlags)
+        self.variogram_parameters = list(variogram_parameters)
+        self.n_neighbours = min(n_neighbours, len(self.z))
+        # Строки точек по столбцам-наблюдениям и пары наблюдений для матриц систем
+        self.to_observed = distances.distance[:, self.observed].tocsr()
+        self.to_observed.sort_indices()
+        self.between_observed = self.to_observed[self.observed].tocsr()
+        self.between_observed.sort_indices()
+        self.pair_keys = _pair_keys(self.between_observed)
+        self.eps = 1e-10
+
+    def _variogram(self, distance):
+        # Пары дальше cutoff (inf) получают значение вариограммы на cutoff
+        return self.variogram_function(self.variogram_parameters, np.minimum(distance, self.distances.cutoff))
+
+    def _weights_chunk(self, sites):
+        # Веса кригинга (M, k + 1), наблюдения окна (M, k), правая часть, пустые места окна и точки без окна
+        sites = np.asarray(sites, dtype=np.int64)
+        k = self.n_neighbours
+        distance, neighbours = _nearest(self.to_observed[sites], k)
+        pad = neighbours < 0
+        neighbours = np.where(pad, 0, neighbours)
+        empty = pad.all(axis=1)
+
+        pairwise = _lookup(self.between_observed, self.pair_keys, neighbours[:, :, None], neighbours[:, None, :])
+        a = np.zeros((len(sites), k + 1, k + 1))
+        a[:, :k, :k] = -self._variogram(pairwise)
+        a[:, np.arange(k), np.arange(k)] = 0.0
+        a[:, k, :k] = 1.0
+        a[:, :k, k] = 1.0
+        # Пустые места окна (наблюдений в cutoff меньше k) дают уравнения weight = 0
+        a[:, :k, :k][pad[:, :, None] | pad[:, None, :]] = 0.0
+        a[:, :k, :k][pad[:, :, None] & np.eye(k, dtype=bool)] = 1.0
+        a[:, k, :k][pad] = 0.0
+        a[:, :k, k][pad] = 0.0
+        a[empty, k, k] = 1.0
+
+        b = np.ones((len(sites), k + 1))
+        b[:, :k] = -self._variogram(distance)
+        b[:, :k][(distance <= self.eps) | pad] = 0.0
+
+        weights = np.linalg.solve(a, b[:, :, None])[:, :, 0]
+        return weights, neighbours, b, pad, empty
+
+    def predict_chunk(self, sites):
+        """
+        Прогноз и дисперсия кригинга для пачки точек (позиций в distances).
+        Точки без наблюдений ближе cutoff получают NaN.
+        """
+        weights, neighbours, b, pad, empty = self._weights_chunk(sites)
+        values = np.sum(np.where(pad, 0.0, weights[:, :self.n_neighbours] * self.z[neighbours]), axis=1)
+        variance = np.sum(weights * -b, axis=1)
+        values[empty] = np.nan
+        variance[empty] = np.nan
+        return values, variance
+
+    def weight_matrix(self, sites, chunk_size=4096):
+        """
+        Веса кригинга как разреженная матрица (точки, наблюдения) для SensorKriging.
+        :return: (CSR-матрица весов, дисперсии; NaN - нет наблюдений ближе cutoff)
+        """
+        sites = np.asarray(sites, dtype=np.int64)
+        rows, cols, data, variance = [], [], [], []
+        for start in range(0, len(sites), chunk_size):
+            weights, neighbours, b, pad, empty = self._weights_chunk(sites[start:start + chunk_size])
+            row, column = np.nonzero(~pad)
+            rows.append(start + row)
+            cols.append(neighbours[row, column])
+            data.append(weights[row, column])
+            part = np.sum(weights * -b, axis=1)
+            part[empty] = np.nan
+            variance.append(part)
+        if not rows:
+            return sparse.csr_matrix((0, len(self.z))), np.empty(0)
+        matrix = sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                   shape=(len(sites), len(self.z)))
+        return matrix, np.concatenate(variance)
+
+    def predict(self, sites=None, chunk_size=4096):
+        """
+        :param sites: позиции точек прогноза в distances (None - все точки)
+        :return: (значения, дисперсии)
+        """
+        if sites is None:
+            sites = np.arange(self.distances.distance.shape[0])
+        sites = np.asarray(sites, dtype=np.int64)
+        results = [self.predict_chunk(sites[start:start + chunk_size]) for start in range(0, len(sites), chunk_size)]
+        if not results:
+            return np.empty(0), np.empty(0)
+        values, variance = (np.concatenate(parts) for parts in zip(*results))
+        return values, variance
+
+
+# === Сравнение с плоским кригингом на синтетическом городе ===
+
+def synthetic_city(size=60, spacing=100.0, bridges=None, origin=(37.6, 55.75)):
+    """
+    Квадратная сетка улиц size x size с рекой между столбцами size // 2 - 1 и size // 2:
+    поперечные рёбра через реку есть только в строках bridges (по умолчанию два моста).
+    :return: CompactGraph в EPSG:4326 с длинами рёбер в метрах
+    """
+    if bridges is None:
+        bridges = (size // 4, 3 * size // 4)
+    row, column = np.divmod(np.arange(size * size), size)
+    # Метры в градусы около origin
+    lon = origin[0] + column * spacing / (111320.0 * np.cos(np.radians(origin[1])))
+    lat = origin[1] + row * spacing / 110540.0
+    node = np.arange(size * size).reshape(size, size)
+    river = size // 2 - 1
+    horizontal = np.ones((size, size - 1), dtype=bool)
+    horizontal[:, river] = False
+    horizontal[list(bridges), river] = True
+    u = np.concatenate([node[:, :-1][horizontal], node[:-1, :].ravel()])
+    v = np.concatenate([node[:, 1:][horizontal], node[1:, :].ravel()])
+    return CompactGraph(np.column_stack([lon, lat]), u, v, length=spacing)
+
+
+def benchmark(size=60, spacing=100.0, observed_share=0.3, cutoff=1500.0, n_neighbours=16, scale=800.0,
+              noise=1.0, cache=None, naive=True, workers=1, seed=0):
+    """
+    Ошибка и время плоского и сетевого кригинга на synthetic_city.
+    Трафик затухает с расстоянием по сети от точки у реки, поэтому на другом берегу он мал,
+    хотя по прямой точка близко. Наблюдения - случайная доля вершин, проверка - остальные вершины.
+    :param cache: каталог кэша матрицы расстояний (None - без кэша)
+    :param naive: замерить также полную матрицу расстояний без обрезки и без подграфов
+    :return: DataFrame: method, distances_seconds, predict_seconds, rmse
+    """
+    rng = np.random.default_rng(seed)
+    graph = synthetic_city(size, spacing)
+    matrix, xy, _ = network_arrays(graph)
+    hotspot = (size // 2) * size + size // 2 - 2
+    truth = 100 * np.exp(-dijkstra(matrix, directed=False, indices=hotspot) / scale)
+    values = truth + rng.normal(0, noise, len(truth))
+
+    nodes = rng.permutation(len(truth))
+    observed_nodes = np.sort(nodes[:int(observed_share * len(nodes))])
+    test_nodes = np.sort(nodes[len(observed_nodes):])
+    sites = np.concatenate([observed_nodes, test_nodes])
+    observed = np.arange(len(observed_nodes))
+    test = np.arange(len(observed_nodes), len(sites))
+    rows = []
+
+    start = time.perf_counter()
+    planar = LocalKriging(xy[observed_nodes, 0], xy[observed_nodes, 1], values[observed_nodes],
+                          variogram_model='exponential', n_neighbours=n_neighbours,
+                          variogram_parameters=fit_variogram(xy[observed_nodes, 0], xy[observed_nodes, 1],
+                                                             values[observed_nodes], 'exponential', seed=seed))
+    prediction, _ = planar.predict(xy[test_nodes, 0], xy[test_nodes, 1])
+    rows.append({'method': 'planar', 'distances_seconds': 0.0, 'predict_seconds': time.perf_counter() - start,
+                 'rmse': np.sqrt(np.nanmean((prediction - truth[test_nodes]) ** 2))})
+
+    start = time.perf_counter()
+    if cache is None:
+        distances = NetworkDistances.build(matrix, xy, sites, cutoff, workers=workers)
+    else:
+        distances = NetworkDistances.cached(cache, matrix, xy, sites, cutoff, workers=workers)
+    built = time.perf_counter() - start
+    start = time.perf_counter()
+    model = NetworkKriging(distances, observed, values[observed_nodes], n_neighbours=n_neighbours)
+    prediction, _ = model.predict(test)
+    rows.append({'method': 'network', 'distances_seconds': built, 'predict_seconds': time.perf_counter() - start,
+                 'rmse': np.sqrt(np.nanmean((prediction - truth[test_nodes]) ** 2))})
+
+    if cache is not None:
+        start = time.perf_counter()
+        NetworkDistances.cached(cache, matrix, xy, sites, cutoff)
+        rows.append({'method': 'network (cached distances)', 'distances_seconds': time.perf_counter() - start,
+                     'predict_seconds': rows[-1]['predict_seconds'], 'rmse': rows[-1]['rmse']})
+
+    if naive:
+        # Полные расстояния между всеми точками: Дейкстра по всему графу без предела
+        start = time.perf_counter()
+        dijkstra(matrix, directed=False, indices=sites)[:, sites]
+        rows.append({'method': 'network (full matrix)', 'distances_seconds': time.perf_counter() - start,
+                     'predict_seconds': np.nan, 'rmse': np.nan})
+
+    result = pd.DataFrame(rows)
+    print(result.to_string(index=False))
+    return result
+
+
+if __name__ == '__main__':
+    benchmark(cache='cache/network_kriging_benchmark')
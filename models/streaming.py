@@ -0,0 +1,144 @@
+import time
+from pathlib import Path
+
+import torch
+
+'''
+Потоковый прогноз GCN_LSTM: на каждый новый срез наблюдений (nodes, features) модель делает
+один шаг - GCN по одному снимку и один шаг LSTM из сохранённого состояния (h, c) каждой вершины,
+без повторного прохода по всему окну истории.
+
+Внимание и Max Pooling в GCN_LSTM смотрят на выходы LSTM за окно, поэтому последние window
+выходов хранятся в буфере; после window шагов с нулевого состояния прогноз совпадает
+с forward_sequence по тем же window срезам. Дальше LSTM продолжает состояние, а не начинает окно заново.
+Состояние сохраняется в файл и восстанавливается после перезапуска сервиса.
+'''
+
+
+class StreamingForecaster:
+    """
+    Состояние потока для всей сети: (h, c) LSTM (layers, nodes, hidden) и буфер выходов (nodes, window, hidden).
+    """
+
+    def __init__(self, model, edge_index, num_nodes, edge_weight=None, window=12):
+        """
+        :param model: обученный GCN_LSTM (переводится в eval)
+        :param edge_index: рёбра графа, остаются в памяти между вызовами
+        :param num_nodes: число вершин
+        :param window: число последних выходов LSTM для внимания (длина окна при обучении)
+        """
+        self.model = model.eval()
+        self.edge_index = edge_index
+        self.edge_weight = edge_weight
+        self.num_nodes = num_nodes
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        lstm = self.model.lstm
+        shape = (lstm.num_layers, self.num_nodes, lstm.hidden_size)
+        self.hidden = torch.zeros(shape)
+        self.cell = torch.zeros(shape)
+        self.outputs = torch.zeros(self.num_nodes, self.window, lstm.hidden_size)
+        self.filled = 0
+        self.steps = 0
+
+    @torch.inference_mode()
+    def step(self, observation):
+        """
+        Продвигает состояние на один срез и возвращает обновлённый прогноз.
+        :param observation: новый срез (nodes, in_channels)
+        :return: прогноз (horizon, nodes, num_features)
+        """
+        x = torch.as_tensor(observation, dtype=torch.float32)
+        x = self.model.spatial(x, self.edge_index, self.edge_weight)
+        output, (self.hidden, self.cell) = self.model.lstm(x.unsqueeze(1), (self.hidden, self.cell))
+
+        # Буфер последних window выходов: окно короткое, сдвиг - одна копия
+        self.outputs = torch.cat([self.outputs[:, 1:], output], dim=1)
+        self.filled = min(self.filled + 1, self.window)
+        self.steps += 1
+        return self.model.readout(self.outputs[:, self.window - self.filled:], 1, self.num_nodes)[0]
+
+    def warm_up(self, history):
+        """
+        Прогон истории (time, nodes, in_channels) по шагам, например после reset без сохранённого состояния.
+        :return: прогноз после последнего среза
+        """
+        forecast = None
+        for observation in history:
+            forecast = self.step(observation)
+        return forecast
+
+    # --- сохранение состояния ---
+
+    def state_dict(self):
+        return {'hidden': self.hidden.clone(), 'cell': self.cell.clone(), 'outputs': self.outputs.clone(),
+                'filled': self.filled, 'steps': self.steps, 'window': self.window, 'num_nodes': self.num_nodes}
+
+    def load_state_dict(self, state):
+        if state['num_nodes'] != self.num_nodes or state['window'] != self.window:
+            raise ValueError("Saved stream state was built for a different graph or window.")
+        self.hidden, self.cell, self.outputs = state['hidden'], state['cell'], state['outputs']
+        self.filled, self.steps = state['filled'], state['steps']
+
+    def snapshot(self, path):
+        """
+        Сохраняет состояние потока атомарно (временный файл и переименование).
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(path.suffix + '.tmp')
+        torch.save(self.state_dict(), tmp)
+        tmp.replace(path)
+
+    def restore(self, path):
+        self.load_state_dict(torch.load(path, weights_only=True))
+
+
+def streaming_check(num_nodes=500, num_edges=2000, window=12, steps=40, features=3, hidden_channels=32, seed=0):
+    """
+    Сверка с forward_sequence (первые window шагов), проверка snapshot/restore и время шага
+    против пересчёта окна целиком.
+    :return: словарь с расхождениями и временем, мс
+    """
+    from models.GCN_LSTM import GCN_LSTM
+
+    torch.manual_seed(seed)
+    edge_index = torch.randint(0, num_nodes, (2, num_edges))
+    edge_weight = torch.rand(num_edges)
+    model = GCN_LSTM(in_channels=features, hidden_channels=hidden_channels, num_features=features, horizon=3,
+                     normalize=True, cached=True).eval()
+    series = torch.randn(steps, num_nodes, features)
+
+    stream = StreamingForecaster(model, edge_index, num_nodes, edge_weight=edge_weight, window=window)
+    forecast = stream.warm_up(series[:window])
+    with torch.inference_mode():
+        expected = model.forward_sequence(series[None, :window], edge_index, edge_weight)[0]
+    window_difference = (forecast - expected).abs().max().item()
+
+    # Состояние после половины потока сохраняется, поток продолжается, затем восстанавливается
+    path = Path('cache/streaming_check/state.pt')
+    stream.warm_up(series[window:steps // 2])
+    stream.snapshot(path)
+    continued = stream.warm_up(series[steps // 2:])
+    restored = StreamingForecaster(model, edge_index, num_nodes, edge_weight=edge_weight, window=window)
+    restored.restore(path)
+    restore_difference = (restored.warm_up(series[steps // 2:]) - continued).abs().max().item()
+
+    start = time.perf_counter()
+    stream.step(series[-1])
+    step_ms = 1000 * (time.perf_counter() - start)
+    start = time.perf_counter()
+    with torch.inference_mode():
+        model.forward_sequence(series[None, -window:], edge_index, edge_weight)
+    window_ms = 1000 * (time.perf_counter() - start)
+
+    result = {'window_difference': window_difference, 'restore_difference': restore_difference,
+              'step_ms': step_ms, 'full_window_ms': window_ms}
+    print(result)
+    return result
+
+
+if __name__ == '__main__':
+    streaming_check()
@@ -0,0 +1,282 @@
+import os
+import time
+import warnings
+from pathlib import Path
+
+import torch
+import torch.nn.functional as F
+from torch_geometric.nn.conv.gcn_conv import gcn_norm
+
+from models.neighbour_sampling import prefetch
+
+'''
+Обучение GCN_LSTM.forward_sequence полным графом по окнам снимков: загрузка пачек окон
+в фоновом потоке, функция потерь, метрики по шагам горизонта, сохранение и продолжение обучения.
+
+Ускорения включаются по отдельности и сравниваются в benchmark_configurations:
+    compile - torch.compile прямого прохода (первый шаг - компиляция, десятки секунд);
+    bf16 - autocast в bfloat16 на CPU (матрицы Linear/LSTM в bf16, потери и оптимизатор в float32);
+    checkpoint_activations - активации GCN-слоёв пересчитываются при backward, а не хранятся;
+    threads / interop_threads - число потоков внутри и между операциями torch.
+
+Запуск сравнения: python -m models.trainer
+'''
+
+LOSSES = {'mse': F.mse_loss, 'mae': F.l1_loss, 'huber': F.huber_loss}
+
+
+def horizon_metrics(prediction, target):
+    """
+    MAE и RMSE по каждому шагу прогноза.
+    :param prediction: прогноз (W, horizon, nodes, features)
+    :param target: истинные значения той же формы
+    :return: словарь {'mae': [...], 'rmse': [...]} длины horizon и средние 'mae_mean', 'rmse_mean'
+    """
+    error = (prediction.float() - target.float()).transpose(0, 1).reshape(target.size(1), -1)
+    mae = error.abs().mean(dim=1)
+    rmse = error.square().mean(dim=1).sqrt()
+    return {'mae': mae.tolist(), 'rmse': rmse.tolist(),
+            'mae_mean': mae.mean().item(), 'rmse_mean': error.square().mean().sqrt().item()}
+
+
+def set_threads(threads=None, interop_threads=None):
+    """
+    Число потоков torch. Между операциями число потоков можно задать только до первой
+    параллельной операции процесса; позже настройка пропускается с предупреждением.
+    """
+    if threads is not None:
+        torch.set_num_threads(threads)
+    if interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            warnings.warn(f"interop threads stay at {torch.get_num_interop_threads()}: already in use",
+                          RuntimeWarning, stacklevel=2)
+
+
+class Trainer:
+    """
+    Обучение модели с фиксированным графом; окна перемешиваются по (seed, эпоха), поэтому
+    после load_checkpoint обучение продолжается с той же пачки, на которой остановилось.
+    """
+
+    def __init__(self, model, edge_index, num_nodes, edge_weight=None, lr=1e-3, loss='mse', normalize=False,
+                 compile=False, bf16=False, checkpoint_activations=False, threads=None, interop_threads=None,
+                 grad_clip=None, checkpoint_path=None, checkpoint_every=None, verbose=True):
+        """
+        :param model: GCN_LSTM
+        :param edge_index: рёбра графа (2, E)
+        :param num_nodes: число вершин
+        :param edge_weight: веса рёбер (None - единичные)
+        :param loss: 'mse', 'mae' или 'huber'
+        :param normalize: нормировать смежность один раз здесь (модель - с normalize=False)
+        :param compile: torch.compile для forward_sequence
+        :param bf16: autocast в bfloat16 на CPU
+        :param checkpoint_activations: пересчёт активаций GCN-слоёв при backward
+        :param threads: число потоков внутри операций (None - по умолчанию torch)
+        :param interop_threads: число потоков между операциями
+        :param grad_clip: ограничение нормы градиента (None - без ограничения)
+        :param checkpoint_path: файл состояния обучения (None - не сохранять)
+        :param checkpoint_every: сохранять каждые столько пачек (None - только в конце эпохи)
+        :param verbose: печатать итоги эпох и продолжение с сохранённого места
+        """
+        set_threads(threads, interop_threads)
+        if normalize:
+            edge_index, edge_weight = gcn_norm(edge_index, edge_weight, num_nodes, add_self_loops=True)
+        self.model = model
+        self.edge_index = edge_index
+        self.edge_weight = edge_weight
+        self.num_nodes = num_nodes
+        self.loss = LOSSES[loss]
+        self.bf16 = bf16
+        self.grad_clip = grad_clip
+        self.checkpoint_path = None if checkpoint_path is None else Path(checkpoint_path)
+        self.checkpoint_every = checkpoint_every
+        self.verbose = verbose
+        model.gradient_checkpointing = checkpoint_activations
+        self.forward = torch.compile(model.forward_sequence) if compile else model.forward_sequence
+        self.optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+        self.epoch = 0
+        self.step = 0
+        self.history = []
+
+    def _predict(self, x, forward):
+        with torch.autocast('cpu', dtype=torch.bfloat16, enabled=self.bf16):
+            return forward(x, self.edge_index, self.edge_weight)
+
+    def _batches(self, inputs, targets, batch_size, seed, epoch, skip=0):
+        # Пачки эпохи; индексация окон (копия из view sliding_windows) идёт в фоновом потоке
+        windows = torch.randperm(len(inputs), generator=torch.Generator().manual_seed(seed * 1000003 + epoch))
+        for start in range(skip * batch_size, len(windows), batch_size):
+            chosen = windows[start:start + batch_size]
+            yield inputs[chosen], targets[chosen]
+
+    def fit(self, inputs, targets, epochs=1, batch_size=32, validation=None, seed=0, prefetch_depth=2):
+        """
+        Обучение до epochs эпох (с учётом уже пройденных, если состояние загружено).
+        :param inputs: окна (W, time, N, in_channels), например из sliding_windows
+        :param targets: цели (W, horizon, N, num_features)
+        :param validation: (входы, цели) для метрик после каждой эпохи
+        :param seed: зерно перемешивания окон и dropout
+        :return: история по эпохам: потери, окон в секунду, метрики на валидации
+        """
+        if self.epoch == 0 and self.step == 0:
+            torch.manual_seed(seed)
+        while self.epoch < epochs:
+            self.model.train()
+            total, count, samples = 0.0, 0, 0
+            start = time.perf_counter()
+            batches = self._batches(inputs, targets, batch_size, seed, self.epoch, skip=self.step)
+            for x, y in prefetch(batches, depth=prefetch_depth):
+                self.optimizer.zero_grad()
+                loss = self.loss(self._predict(x, self.forward).float(), y)
+                loss.backward()
+                if self.grad_clip is not None:
+                    torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
+                self.optimizer.step()
+                self.step += 1
+                total += loss.item() * len(x)
+                count += len(x)
+                samples += len(x)
+                if self.checkpoint_every is not None and self.step % self.checkpoint_every == 0:
+                    self.save_checkpoint()
+            elapsed = time.perf_counter() - start
+
+            record = {'epoch': self.epoch, 'loss': total / max(count, 1), 'samples_per_s': samples / elapsed}
+            if validation is not None:
+                record['validation'] = self.evaluate(*validation, batch_size=batch_size)
+            self.history.append(record)
+            if self.verbose:
+                print(f"epoch {self.epoch}: loss {record['loss']:.6f}, {record['samples_per_s']:.1f} samples/s"
+                      + (f", val mae {record['validation']['mae_mean']:.6f}" if validation is not None else ''))
+            self.epoch += 1
+            self.step = 0
+            if self.checkpoint_path is not None:
+                self.save_checkpoint()
+        return self.history
+
+    @torch.no_grad()
+    def predict(self, inputs, batch_size=32):
+        """
+        Прогноз (W, horizon, N, num_features) по пачкам окон.
+        """
+        # Без compile: смена grad_mode перекомпилировала бы граф обучения на каждой валидации
+        self.model.eval()
+        return torch.cat([self._predict(inputs[start:start + batch_size], self.model.forward_sequence).float()
+                          for start in range(0, len(inputs), batch_size)])
+
+    def evaluate(self, inputs, targets, batch_size=32):
+        """
+        Метрики по шагам горизонта (horizon_metrics) на отложенных окнах.
+        """
+        return horizon_metrics(self.predict(inputs, batch_size=batch_size), targets)
+
+    # --- сохранение и продолжение ---
+
+    def state_dict(self):
+        return {'model': self.model.state_dict(), 'optimizer': self.optimizer.state_dict(), 'epoch': self.epoch,
+                'step': self.step, 'history': self.history, 'rng': torch.get_rng_state()}
+
+    def load_state_dict(self, state):
+        self.model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.epoch, self.step, self.history = state['epoch'], state['step'], state['history']
+        torch.set_rng_state(state['rng'])
+
+    def save_checkpoint(self, path=None):
+        """
+        Атомарное сохранение модели, оптимизатора и позиции в эпохе (временный файл и переименование).
+        """
+        path = Path(path or self.checkpoint_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(path.suffix + '.tmp')
+        torch.save(self.state_dict(), tmp)
+        tmp.replace(path)
+
+    def load_checkpoint(self, path=None):
+        """
+        Загружает состояние, если файл есть.
+        :return: True, если обучение продолжится с сохранённого места
+        """
+        path = Path(path or self.checkpoint_path)
+        if not path.exists():
+            return False
+        self.load_state_dict(torch.load(path, weights_only=True))
+        if self.verbose:
+            print(f"resumed from {path}: epoch {self.epoch}, step {self.step}")
+        return True
+
+
+def benchmark_configurations(num_nodes=500, num_edges=2000, steps=200, window=12, horizon=3, features=3,
+                             hidden_channels=32, epochs=2, batch_size=16, directory='cache/trainer_benchmark', seed=0):
+    """
+    Окон в секунду для каждого варианта обучения на случайном графе, проверка продолжения
+    обучения после сохранения. Первая эпоха с compile включает компиляцию, поэтому
+    сравнивается последняя эпоха.
+    :return: список словарей по вариантам
+    """
+    from models.GCN_LSTM import GCN_LSTM, sliding_windows
+
+    torch.manual_seed(seed)
+    edge_index = torch.randint(0, num_nodes, (2, num_edges))
+    edge_weight = torch.rand(num_edges)
+    series = torch.randn(steps, num_nodes, features)
+    inputs, targets = sliding_windows(series, window, horizon)
+    train_inputs, train_targets = inputs[:-batch_size], targets[:-batch_size]
+    validation = (inputs[-batch_size:], targets[-batch_size:])
+
+    def make_trainer(**options):
+        torch.manual_seed(seed)
+        model = GCN_LSTM(in_channels=features, hidden_channels=hidden_channels, num_features=features,
+                         horizon=horizon, normalize=True, cached=True)
+        return Trainer(model, edge_index, num_nodes, edge_weight=edge_weight, **options)
+
+    configurations = {'eager': {}, 'threads': {'threads': os.cpu_count()}, 'bf16': {'bf16': True},
+                      'checkpoint_activations': {'checkpoint_activations': True}, 'compile': {'compile': True},
+                      'compile_bf16': {'compile': True, 'bf16': True}}
+    rows = []
+    for name, options in configurations.items():
+        trainer = make_trainer(**options)
+        history = trainer.fit(train_inputs, train_targets, epochs=epochs, batch_size=batch_size,
+                              validation=validation, seed=seed)
+        row = {'configuration': name, 'samples_per_s': history[-1]['samples_per_s'], 'loss': history[-1]['loss'],
+               'val_mae': history[-1]['validation']['mae_mean']}
+        print(row)
+        rows.append(row)
+
+    # Сбой на середине второй эпохи и продолжение в новом Trainer дают те же веса, что обучение без сбоя
+    class Crashing:
+        def __init__(self, tensor, after):
+            self.tensor, self.calls, self.after = tensor, 0, after
+
+        def __len__(self):
+            return len(self.tensor)
+
+        def __getitem__(self, index):
+            self.calls += 1
+            if self.calls > self.after:
+                raise RuntimeError('simulated crash')
+            return self.tensor[index]
+
+    path = Path(directory) / 'state.pt'
+    path.unlink(missing_ok=True)
+    reference = make_trainer()
+    reference.fit(train_inputs, train_targets, epochs=epochs, batch_size=batch_size, seed=seed)
+    batches_per_epoch = -(-len(train_inputs) // batch_size)
+    interrupted = make_trainer(checkpoint_path=path, checkpoint_every=3)
+    try:
+        interrupted.fit(Crashing(train_inputs, batches_per_epoch + 4), train_targets, epochs=epochs,
+                        batch_size=batch_size, seed=seed)
+    except RuntimeError as error:
+        print(error)
+    resumed = make_trainer(checkpoint_path=path)
+    resumed.load_checkpoint()
+    resumed.fit(train_inputs, train_targets, epochs=epochs, batch_size=batch_size, seed=seed)
+    difference = max((a - b).abs().max().item() for a, b in zip(reference.model.state_dict().values(),
+                                                                  resumed.model.state_dict().values()))
+    print({'resume_difference': difference})
+    return rows
+
+
+if __name__ == '__main__':
+    benchmark_configurations()
@@ -0,0 +1,29 @@
+import pytest
+import torch
+
+from models.AttentionLayer_GRU_LSTM import AttentionLayerGRULSTM, equivalence_check
+
+
+def test_equivalence_with_reference():
+    result = equivalence_check()
+    assert set(result) == {'full', 'causal', 'window', 'causal_window', 'chunked', 'causal_chunked',
+                           'old_checkpoint'}
+    assert max(result.values()) < 1e-5
+
+
+@pytest.mark.parametrize('n_heads', [1, 4])
+def test_old_checkpoint_in_parent_module(n_heads):
+    # Ключи с префиксом, как у слоя внутри модели
+    layer = AttentionLayerGRULSTM(8, 8, n_heads=n_heads)
+    query, key, value = layer.linear_qkv.weight.detach().chunk(3)
+    state = {'attention.linear_query.weight': query, 'attention.linear_key.weight': key,
+             'attention.linear_value.weight': value, 'attention.linear_out.weight': layer.linear_out.weight}
+    model = torch.nn.Module()
+    model.attention = AttentionLayerGRULSTM(8, 8, n_heads=n_heads)
+    model.load_state_dict(state)
+    assert torch.equal(model.attention.linear_qkv.weight, layer.linear_qkv.weight)
+
+
+def test_equivalence_check_fails_above_tolerance():
+    with pytest.raises(AssertionError):
+        equivalence_check(length=32, tolerance=0)
@@ -0,0 +1,64 @@
+import networkx as nx
+import pytest
+
+from utils.compact_graph import CompactGraph
+from utils.detour_index import calculate_detour_indices, network_matrix
+
+
+def line_graph():
+    G = nx.Graph(crs='EPSG:4326')
+    nodes = [(37.6 + i * 0.001, 55.7) for i in range(4)]
+    for x, y in nodes:
+        G.add_node((x, y), x=x, y=y)
+    for u, v in zip(nodes[:-1], nodes[1:]):
+        G.add_edge(u, v, length=100.0, traffic=3.0)
+    return G
+
+
+def test_networkx_attribute_used():
+    G = line_graph()
+    result = calculate_detour_indices(G, [list(G)[0]], [list(G)[-1]], weight='traffic')
+    assert result['network_distance'][0] == pytest.approx(9.0)
+
+
+@pytest.mark.parametrize('make', [lambda G: G, CompactGraph.from_networkx,
+                                  lambda G: CompactGraph.from_networkx(G).as_networkx()])
+def test_missing_attribute_raises(make):
+    graph = make(line_graph())
+    with pytest.raises(KeyError):
+        network_matrix(graph, weight='trafic')
+
+
+def test_shared_compact_graph_not_modified():
+    compact = CompactGraph.from_networkx(line_graph())
+    view = compact.as_networkx()
+    columns = set(compact.edge_data)
+    with pytest.raises(KeyError):
+        calculate_detour_indices(view, [0], [3], weight='traffic')
+    assert set(compact.edge_data) == columns
+
+
+def test_chunk_follows_memory_budget(monkeypatch):
+    import utils.detour_index as detour_index
+
+    G = nx.grid_2d_graph(10, 10)
+    for x, y in G:
+        G.nodes[(x, y)].update(x=37.6 + x * 0.001, y=55.7 + y * 0.001)
+    nx.set_edge_attributes(G, 100.0, 'length')
+    nodes = list(G)
+    sources, targets = nodes * 2, nodes[::-1] * 2
+
+    blocks = []
+    original = detour_index.dijkstra
+
+    def recording(matrix, **kwargs):
+        distance = original(matrix, **kwargs)
+        blocks.append(distance.nbytes)
+        return distance
+
+    expected = calculate_detour_indices(G, sources, targets)['network_distance']
+    monkeypatch.setattr(detour_index, 'dijkstra', recording)
+    budget = 8 * len(nodes) * 7
+    result = calculate_detour_indices(G, sources, targets, memory_budget=budget)['network_distance']
+    assert blocks and max(blocks) <= budget
+    assert result.equals(expected)
@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+from utils.compact_graph import CompactGraph
+from utils.detour_surface import detour_surface, read_surface
+
+
+@pytest.mark.parametrize('crs, step', [('EPSG:4326', 1e-3), ('EPSG:32637', 100.0)])
+def test_surface_straight_line_in_graph_crs(tmp_path, crs, step):
+    # Путь из 4 вершин по оси x и школа в конце: детур ровно 1 в любой системе координат
+    coords = np.column_stack([37.6 + np.arange(4) * step, np.full(4, 55.7)]) if crs == 'EPSG:4326' else \
+        np.column_stack([np.arange(4) * step, np.zeros(4)])
+    graph = CompactGraph(coords, [0, 1, 2], [1, 2, 3], node_type=['road', 'road', 'road', 'school'], crs=crs)
+    if crs != 'EPSG:4326':
+        graph.edge_data['length'][:] = step
+    detour_surface(graph, tmp_path, radius=1000, workers=1)
+    surface = read_surface(tmp_path).set_index('node')
+    assert surface.loc[[0, 1, 2], 'targets'].tolist() == [1, 1, 1]
+    assert np.allclose(surface.loc[[0, 1, 2], 'mean_detour'], 1.0, atol=1e-2)
@@ -0,0 +1,35 @@
+import networkx as nx
+import numpy as np
+import pytest
+
+from utils.detour_index import calculate_detour_indices
+from utils.edge_candidates import EdgeCandidates
+
+
+def projected_path():
+    # Путь 0-1-2-3 по метровым координатам, как в примере models.kriging
+    G = nx.Graph(crs='EPSG:32637')
+    for node, (x, y) in enumerate([(0, 0), (100, 100), (200, 0), (300, 100)]):
+        G.add_node(node, x=x, y=y)
+    for u in range(3):
+        G.add_edge(u, u + 1, length=100.0)
+    return G
+
+
+def test_projected_straight_distance_is_euclidean():
+    candidates = EdgeCandidates(projected_path(), [0, 1], [3, 3])
+    assert np.allclose(candidates.straight, [np.hypot(300, 100), np.hypot(200, 0)])
+    assert np.isfinite(candidates.detour_index()).all()
+
+
+def test_projected_candidates_have_finite_delta():
+    candidates = EdgeCandidates(projected_path(), [0, 1], [3, 3])
+    result = candidates.evaluate([0], [2])
+    assert result['length'][0] == pytest.approx(200.0)
+    assert np.isfinite(result['mean_detour_delta']).all()
+    assert np.isfinite(candidates.accept(0, 3, 50.0)).all()
+
+
+def test_projected_detour_indices():
+    result = calculate_detour_indices(projected_path(), [0], [2])
+    assert result['detour_index'][0] == pytest.approx(1.0)
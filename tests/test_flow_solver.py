@@ -0,0 +1,49 @@
+import warnings
+
+import networkx as nx
+import numpy as np
+import pytest
+
+from utils.flow_solver import FlowSolver
+
+
+def two_components():
+    # Путь 0-1-2, отдельный путь 3-4 и ребро 5-6 без спроса: до 5 и 6 расстояние inf
+    G = nx.Graph()
+    G.add_nodes_from((node, {'x': float(node), 'y': 0.0}) for node in range(7))
+    for u, v, coast in [(0, 1, 1.0), (1, 2, 2.0), (3, 4, 1.0), (5, 6, 1.0)]:
+        G.add_edge(u, v, coast=coast, capacity=10.0)
+    return G
+
+
+def test_unreachable_nodes_do_not_produce_nan():
+    solver = FlowSolver(two_components())
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        result = solver.solve({0: -3, 2: 3, 3: -1, 4: 1})
+    assert result.unmet == 0
+    assert np.isfinite(result.potential).all()
+    assert result.cost == pytest.approx(3 * 3.0 + 1.0)
+
+
+def test_huge_capacity_matches_network_simplex():
+    G = nx.grid_2d_graph(4, 4)
+    rng = np.random.default_rng(0)
+    for u, v in G.edges:
+        G.edges[u, v].update(coast=float(rng.integers(1, 10)), capacity=1e12)
+    demands = {(0, 0): -500, (3, 3): 300, (0, 3): 200}
+    result = FlowSolver(G).solve(demands)
+
+    directed = nx.DiGraph()
+    for u, v, data in G.edges(data=True):
+        directed.add_edge(u, v, weight=data['coast'])
+        directed.add_edge(v, u, weight=data['coast'])
+    nx.set_node_attributes(directed, {node: demands.get(node, 0) for node in directed}, 'demand')
+    assert result.unmet == 0
+    assert result.cost == pytest.approx(nx.network_simplex(directed)[0])
+
+
+def test_supply_beyond_int32_is_rejected():
+    solver = FlowSolver(two_components())
+    with pytest.raises(ValueError):
+        solver.solve({0: -3e9, 2: 3e9})
@@ -0,0 +1,56 @@
+import pytest
+import torch
+
+from models.GCN_CONV import GCN_CONV
+
+
+def graph(num_nodes=12, num_edges=40, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    edge_index = torch.randint(0, num_nodes, (2, num_edges), generator=generator)
+    edge_weight = torch.rand(num_edges, generator=generator)
+    x = torch.randn(num_nodes, 5, generator=generator)
+    return x, edge_index, edge_weight
+
+
+def pair(normalize):
+    # Одинаковые веса: слой с кэшем CSR и слой через propagate
+    torch.manual_seed(0)
+    cached = GCN_CONV(5, 7, normalize=normalize, cached=True)
+    reference = GCN_CONV(5, 7, normalize=normalize)
+    reference.load_state_dict(cached.state_dict())
+    return cached, reference
+
+
+@pytest.mark.parametrize('normalize', [False, True])
+@pytest.mark.parametrize('weighted', [False, True])
+def test_cached_matches_propagate(normalize, weighted):
+    cached, reference = pair(normalize)
+    x, edge_index, edge_weight = graph()
+    edge_weight = edge_weight if weighted else None
+    assert torch.allclose(cached(x, edge_index, edge_weight), reference(x, edge_index, edge_weight), atol=1e-6)
+    # Батч снимков (..., N, F) - та же матрица по оси вершин
+    batch = torch.stack([x, 2 * x, -x])
+    assert torch.allclose(cached(batch, edge_index, edge_weight), reference(batch, edge_index, edge_weight),
+                          atol=1e-6)
+
+
+@pytest.mark.parametrize('normalize', [False, True])
+def test_cache_invalidated_by_in_place_edit(normalize):
+    cached, reference = pair(normalize)
+    x, edge_index, edge_weight = graph()
+    cached(x, edge_index, edge_weight)
+    edge_index[0, :5] = (edge_index[0, :5] + 1) % x.size(0)
+    edge_weight.mul_(3)
+    assert torch.allclose(cached(x, edge_index, edge_weight), reference(x, edge_index, edge_weight), atol=1e-6)
+
+
+def test_reset_cache_rebuilds_adjacency():
+    cached, _ = pair(False)
+    x, edge_index, edge_weight = graph()
+    cached(x, edge_index, edge_weight)
+    adjacency = cached._adjacency
+    cached(x, edge_index, edge_weight)
+    assert cached._adjacency is adjacency
+    cached.reset_cache()
+    cached(x, edge_index, edge_weight)
+    assert cached._adjacency is not adjacency
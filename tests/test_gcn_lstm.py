@@ -0,0 +1,41 @@
+import pytest
+import torch
+
+from models.GCN_LSTM import GCN_LSTM, sliding_windows
+
+
+def setup(num_nodes=15, features=3, horizon=2):
+    torch.manual_seed(0)
+    edge_index = torch.randint(0, num_nodes, (2, 50))
+    model = GCN_LSTM(in_channels=features, hidden_channels=8, num_gcn_layers=3, num_rnn_layers=2,
+                     num_features=features, horizon=horizon, normalize=True).eval()
+    return model, edge_index
+
+
+@pytest.mark.parametrize('batch, time', [(1, 5), (4, 7)])
+def test_forward_sequence_shape(batch, time):
+    model, edge_index = setup()
+    out = model.forward_sequence(torch.randn(batch, time, 15, 3), edge_index)
+    assert out.shape == (batch, 2, 15, 3)
+    # Четырёхмерный вход в forward идёт в тот же режим
+    assert model(torch.randn(batch, time, 15, 3), edge_index, None).shape == (batch, 2, 15, 3)
+
+
+def test_forward_sequence_nodes_subset():
+    model, edge_index = setup()
+    x = torch.randn(3, 6, 15, 3)
+    nodes = torch.tensor([0, 4, 9])
+    with torch.no_grad():
+        full = model.forward_sequence(x, edge_index)
+        part = model.forward_sequence(x, edge_index, nodes=nodes)
+    assert part.shape == (3, 2, 3, 3)
+    assert torch.allclose(part, full[:, :, nodes], atol=1e-6)
+
+
+def test_sliding_windows_shapes():
+    series = torch.arange(20 * 4 * 3, dtype=torch.float32).view(20, 4, 3)
+    inputs, targets = sliding_windows(series, window=6, horizon=2, stride=3)
+    assert inputs.shape == (5, 6, 4, 3)
+    assert targets.shape == (5, 2, 4, 3)
+    assert torch.equal(inputs[1], series[3:9])
+    assert torch.equal(targets[1], series[9:11])
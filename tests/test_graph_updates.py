@@ -0,0 +1,49 @@
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from utils.compact_graph import CompactGraph
+from utils.graph_updates import GraphEditor
+from utils.road_ingest import lines_to_graph
+
+
+def base_graph(length_crs=32637):
+    lines = [shapely.LineString([(37.60, 55.70), (37.61, 55.70)]),
+             shapely.LineString([(37.61, 55.70), (37.61, 55.71)])]
+    return lines_to_graph(np.array(lines), 'EPSG:4326', length_crs=length_crs)
+
+
+def test_new_roads_use_base_length_crs():
+    graph = base_graph()
+    assert graph.length_crs == 'EPSG:32637'
+    editor = GraphEditor(graph)
+    road = shapely.LineString([(37.61, 55.71), (37.62, 55.715)])
+    edges = editor.add_roads([road])
+    planar = gpd.GeoSeries([road], crs=4326).to_crs(32637).length.iloc[0]
+    assert np.isclose(graph.edge_data['length'][edges[0]], planar)
+    # Конец новой дороги слился с существующей вершиной
+    assert graph.number_of_nodes() == 4
+
+
+def test_great_circle_graph_keeps_great_circle_lengths():
+    graph = base_graph(length_crs=None)
+    assert graph.length_crs is None
+    edges = GraphEditor(graph).add_roads([shapely.LineString([(37.61, 55.71), (37.62, 55.71)])])
+    assert np.isclose(graph.edge_data['length'][edges[0]], graph.straight_distance(2, 3))
+
+
+def test_csr_rebuilt_once_per_batch_of_edits(monkeypatch):
+    graph = CompactGraph(np.column_stack([np.arange(5.0), np.zeros(5)]), [0, 1, 2], [1, 2, 3])
+    builds = []
+    build_csr = CompactGraph._build_csr
+    monkeypatch.setattr(CompactGraph, '_build_csr', lambda self: builds.append(1) or build_csr(self))
+    graph.add_edges([3], [4])
+    graph.remove_edges([0])
+    graph.add_edges([0], [4])
+    assert not builds
+    assert sorted(graph.neighbors(4).tolist()) == [0, 3]
+    assert graph.edge_id(1, 2) == 0
+    assert len(builds) == 1
+    graph.add_nodes([(9.0, 0.0)])
+    assert graph.degree().tolist() == [1, 1, 2, 2, 2, 0]
+    assert len(builds) == 1
@@ -0,0 +1,39 @@
+import torch
+
+from models.GCN_LSTM import GCN_LSTM
+from models.inference import InferenceRunner, StaticGraphModel, export_torchscript
+
+
+def setup(num_nodes=20, features=3):
+    torch.manual_seed(0)
+    edge_index = torch.randint(0, num_nodes, (2, 60))
+    edge_weight = torch.rand(60)
+    model = GCN_LSTM(in_channels=features, hidden_channels=16, num_features=features, horizon=2,
+                     normalize=True, cached=True).eval()
+    return model, edge_index, edge_weight
+
+
+def test_static_graph_model_matches_forward_sequence():
+    model, edge_index, edge_weight = setup()
+    x = torch.randn(3, 6, 20, 3)
+    with torch.no_grad():
+        expected = model.forward_sequence(x, edge_index, edge_weight)
+        for aggregation in ('sparse', 'scatter'):
+            module = StaticGraphModel(model, edge_index, 20, edge_weight=edge_weight, aggregation=aggregation)
+            assert torch.allclose(module(x), expected, atol=1e-5)
+
+
+def test_torchscript_any_batch_size(tmp_path):
+    model, edge_index, edge_weight = setup()
+    example = torch.randn(4, 6, 20, 3)
+    path = tmp_path / 'model.pt'
+    export_torchscript(model, edge_index, 20, example, path, edge_weight=edge_weight)
+
+    # Размер пачки при запуске отличается от примера трассировки
+    x = torch.randn(7, 6, 20, 3)
+    with torch.no_grad():
+        expected = model.forward_sequence(x, edge_index, edge_weight)
+    runner = InferenceRunner(path, batch_size=5)
+    prediction = runner.predict(x)
+    assert prediction.shape == expected.shape
+    assert torch.allclose(prediction, expected, atol=1e-5)
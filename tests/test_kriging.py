@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+from pykrige.ok import OrdinaryKriging
+
+from models.local_kriging import fit_variogram_model
+
+
+@pytest.mark.parametrize('variogram_model', ['linear', 'power', 'exponential', 'spherical'])
+def test_variogram_fit_matches_pykrige(variogram_model):
+    rng = np.random.default_rng(0)
+    x, y = rng.random(300) * 1000, rng.random(300) * 1000
+    z = np.sin(x / 200) + np.cos(y / 300) + rng.normal(0, 0.1, 300)
+    model = OrdinaryKriging(x, y, z, variogram_model=variogram_model, nlags=8,
+                            verbose=False, enable_plotting=False)
+    parameters = fit_variogram_model(model.lags, model.semivariance, variogram_model)
+    assert np.allclose(parameters, model.variogram_model_parameters, rtol=1e-6)
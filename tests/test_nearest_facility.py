@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from utils.compact_graph import CompactGraph
+from utils.nearest_facility import NearestFacility
+
+
+def random_graph(n=200, seed=0):
+    rng = np.random.default_rng(seed)
+    coords = np.column_stack([37.6 + rng.random(n) * 0.05, 55.7 + rng.random(n) * 0.05])
+    # Цепочка гарантирует связность, остальные рёбра - случайные хорды
+    u = np.concatenate([np.arange(n - 1), rng.integers(0, n, 2 * n)])
+    v = np.concatenate([np.arange(1, n), rng.integers(0, n, 2 * n)])
+    keep = u != v
+    node_type = np.array(['road'] * n, dtype=object)
+    node_type[rng.choice(n, 6, replace=False)] = 'school'
+    return CompactGraph(coords, u[keep], v[keep], node_type=node_type)
+
+
+def assert_matches_rebuild(facilities, graph, weight):
+    expected = NearestFacility(graph, ('school',), weight=weight)
+    # Равноудалённые объекты допустимы оба, поэтому сравниваются расстояния
+    assert np.allclose(facilities.distance['school'], expected.distance['school'])
+    reached = np.isfinite(expected.distance['school'])
+    assert (facilities.facility['school'][reached] >= 0).all()
+
+
+@pytest.mark.parametrize('weight', [None, 'length'])
+def test_add_and_remove_match_rebuild(weight):
+    graph = random_graph()
+    facilities = NearestFacility(graph, ('school',), weight=weight)
+    for node in (5, 77, 150):
+        changed = facilities.add_facility(node, 'school')
+        graph.set_node_type([node], 'school')
+        assert node in changed
+        assert_matches_rebuild(facilities, graph, weight)
+    for node in (77, int(graph.nodes_of_type('school')[0])):
+        facilities.remove_facility(node, 'school')
+        graph.set_node_type([node], 'road')
+        assert_matches_rebuild(facilities, graph, weight)
+
+
+def test_add_facility_search_is_local():
+    # На пути 0-1-...-99 с объектом в 0 новый объект в 90 перемечает только вершины за серединой
+    n = 100
+    graph = CompactGraph(np.column_stack([37.6 + np.arange(n) * 1e-3, np.full(n, 55.7)]),
+                         np.arange(n - 1), np.arange(1, n), length=1.0,
+                         node_type=['school'] + ['road'] * (n - 1))
+    facilities = NearestFacility(graph, ('school',), weight='length')
+    changed = facilities.add_facility(90, 'school')
+    assert changed.tolist() == list(range(46, n))
+
+
+def test_new_nodes_get_labels_from_neighbours():
+    graph = random_graph()
+    facilities = NearestFacility(graph, ('school', 'stop'), weight='length')
+    facilities.add_facility(10, 'stop')
+    graph.set_node_type([10], 'stop')
+
+    # Новая остановка и дорожная вершина, привязанные к существующим вершинам
+    new = graph.add_nodes([(37.61, 55.71), (37.62, 55.72)], node_type=['stop', 'road'])
+    graph.add_edges([new[0], new[0], new[1]], [3, new[1], 50])
+    facilities.add_facility(int(new[0]), 'stop')
+
+    expected = NearestFacility(graph, ('school', 'stop'), weight='length')
+    for node_type in ('school', 'stop'):
+        assert np.isfinite(facilities.distance[node_type][new]).all()
+        assert np.allclose(facilities.distance[node_type], expected.distance[node_type])
@@ -0,0 +1,62 @@
+import threading
+import time
+
+import numpy as np
+import torch
+
+from models.neighbour_sampling import NeighbourSampler, parity_check, prefetch
+
+
+def test_parity_with_full_graph():
+    result = parity_check(epochs=3)
+    assert result['forward_difference'] < 1e-5
+    assert result['minibatch_mse'] <= 1.5 * result['full_mse']
+
+
+def test_full_fanout_keeps_all_in_edges():
+    edge_index = torch.tensor([[1, 2, 3, 0], [0, 0, 0, 1]])
+    sampler = NeighbourSampler(edge_index, 4, [-1])
+    subgraph = sampler.sample([0], np.random.default_rng(0))
+    assert subgraph.num_targets == 1
+    assert subgraph.nodes[0] == 0
+    assert subgraph.edge_index.size(1) == 3
+
+
+def test_fanout_limits_and_rescales():
+    edge_index = torch.tensor([[1, 2, 3, 4], [0, 0, 0, 0]])
+    sampler = NeighbourSampler(edge_index, 5, [2])
+    subgraph = sampler.sample([0], np.random.default_rng(0))
+    assert subgraph.edge_index.size(1) == 2
+    assert torch.allclose(subgraph.edge_weight, torch.full((2,), 2.0))
+
+
+def test_self_loop_always_kept_with_normalize():
+    edge_index = torch.tensor([[1, 2, 3, 4, 0, 0, 0, 0], [0, 0, 0, 0, 1, 2, 3, 4]])
+    sampler = NeighbourSampler(edge_index, 5, [1], normalize=True)
+    for seed in range(10):
+        subgraph = sampler.sample([0], np.random.default_rng(seed))
+        source, target = subgraph.nodes[subgraph.edge_index]
+        loop = source == target
+        # Петля из gcn_norm и ровно один случайный сосед с весом, умноженным на 4
+        assert loop.sum() == 1 and (~loop).sum() == 1
+        assert torch.allclose(subgraph.edge_weight[loop], torch.tensor([0.2]))
+        assert torch.allclose(subgraph.edge_weight[~loop], torch.tensor([4 / 10 ** 0.5]))
+
+
+def test_prefetch_releases_producer_on_early_stop():
+    produced = []
+
+    def items():
+        for item in range(100):
+            produced.append(item)
+            yield item
+
+    before = threading.active_count()
+    for item in prefetch(items(), depth=2):
+        if item == 3:
+            break
+    deadline = time.monotonic() + 5
+    while threading.active_count() > before and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert threading.active_count() == before
+    assert len(produced) < 100
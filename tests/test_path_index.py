@@ -0,0 +1,141 @@
+import time
+
+import networkx as nx
+import numpy as np
+import pytest
+
+from utils.compact_graph import CompactGraph
+from utils.detour_index import calculate_detour_index, calculate_detour_indices
+import utils.path_index
+from utils.path_index import LandmarkIndex, path_index_of
+
+
+def grid_graph(size=6, step=0.001):
+    """
+    Решётка size x size в градусах около Москвы; длина ребра - 1, путь между углами - 2 * (size - 1).
+    """
+    G = nx.Graph(crs='EPSG:4326')
+    for i in range(size):
+        for j in range(size):
+            G.add_node((37.6 + i * step, 55.7 + j * step), x=37.6 + i * step, y=55.7 + j * step)
+    nodes = list(G.nodes)
+    for i in range(size):
+        for j in range(size):
+            if i + 1 < size:
+                G.add_edge(nodes[i * size + j], nodes[(i + 1) * size + j], length=1.0)
+            if j + 1 < size:
+                G.add_edge(nodes[i * size + j], nodes[i * size + j + 1], length=1.0)
+    return G
+
+
+def test_index_matches_dijkstra():
+    G = grid_graph()
+    index = LandmarkIndex.build(G, n_landmarks=4)
+    nodes = list(G.nodes)
+    for source, target in [(nodes[0], nodes[-1]), (nodes[3], nodes[20]), (nodes[7], nodes[7])]:
+        assert index.distance_between(source, target) == nx.shortest_path_length(G, source, target, weight='length')
+
+
+def test_networkx_index_invalidated_after_edit():
+    G = grid_graph()
+    LandmarkIndex.build(G, n_landmarks=4)
+    source, target = list(G.nodes)[0], list(G.nodes)[-1]
+    assert path_index_of(G) is not None
+    assert calculate_detour_indices(G, [source], [target])['network_distance'][0] == pytest.approx(10.0)
+
+    G.add_edge(source, target, length=1.0)
+    # Пакетный расчёт сверяет число рёбер сам, одиночный - по счётчику изменений
+    assert path_index_of(G, count_edges=True) is None
+    assert calculate_detour_indices(G, [source], [target])['network_distance'][0] == pytest.approx(1.0)
+    G.graph['version'] = G.graph.get('version', 0) + 1
+    assert path_index_of(G) is None
+    single = calculate_detour_index(G, source, target)
+    assert single == pytest.approx(calculate_detour_indices(G, [source], [target])['detour_index'][0])
+
+
+def test_networkx_index_invalidated_after_weight_change():
+    G = grid_graph()
+    LandmarkIndex.build(G, n_landmarks=4)
+    nodes = list(G.nodes)
+    G.edges[nodes[0], nodes[1]]['length'] = 5.0
+    # У networkx-графа нет счётчика изменений: правку весов на месте отмечают в G.graph['version']
+    G.graph['version'] = G.graph.get('version', 0) + 1
+    assert path_index_of(G) is None
+
+
+def test_compact_index_invalidated_after_edit():
+    graph = CompactGraph.from_networkx(grid_graph())
+    graph.edge_data['length'][:] = 1.0
+    LandmarkIndex.build(graph, n_landmarks=4)
+    assert path_index_of(graph).distance_by_index(0, 35) == pytest.approx(10.0)
+
+    # Число рёбер после правки то же, что при построении индекса
+    graph.add_edges([0], [35], length=1.0)
+    graph.remove_edges([0])
+    assert graph.number_of_edges() == 60
+    assert path_index_of(graph) is None
+    result = calculate_detour_indices(graph, [0], [35])
+    assert result['network_distance'][0] == pytest.approx(1.0)
+
+
+def test_saved_index_stale_after_edit(tmp_path):
+    graph = CompactGraph.from_networkx(grid_graph())
+    LandmarkIndex.build(graph, n_landmarks=4).save(tmp_path)
+    assert path_index_of(graph) is not None
+    LandmarkIndex.load(tmp_path, graph)
+    assert path_index_of(graph) is not None
+
+    graph.add_edges([0], [35], length=1.0)
+    LandmarkIndex.load(tmp_path, graph)
+    assert path_index_of(graph) is None
+    assert np.isclose(calculate_detour_indices(graph, [0], [35])['network_distance'][0], 1.0)
+
+
+def test_compact_index_invalidated_by_editor():
+    graph = CompactGraph.from_networkx(grid_graph())
+    LandmarkIndex.build(graph, n_landmarks=4)
+    graph.add_nodes([(37.7, 55.8)])
+    assert path_index_of(graph) is None
+
+
+def test_queries_do_not_fingerprint(monkeypatch):
+    G = grid_graph()
+    graph = CompactGraph.from_networkx(G)
+    LandmarkIndex.build(G, n_landmarks=4)
+    LandmarkIndex.build(graph, n_landmarks=4)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('graph_fingerprint called on a query')
+
+    monkeypatch.setattr(utils.path_index, 'graph_fingerprint', fail)
+    source, target = list(G.nodes)[0], list(G.nodes)[7]
+    calculate_detour_index(G, source, target)
+    calculate_detour_indices(G, [source], [target])
+    calculate_detour_indices(graph, [0], [7])
+
+
+def median_time(function, repeat=50):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def test_short_query_not_slower_than_networkx():
+    # Проверка актуальности индекса за O(1): короткий запрос на большой решётке
+    # не должен стоить прохода по всем рёбрам
+    size = 120
+    G = nx.grid_2d_graph(size, size)
+    nx.set_edge_attributes(G, 1.0, 'length')
+    for node, data in G.nodes(data=True):
+        data['x'], data['y'] = 37.6 + node[0] * 1e-4, 55.7 + node[1] * 1e-4
+    LandmarkIndex.build(G, n_landmarks=8)
+    source, target = (60, 60), (62, 63)
+    index = path_index_of(G)
+    assert index.distance_between(source, target) == 5.0
+
+    with_index = median_time(lambda: path_index_of(G).distance_between(source, target))
+    plain = median_time(lambda: nx.shortest_path_length(G, source, target, weight='length'))
+    assert with_index < 5 * plain + 1e-3
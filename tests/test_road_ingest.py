@@ -0,0 +1,65 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+
+from utils.graph_creator import create_road_graph
+from utils.road_ingest import read_roads
+
+
+@pytest.fixture
+def roads_path(tmp_path):
+    lines = [shapely.LineString([(37.60, 55.70), (37.61, 55.70)]),
+             shapely.LineString([(37.61, 55.70), (37.61, 55.71), (37.62, 55.71)]),
+             shapely.LineString([(37.62, 55.71), (37.63, 55.72)]),
+             shapely.LineString([(37.70, 55.80), (37.71, 55.80)])]
+    path = tmp_path / 'roads.gpkg'
+    gpd.GeoDataFrame({'Foot': [1, 1, 1, 0]}, geometry=lines, crs=4326).to_file(path)
+    return path
+
+
+def test_compact_lengths_match_networkx(roads_path):
+    for crs in (32633, 32637):
+        graph = create_road_graph(roads_path, compact=True, crs=crs)
+        G = create_road_graph(roads_path, crs=crs)
+        assert graph.number_of_edges() == G.number_of_edges()
+        expected = sorted(data['length'] for _, _, data in G.edges(data=True))
+        assert np.allclose(np.sort(graph.edge_data['length']), expected)
+
+
+def test_bbox_and_mask_intersection(roads_path):
+    mask = shapely.box(37.59, 55.69, 37.615, 55.705)
+    lines, _ = read_roads(roads_path, foot=None, bbox=(37.605, 55.69, 37.70, 55.73), mask=mask)
+    assert len(lines) == 2
+
+
+def test_vertices_projected_at_most_once(monkeypatch):
+    import utils.road_ingest as road_ingest
+    from pyproj import Transformer
+
+    lines = gpd.GeoSeries([shapely.LineString([(37.60, 55.70), (37.605, 55.702), (37.61, 55.70)]),
+                           shapely.LineString([(37.61, 55.70), (37.61, 55.71)])], crs=4326).to_crs(32637)
+    projected = 0
+
+    class Counting:
+        def __init__(self, transformer):
+            self.transformer = transformer
+
+        def transform(self, x, y):
+            nonlocal projected
+            projected += len(x)
+            return self.transformer.transform(x, y)
+
+    from_crs = Transformer.from_crs
+    monkeypatch.setattr(road_ingest.Transformer, 'from_crs',
+                        lambda *args, **kwargs: Counting(from_crs(*args, **kwargs)))
+    graph = road_ingest.lines_to_graph(lines.values, lines.crs, length_crs=32637)
+    # Точки линий уже в метрической проекции: в EPSG:4326 переводятся только 3 вершины графа
+    assert projected == 3
+    assert np.allclose(np.sort(graph.edge_data['length']), np.sort(lines.length))
+    assert np.allclose(graph.coords[np.lexsort(graph.coords.T[::-1])],
+                       [(37.60, 55.70), (37.61, 55.70), (37.61, 55.71)])
+
+    projected = 0
+    road_ingest.lines_to_graph(lines.values, lines.crs, length_crs=32633)
+    assert projected == 5 + 3
@@ -0,0 +1,29 @@
+import numpy as np
+
+from utils.graph_creation_parallel import attach_edges
+from utils.snapping import NodeIndex
+
+
+def grid_index():
+    rng = np.random.default_rng(0)
+    coords = np.column_stack([37.6 + rng.random(2000) * 0.05, 55.7 + rng.random(2000) * 0.05])
+    return NodeIndex(np.arange(len(coords)), coords, 'EPSG:32637')
+
+
+def test_attach_edges_matches_snap_for_any_workers():
+    idx = grid_index()
+    rng = np.random.default_rng(1)
+    xy = idx.xy[rng.integers(len(idx.xy), size=500)] + rng.normal(0, 80, (500, 2))
+    expected = idx.snap(xy, 50)
+    for workers in (1, 2, None):
+        for got, want in zip(attach_edges(idx, xy, 50, workers=workers), expected):
+            assert np.array_equal(got, want)
+
+
+def test_lonely_point_attaches_to_nearest():
+    idx = grid_index()
+    far = idx.xy.max(axis=0) + 10_000
+    point, position, distance = attach_edges(idx, far[None, :], 50, workers=2)
+    assert list(point) == [0]
+    assert position[0] == idx.tree.query(far)[1]
+    assert distance[0] > 50
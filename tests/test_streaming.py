@@ -0,0 +1,48 @@
+import pytest
+import torch
+
+from models.GCN_LSTM import GCN_LSTM
+from models.streaming import StreamingForecaster
+
+
+def setup(num_nodes=25, features=3, window=5):
+    torch.manual_seed(0)
+    edge_index = torch.randint(0, num_nodes, (2, 80))
+    edge_weight = torch.rand(80)
+    model = GCN_LSTM(in_channels=features, hidden_channels=16, num_features=features, horizon=2,
+                     normalize=True, cached=True).eval()
+    stream = StreamingForecaster(model, edge_index, num_nodes, edge_weight=edge_weight, window=window)
+    return model, stream, edge_index, edge_weight
+
+
+def test_steps_match_forward_sequence_within_window():
+    model, stream, edge_index, edge_weight = setup()
+    series = torch.randn(5, 25, 3)
+    for t in range(5):
+        forecast = stream.step(series[t])
+        with torch.no_grad():
+            expected = model.forward_sequence(series[None, :t + 1], edge_index, edge_weight)[0]
+        assert forecast.shape == (2, 25, 3)
+        assert torch.allclose(forecast, expected, atol=1e-5)
+
+
+def test_snapshot_restore_continues_stream(tmp_path):
+    model, stream, edge_index, edge_weight = setup()
+    series = torch.randn(12, 25, 3)
+    stream.warm_up(series[:7])
+    stream.snapshot(tmp_path / 'state.pt')
+    continued = stream.warm_up(series[7:])
+
+    restored = StreamingForecaster(model, edge_index, 25, edge_weight=edge_weight, window=5)
+    restored.restore(tmp_path / 'state.pt')
+    assert restored.steps == 7
+    assert torch.equal(restored.warm_up(series[7:]), continued)
+
+
+def test_restore_rejects_other_window(tmp_path):
+    model, stream, edge_index, edge_weight = setup()
+    stream.step(torch.randn(25, 3))
+    stream.snapshot(tmp_path / 'state.pt')
+    other = StreamingForecaster(model, edge_index, 25, edge_weight=edge_weight, window=6)
+    with pytest.raises(ValueError):
+        other.restore(tmp_path / 'state.pt')
@@ -0,0 +1,72 @@
+import warnings
+
+import torch
+
+from models.GCN_LSTM import GCN_LSTM, sliding_windows
+from models.trainer import Trainer, set_threads
+
+
+def make_trainer(**options):
+    torch.manual_seed(0)
+    model = GCN_LSTM(in_channels=2, hidden_channels=8, num_gcn_layers=2, num_rnn_layers=1, num_features=2,
+                     horizon=2, normalize=True, cached=True)
+    edge_index = torch.tensor([[0, 1, 2, 3, 4, 5], [1, 2, 3, 4, 5, 0]])
+    return Trainer(model, edge_index, 6, **options)
+
+
+def data():
+    series = torch.randn(40, 6, 2, generator=torch.Generator().manual_seed(0))
+    return sliding_windows(series, 6, 2)
+
+
+def test_resume_from_checkpoint(tmp_path, capsys):
+    inputs, targets = data()
+    reference = make_trainer(verbose=False)
+    reference.fit(inputs, targets, epochs=2, batch_size=8)
+
+    path = tmp_path / 'state.pt'
+    first = make_trainer(checkpoint_path=path, verbose=False)
+    first.fit(inputs, targets, epochs=1, batch_size=8)
+    resumed = make_trainer(checkpoint_path=path, verbose=False)
+    assert resumed.load_checkpoint()
+    resumed.fit(inputs, targets, epochs=2, batch_size=8)
+
+    assert capsys.readouterr().out == ''
+    for a, b in zip(reference.model.state_dict().values(), resumed.model.state_dict().values()):
+        assert torch.allclose(a, b)
+    assert len(resumed.history) == 2
+
+
+def test_verbose_prints_epochs(tmp_path, capsys):
+    inputs, targets = data()
+    trainer = make_trainer(checkpoint_path=tmp_path / 'state.pt')
+    trainer.fit(inputs, targets, epochs=1, batch_size=8)
+    make_trainer(checkpoint_path=tmp_path / 'state.pt').load_checkpoint()
+    out = capsys.readouterr().out
+    assert 'epoch 0' in out and 'resumed from' in out
+
+
+def test_interop_threads_warning(capsys):
+    # Второй вызов всегда поздний: число потоков между операциями уже задано
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        set_threads(interop_threads=torch.get_num_interop_threads())
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        set_threads(interop_threads=torch.get_num_interop_threads())
+    assert [warning.category for warning in caught] == [RuntimeWarning]
+    assert capsys.readouterr().out == ''
+
+
+def test_checkpoint_activations_match_plain_training():
+    inputs, targets = data()
+    plain = make_trainer(verbose=False)
+    plain.fit(inputs, targets, epochs=1, batch_size=8)
+    checkpointed = make_trainer(checkpoint_activations=True, verbose=False)
+    checkpointed.fit(inputs, targets, epochs=1, batch_size=8)
+
+    expected, got = plain.model.state_dict(), checkpointed.model.state_dict()
+    assert expected.keys() == got.keys()
+    for name in expected:
+        assert torch.allclose(expected[name].float(), got[name].float(), atol=1e-6), name
+    assert got['batch_norms.0.num_batches_tracked'] == -(-len(inputs) // 8)
@@ -0,0 +1,523 @@
+from collections.abc import Mapping
+
+import networkx as nx
+import numpy as np
+
+EARTH_RADIUS = 6371008.8  # средний радиус Земли, м
+
+NODE_TYPES = ('road', 'stop', 'metro', 'school', 'removed')
+EDGE_TYPES = ('road', 'link')
+EDGE_COLUMNS = ('length', 'capacity', 'coast')
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Векторизованное расстояние по большому кругу в метрах.
+    Принимает скаляры или массивы одинаковой (или совместимой) формы в градусах.
+    """
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class CompactGraph:
+    """
+    Компактный неориентированный граф с целочисленными вершинами 0..N-1.
+
+    Вершины хранятся столбцами: координаты (N, 2) в EPSG:4326 (x - долгота, y - широта),
+    коды типов вершин и произвольные колонки атрибутов (name, id).
+    Рёбра хранятся массивами концов edge_u / edge_v и колонками length, capacity, coast, type.
+    Смежность - CSR (indptr, indices, edge_ids); после add_edges / remove_edges она помечается
+    устаревшей и пересобирается один раз при следующем обращении, так что серия правок стоит одной пересборки.
+    length_crs - метрическая проекция, в которой посчитаны длины рёбер (None - длины по большому кругу).
+    Счётчик version растёт при каждом изменении вершин или рёбер через методы графа;
+    по нему привязанные индексы (LandmarkIndex) дёшево проверяют актуальность.
+    """
+
+    version = 0
+    length_crs = None
+    _csr_stale = False
+
+    def __init__(self, coords, edge_u=(), edge_v=(), node_type=None, node_data=None,
+                 length=None, capacity=800, coast=1, edge_type=None, crs='EPSG:4326'):
+        """
+        :param coords: массив координат вершин (N, 2)
+        :param edge_u: начала рёбер
+        :param edge_v: концы рёбер
+        :param node_type: строки или коды типов вершин, по умолчанию все 'road'
+        :param node_data: словарь колонок атрибутов вершин {имя: массив длины N}
+        :param length: длины рёбер в метрах, по умолчанию - расстояние между концами
+        :param capacity: пропускная способность рёбер (скаляр или массив)
+        :param coast: стоимость прохода по рёбрам (скаляр или массив)
+        :param edge_type: строки или коды типов рёбер, по умолчанию все 'road'
+        :param crs: система координат вершин
+        """
+        self.crs = crs
+        self.node_types = list(NODE_TYPES)
+        self.edge_types = list(EDGE_TYPES)
+
+        self.coords = np.ascontiguousarray(coords, dtype=np.float64).reshape(-1, 2)
+        n = len(self.coords)
+        self.node_type = self._encode(node_type, self.node_types, n)
+        self.node_data = {key: np.asarray(col, dtype=object) for key, col in (node_data or {}).items()}
+
+        self.edge_u = np.asarray(edge_u, dtype=np.int64)
+        self.edge_v = np.asarray(edge_v, dtype=np.int64)
+        m = len(self.edge_u)
+        if length is None:
+            length = self.straight_distance(self.edge_u, self.edge_v)
+        self.edge_data = {
+            'length': np.broadcast_to(np.asarray(length, dtype=np.float64), (m,)).copy(),
+            'capacity': np.broadcast_to(np.asarray(capacity, dtype=np.float64), (m,)).copy(),
+            'coast': np.broadcast_to(np.asarray(coast, dtype=np.float64), (m,)).copy(),
+        }
+        self.edge_type = self._encode(edge_type, self.edge_types, m)
+        self._build_csr()
+
+    @staticmethod
+    def _encode(values, categories, size):
+        # Строковые категории переводим в коды int8, новые категории дописываем в конец
+        if values is None:
+            return np.zeros(size, dtype=np.int8)
+        if isinstance(values, str):
+            values = [values] * size
+        values = np.asarray(values)
+        if values.dtype.kind in 'iu':
+            return values.astype(np.int8)
+        codes = np.empty(len(values), dtype=np.int8)
+        for name in np.unique(values):
+            if name not in categories:
+                categories.append(str(name))
+            codes[values == name] = categories.index(name)
+        return codes
+
+    def _build_csr(self):
+        n = len(self.coords)
+        m = len(self.edge_u)
+        heads = np.concatenate([self.edge_u, self.edge_v])
+        tails = np.concatenate([self.edge_v, self.edge_u])
+        order = np.argsort(heads, kind='stable')
+        self._indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(heads, minlength=n), out=self._indptr[1:])
+        self._indices = tails[order]
+        self._edge_ids = np.concatenate([np.arange(m), np.arange(m)])[order]
+        self._csr_stale = False
+
+    @property
+    def indptr(self):
+        if self._csr_stale:
+            self._build_csr()
+        return self._indptr
+
+    @property
+    def indices(self):
+        if self._csr_stale:
+            self._build_csr()
+        return self._indices
+
+    @property
+    def edge_ids(self):
+        if self._csr_stale:
+            self._build_csr()
+        return self._edge_ids
+
+    # --- размеры и доступ ---
+
+    def number_of_nodes(self):
+        return len(self.coords)
+
+    def number_of_edges(self):
+        return len(self.edge_u)
+
+    def __len__(self):
+        return self.number_of_nodes()
+
+    def degree(self):
+        return np.diff(self.indptr)
+
+    def neighbors(self, node):
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def edge_id(self, u, v):
+        """
+        Индекс ребра (u, v) или -1, если ребра нет.
+        """
+        start, end = self.indptr[u], self.indptr[u + 1]
+        hits = np.flatnonzero(self.indices[start:end] == v)
+        return int(self.edge_ids[start + hits[-1]]) if len(hits) else -1
+
+    def nodes_of_type(self, node_type):
+        if node_type not in self.node_types:
+            return np.empty(0, dtype=np.int64)
+        return np.flatnonzero(self.node_type == self.node_types.index(node_type))
+
+    def type_of(self, node):
+        return self.node_types[self.node_type[node]]
+
+    def straight_distance(self, u, v):
+        """
+        Расстояние по прямой (по большому кругу) между вершинами u и v в метрах.
+        """
+        u, v = np.asarray(u), np.asarray(v)
+        return haversine(self.coords[u, 0], self.coords[u, 1], self.coords[v, 0], self.coords[v, 1])
+
+    def csr_matrix(self, weight='length'):
+        """
+        Симметричная матрица смежности scipy.sparse с весами из колонки weight
+        (None - единичные веса). Для кратных рёбер берётся минимальный вес.
+        """
+        w = np.ones(len(self.edge_u)) if weight is None else self.edge_data[weight]
+        # Нулевые веса scipy считает отсутствием ребра, поэтому заменяем их на минимально возможные
+        w = np.where(w > 0, w, np.finfo(np.float64).tiny)
+        rows = np.concatenate([self.edge_u, self.edge_v])
+        cols = np.concatenate([self.edge_v, self.edge_u])
+        return _min_csr(rows, cols, np.concatenate([w, w]), len(self.coords))
+
+    def arrays(self):
+        """
+        Все числовые массивы графа по именам (для сохранения на диск).
+        """
+        arrays = {
+            'coords': self.coords, 'node_type': self.node_type,
+            'edge_u': self.edge_u, 'edge_v': self.edge_v, 'edge_type': self.edge_type,
+            'indptr': self.indptr, 'indices': self.indices, 'edge_ids': self.edge_ids,
+        }
+        arrays.update({'edge_' + key: col for key, col in self.edge_data.items()})
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, node_types, edge_types, node_data=None, crs='EPSG:4326', length_crs=None):
+        """
+        Собирает граф из готовых массивов без копирования (в том числе из np.memmap).
+        :param arrays: словарь в формате CompactGraph.arrays()
+        """
+        graph = cls.__new__(cls)
+        graph.crs = crs
+        graph.length_crs = length_crs
+        graph.node_types = list(node_types)
+        graph.edge_types = list(edge_types)
+        graph.coords = arrays['coords']
+        graph.node_type = arrays['node_type']
+        graph.node_data = dict(node_data or {})
+        graph.edge_u = arrays['edge_u']
+        graph.edge_v = arrays['edge_v']
+        graph.edge_type = arrays['edge_type']
+        graph.edge_data = {key: arrays['edge_' + key] for key in EDGE_COLUMNS}
+        graph._indptr = arrays['indptr']
+        graph._indices = arrays['indices']
+        graph._edge_ids = arrays['edge_ids']
+        return graph
+
+    # --- изменение графа ---
+
+    def add_nodes(self, coords, node_type='road', **node_data):
+        """
+        Добавляет вершины пачкой, возвращает их индексы.
+        :param coords: координаты новых вершин (K, 2)
+        :param node_type: тип новых вершин (строка или массив строк)
+        :param node_data: колонки атрибутов новых вершин (name, id, ...)
+        """
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        n, k = len(self.coords), len(coords)
+        self.coords = np.concatenate([self.coords, coords])
+        self.node_type = np.concatenate([self.node_type, self._encode(node_type, self.node_types, k)])
+        for key in set(self.node_data) | set(node_data):
+            old = self.node_data.get(key, np.full(n, None, dtype=object))
+            new = np.asarray(node_data[key], dtype=object) if key in node_data else np.full(k, None, dtype=object)
+            self.node_data[key] = np.concatenate([old, new])
+        # Для новых вершин CSR достаточно дополнить пустыми строками (устаревший CSR пересоберётся целиком)
+        if not self._csr_stale:
+            self._indptr = np.concatenate([self._indptr, np.full(k, self._indptr[-1])])
+        self.version += 1
+        return np.arange(n, n + k)
+
+    def add_edges(self, u, v, length=None, capacity=800, coast=1, edge_type='road'):
+        """
+        Добавляет рёбра пачкой, возвращает индексы рёбер; CSR пересоберётся при следующем обращении.
+        """
+        u = np.asarray(u, dtype=np.int64).ravel()
+        v = np.asarray(v, dtype=np.int64).ravel()
+        m, k = len(self.edge_u), len(u)
+        if length is None:
+            length = self.straight_distance(u, v)
+        new_columns = {'length': length, 'capacity': capacity, 'coast': coast}
+        self.edge_u = np.concatenate([self.edge_u, u])
+        self.edge_v = np.concatenate([self.edge_v, v])
+        for key, value in new_columns.items():
+            value = np.broadcast_to(np.asarray(value, dtype=np.float64), (k,))
+            self.edge_data[key] = np.concatenate([self.edge_data[key], value])
+        self.edge_type = np.concatenate([self.edge_type, self._encode(edge_type, self.edge_types, k)])
+        self._csr_stale = True
+        self.version += 1
+        return np.arange(m, m + k)
+
+    def remove_edges(self, edges):
+        """
+        Удаляет рёбра по индексам; индексы оставшихся рёбер сдвигаются, индексы вершин не меняются.
+        """
+        keep = np.ones(len(self.edge_u), dtype=bool)
+        keep[np.asarray(edges, dtype=np.int64)] = False
+        self.edge_u = self.edge_u[keep]
+        self.edge_v = self.edge_v[keep]
+        self.edge_data = {key: col[keep] for key, col in self.edge_data.items()}
+        self.edge_type = self.edge_type[keep]
+        self._csr_stale = True
+        self.version += 1
+
+    def incident_edges(self, nodes):
+        """
+        Индексы рёбер, инцидентных вершинам nodes (без повторов).
+        """
+        nodes = np.asarray(nodes, dtype=np.int64).ravel()
+        if not len(nodes):
+            return np.empty(0, dtype=np.int64)
+        starts, ends = self.indptr[nodes], self.indptr[nodes + 1]
+        half_edges = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+        return np.unique(self.edge_ids[half_edges.astype(np.int64)])
+
+    def set_node_type(self, nodes, node_type):
+        if not self.node_type.flags.writeable:  # граф загружен из кэша через mmap
+            self.node_type = np.array(self.node_type)
+        self.node_type[np.asarray(nodes, dtype=np.int64)] = self._encode(node_type, self.node_types, 1)[0]
+
+    def subgraph(self, nodes):
+        """
+        Подграф на вершинах nodes с перенумерацией 0..K-1 в порядке возрастания старых индексов.
+        """
+        nodes = np.unique(np.asarray(nodes, dtype=np.int64))
+        mapping = np.full(len(self.coords), -1, dtype=np.int64)
+        mapping[nodes] = np.arange(len(nodes))
+        keep = (mapping[self.edge_u] >= 0) & (mapping[self.edge_v] >= 0)
+        sub = CompactGraph.__new__(CompactGraph)
+        sub.crs = self.crs
+        sub.length_crs = self.length_crs
+        sub.node_types = list(self.node_types)
+        sub.edge_types = list(self.edge_types)
+        sub.coords = self.coords[nodes]
+        sub.node_type = self.node_type[nodes]
+        sub.node_data = {key: col[nodes] for key, col in self.node_data.items()}
+        sub.edge_u = mapping[self.edge_u[keep]]
+        sub.edge_v = mapping[self.edge_v[keep]]
+        sub.edge_data = {key: col[keep] for key, col in self.edge_data.items()}
+        sub.edge_type = self.edge_type[keep]
+        sub._build_csr()
+        return sub
+
+    def largest_component(self):
+        """
+        Подграф самой крупной компоненты связности.
+        """
+        from scipy.sparse.csgraph import connected_components
+
+        _, labels = connected_components(self.csr_matrix(weight=None), directed=False)
+        return self.subgraph(np.flatnonzero(labels == np.bincount(labels).argmax()))
+
+    # --- совместимость с networkx ---
+
+    @classmethod
+    def from_networkx(cls, G, capacity=800, coast=1):
+        """
+        Строит компактный граф из networkx-графа с вершинами-кортежами (x, y), как у momepy.
+        Вершины нумеруются в порядке G.nodes; отсутствующие атрибуты рёбер заполняются
+        значениями по умолчанию, отсутствующая длина - расстоянием между концами.
+        """
+        keys = list(G.nodes)
+        position = {key: i for i, key in enumerate(keys)}
+        coords = np.array([(data['x'], data['y']) if 'x' in data else key[:2] for key, data in G.nodes(data=True)],
+                          dtype=np.float64).reshape(-1, 2)
+        node_type = [data.get('type', 'road') for _, data in G.nodes(data=True)]
+        node_data = {}
+        for column in ('name', 'id'):
+            if any(column in data for _, data in G.nodes(data=True)):
+                node_data[column] = [data.get(column) for _, data in G.nodes(data=True)]
+
+        edges = list(G.edges(data=True))
+        edge_u = np.fromiter((position[u] for u, _, _ in edges), dtype=np.int64, count=len(edges))
+        edge_v = np.fromiter((position[v] for _, v, _ in edges), dtype=np.int64, count=len(edges))
+        graph = cls(coords, edge_u, edge_v, node_type=node_type, node_data=node_data,
+                    crs=str(G.graph.get('crs', 'EPSG:4326')))
+
+        straight = graph.edge_data['length']
+        graph.edge_data['length'] = np.array([data.get('length', straight[i]) for i, (_, _, data) in enumerate(edges)],
+                                             dtype=np.float64)
+        graph.edge_data['capacity'] = np.array([data.get('capacity', capacity) for _, _, data in edges],
+                                               dtype=np.float64)
+        graph.edge_data['coast'] = np.array([data.get('coast', coast) for _, _, data in edges], dtype=np.float64)
+        graph.edge_type = graph._encode([data.get('type', 'road') for _, _, data in edges], graph.edge_types,
+                                        len(edges))
+        return graph
+
+    def to_networkx(self, keys='id'):
+        """
+        Полноценная копия в networkx.Graph.
+        :param keys: 'id' - вершины 0..N-1, 'xy' - кортежи (x, y), как в исходных графах momepy
+        """
+        labels = list(map(tuple, self.coords.tolist())) if keys == 'xy' else range(len(self.coords))
+        G = nx.Graph(crs=self.crs)
+        G.add_nodes_from((labels[i], dict(_NodeAttrs(self, i))) for i in range(len(self.coords)))
+        G.add_edges_from((labels[u], labels[v], dict(_EdgeAttrs(self, e)))
+                         for e, (u, v) in enumerate(zip(self.edge_u.tolist(), self.edge_v.tolist())))
+        return G
+
+    def as_networkx(self):
+        """
+        Неизменяемое networkx-представление без копирования данных.
+        """
+        return NetworkXView(self)
+
+
+def as_compact(G):
+    """
+    Приводит граф к CompactGraph.
+    :param G: CompactGraph, NetworkXView или networkx-граф с вершинами-кортежами (x, y)
+    :return: (CompactGraph, ключи вершин исходного графа по индексам или None, если ключи - сами индексы)
+    """
+    if isinstance(G, CompactGraph):
+        return G, None
+    if isinstance(G, NetworkXView):
+        return G.compact, None
+    return CompactGraph.from_networkx(G), list(G.nodes)
+
+
+def _min_csr(rows, cols, data, n):
+    # CSR-матрица, в которой для кратных рёбер остаётся минимальный вес
+    from scipy import sparse
+
+    order = np.lexsort((data, cols, rows))
+    rows, cols, data = rows[order], cols[order], data[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    return sparse.csr_matrix((data[first], (rows[first], cols[first])), shape=(n, n))
+
+
+class _NodeAttrs(Mapping):
+    __slots__ = ('_graph', '_node')
+
+    def __init__(self, graph, node):
+        self._graph = graph
+        self._node = node
+
+    def _keys(self):
+        keys = ['x', 'y', 'type']
+        keys.extend(key for key, col in self._graph.node_data.items() if col[self._node] is not None)
+        return keys
+
+    def __getitem__(self, key):
+        graph, node = self._graph, self._node
+        if key == 'x':
+            return float(graph.coords[node, 0])
+        if key == 'y':
+            return float(graph.coords[node, 1])
+        if key == 'type':
+            return graph.type_of(node)
+        if key in graph.node_data and graph.node_data[key][node] is not None:
+            return graph.node_data[key][node]
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class _EdgeAttrs(Mapping):
+    __slots__ = ('_graph', '_edge')
+
+    def __init__(self, graph, edge):
+        self._graph = graph
+        self._edge = edge
+
+    def __getitem__(self, key):
+        if key == 'type':
+            return self._graph.edge_types[self._graph.edge_type[self._edge]]
+        return float(self._graph.edge_data[key][self._edge])
+
+    def __iter__(self):
+        return iter(EDGE_COLUMNS + ('type',))
+
+    def __len__(self):
+        return len(EDGE_COLUMNS) + 1
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class _NodeMap(Mapping):
+    __slots__ = ('_graph',)
+
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __getitem__(self, node):
+        if not self.__contains__(node):
+            raise KeyError(node)
+        return _NodeAttrs(self._graph, node)
+
+    def __contains__(self, node):
+        return isinstance(node, (int, np.integer)) and 0 <= node < len(self._graph.coords)
+
+    def __iter__(self):
+        return iter(range(len(self._graph.coords)))
+
+    def __len__(self):
+        return len(self._graph.coords)
+
+
+class _NeighborMap(Mapping):
+    __slots__ = ('_graph', '_node')
+
+    def __init__(self, graph, node):
+        self._graph = graph
+        self._node = node
+
+    def __getitem__(self, neighbor):
+        edge = self._graph.edge_id(self._node, neighbor) if isinstance(neighbor, (int, np.integer)) else -1
+        if edge < 0:
+            raise KeyError(neighbor)
+        return _EdgeAttrs(self._graph, edge)
+
+    def __contains__(self, neighbor):
+        return isinstance(neighbor, (int, np.integer)) and self._graph.edge_id(self._node, neighbor) >= 0
+
+    def __iter__(self):
+        # Кратные рёбра в представлении networkx схлопываются в одно
+        return iter(dict.fromkeys(self._graph.neighbors(self._node).tolist()))
+
+    def __len__(self):
+        return len(np.unique(self._graph.neighbors(self._node)))
+
+    def items(self):
+        graph, node = self._graph, self._node
+        start, end = graph.indptr[node], graph.indptr[node + 1]
+        return [(v, _EdgeAttrs(graph, e)) for v, e in zip(graph.indices[start:end].tolist(),
+                                                          graph.edge_ids[start:end].tolist())]
+
+
+class _AdjacencyMap(_NodeMap):
+    __slots__ = ()
+
+    def __getitem__(self, node):
+        if not self.__contains__(node):
+            raise KeyError(node)
+        return _NeighborMap(self._graph, node)
+
+
+class NetworkXView(nx.Graph):
+    """
+    Неизменяемое представление CompactGraph через интерфейс networkx.Graph.
+    Вершины - целые 0..N-1 с атрибутами x, y, type (и name, id для POI),
+    рёбра - с атрибутами length, capacity, coast, type. Атрибуты читаются из массивов
+    CompactGraph при обращении, поэтому алгоритмы networkx работают без копии графа.
+    """
+
+    def __init__(self, graph):
+        self.compact = graph
+        self.graph = {'crs': graph.crs}
+        self._node = _NodeMap(graph)
+        self._adj = _AdjacencyMap(graph)
+        self.__networkx_cache__ = {}
+        nx.freeze(self)
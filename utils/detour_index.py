@@ -1,5 +1,16 @@
 import networkx as nx
+import numpy as np
+import pandas as pd
 from geopy.distance import geodesic
+from pyproj import CRS, Geod
+from scipy.sparse.csgraph import dijkstra
+
+from utils.compact_graph import as_compact
+from utils.path_index import path_index_of
+
+WGS84 = Geod(ellps='WGS84')
+# При индексе ALT источники с малым числом целей считаются A* по парам, остальные - одним Дейкстрой
+ALT_MAX_PAIRS_PER_SOURCE = 8
 
 
 def calculate_detour_index(graph, source, target, weight='length'):
@@ -16,8 +27,14 @@ def calculate_detour_index(graph, source, target, weight='length'):
         float: Детур индекс или None, если путь не существует.
     """
     try:
-        # Рассчитываем длину кратчайшего пути в графе
-        network_distance = nx.shortest_path_length(graph, source=source, target=target, weight=weight)
+        # Рассчитываем длину кратчайшего пути в графе (через индекс ALT, если он построен)
+        path_index = path_index_of(graph, weight=weight)
+        if path_index is None:
+            network_distance = nx.shortest_path_length(graph, source=source, target=target, weight=weight)
+        else:
+            network_distance = path_index.distance_between(source, target)
+            if not np.isfinite(network_distance):
+                return None
 
         # Рассчитываем евклидово расстояние на основе координат
         source_coords = (graph.nodes[source]['y'], graph.nodes[source]['x'])
@@ -31,3 +48,105 @@ def calculate_detour_index(graph, source, target, weight='length'):
     except (nx.NetworkXNoPath, nx.NodeNotFound):
         # Если пути нет или узлы не найдены, возвращаем None
         return None
+
+
+def network_matrix(graph, weight='length'):
+    """
+    CompactGraph, ключи вершин и матрица смежности с весом weight для любого графа дорожной сети.
+    Если атрибута нет в CompactGraph (например, 'traffic'), он берётся из рёбер networkx-графа
+    (рёбра без него получают вес 1, как в networkx); если его нет нигде - KeyError.
+    """
+    compact, keys = as_compact(graph)
+    if weight is not None and weight not in compact.edge_data:
+        # Колонку дописываем только в копию, построенную здесь из networkx-графа:
+        # у CompactGraph и NetworkXView рёбра - это сам общий граф
+        if keys is None:
+            raise KeyError(f'Атрибута рёбер {weight!r} нет в графе')
+        # Порядок рёбер совпадает с from_networkx
+        values = [data.get(weight) for _, _, data in graph.edges(data=True)]
+        if values and all(value is None for value in values):
+            raise KeyError(f'Атрибута рёбер {weight!r} нет в графе')
+        compact.edge_data[weight] = np.array([1 if value is None else value for value in values], dtype=np.float64)
+    return compact, keys, compact.csr_matrix(weight=weight)
+
+
+def straight_distances(compact, source_index, target_index):
+    """
+    Расстояния по прямой между вершинами CompactGraph: на эллипсоиде WGS84, как geodesic,
+    если координаты географические, и евклидовы, если граф в метрической проекции (compact.crs).
+    """
+    coords = compact.coords
+    source, target = coords[source_index], coords[target_index]
+    if CRS.from_user_input(compact.crs).is_geographic:
+        return WGS84.inv(source[:, 0], source[:, 1], target[:, 0], target[:, 1])[2]
+    return np.hypot(target[:, 0] - source[:, 0], target[:, 1] - source[:, 1])
+
+
+def node_indices(compact, keys, nodes):
+    """
+    Индексы вершин CompactGraph для списка ключей (-1 - вершины нет в графе).
+    """
+    if keys is None:
+        index = np.asarray(nodes, dtype=np.int64)
+        return np.where((index >= 0) & (index < compact.number_of_nodes()), index, -1)
+    position = {key: i for i, key in enumerate(keys)}
+    return np.fromiter((position.get(node, -1) for node in nodes), dtype=np.int64, count=len(nodes))
+
+
+def calculate_detour_indices(graph, sources, targets, weight='length', chunk_size=None, memory_budget=256 * 2 ** 20):
+    """
+    Детур индексы для массива пар источник - цель.
+
+    Пары группируются по источнику: на каждый уникальный источник один Дейкстра (scipy, пачками
+    источников, чтобы плотный блок расстояний пачка x N укладывался в memory_budget), прямые расстояния считаются векторно на эллипсоиде WGS84, как geodesic
+    (для графа в метрической проекции - евклидовы).
+
+    Параметры:
+        graph: CompactGraph, NetworkXView или networkx-граф дорожной сети.
+        sources, targets: массивы узлов одинаковой длины (ключи вершин графа).
+        weight (str): Атрибут рёбер, используемый как вес для расчета кратчайшего пути.
+        chunk_size (int): Сколько источников обрабатывать за один вызов Дейкстры (память - chunk_size x N
+            float64); None - выводится из memory_budget.
+        memory_budget (int): Предел памяти на блок расстояний одного вызова Дейкстры, байт.
+
+    Возвращает:
+        pandas.DataFrame с колонками source, target, network_distance, euclidean_distance, detour_index;
+        NaN там, где пути нет, узел не найден или узлы совпадают.
+    """
+    compact, keys, matrix = network_matrix(graph, weight=weight)
+    sources, targets = list(sources), list(targets)
+    source_index = node_indices(compact, keys, sources)
+    target_index = node_indices(compact, keys, targets)
+    known = np.flatnonzero((source_index >= 0) & (target_index >= 0))
+
+    network_distance = np.full(len(sources), np.nan)
+    unique_sources, group, per_source = np.unique(source_index[known], return_inverse=True, return_counts=True)
+    # Граф уже пройден целиком в network_matrix, поэтому число рёбер сверяем и у networkx-графа
+    path_index = path_index_of(graph, weight=weight, count_edges=True)
+    if path_index is not None:
+        # Редкие источники - A* по индексу, частые остаются для Дейкстры
+        sparse_pairs = per_source[group] <= ALT_MAX_PAIRS_PER_SOURCE
+        for pair in known[sparse_pairs].tolist():
+            network_distance[pair] = path_index.distance_by_index(int(source_index[pair]), int(target_index[pair]))
+        known_dense = known[~sparse_pairs]
+        unique_sources, group = np.unique(source_index[known_dense], return_inverse=True)
+    else:
+        known_dense = known
+    if chunk_size is None:
+        # Строка блока - расстояния от одного источника до всех N вершин (float64)
+        chunk_size = max(1, memory_budget // (8 * max(compact.number_of_nodes(), 1)))
+    for start in range(0, len(unique_sources), chunk_size):
+        chunk = unique_sources[start:start + chunk_size]
+        distance = dijkstra(matrix, directed=False, indices=chunk)
+        selected = (group >= start) & (group < start + len(chunk))
+        pairs = known_dense[selected]
+        network_distance[pairs] = distance[group[selected] - start, target_index[pairs]]
+    network_distance[np.isinf(network_distance)] = np.nan
+
+    euclidean_distance = np.full(len(sources), np.nan)
+    euclidean_distance[known] = straight_distances(compact, source_index[known], target_index[known])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        detour_index = np.where(euclidean_distance > 0, network_distance / euclidean_distance, np.nan)
+
+    return pd.DataFrame({'source': sources, 'target': targets, 'network_distance': network_distance,
+                         'euclidean_distance': euclidean_distance, 'detour_index': detour_index})
@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyproj import CRS
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from utils.compact_graph import CompactGraph, as_compact
+from utils.detour_index import straight_distances
+from utils.snapping import NodeIndex
+
+'''
+Карта детур индексов по городу: для каждой вершины-источника - средний детур до всех объектов
+типа node_type (или до случайных вершин), лежащих в пределах radius метров по сети.
+
+Источники упорядочиваются по кривой Мортона и режутся на пространственно компактные чанки.
+Путь длиной не больше radius не выходит из круга радиуса radius вокруг источника, поэтому
+Дейкстра для чанка идёт по подграфу вокруг его рамки, а не по всему городу. Чанки считаются
+в пуле процессов и пишутся отдельными Parquet-файлами; при повторном запуске готовые чанки пропускаются.
+
+Запуск из корня репозитория:
+    python -m utils.detour_surface --graph cache/graphs/<ключ> --type school --radius 1500 --output out/detour
+'''
+
+COLUMNS = ('node', 'targets', 'mean_detour', 'min_detour', 'nearest_distance')
+
+
+def _morton(tx, ty):
+    # Чередование битов номеров клеток: соседние клетки получают близкие коды
+    code = np.zeros(len(tx), dtype=np.int64)
+    for bit in range(21):
+        code |= ((tx >> bit) & 1) << (2 * bit)
+        code |= ((ty >> bit) & 1) << (2 * bit + 1)
+    return code
+
+
+def plan_chunks(xy, sources, radius, chunk_size):
+    """
+    Разбиение источников на чанки: сортировка по коду Мортона клеток со стороной radius.
+    :return: список массивов индексов вершин
+    """
+    cell = np.floor((xy[sources] - xy[sources].min(axis=0)) / radius).astype(np.int64)
+    order = np.argsort(_morton(cell[:, 0], cell[:, 1]), kind='stable')
+    sources = sources[order]
+    return [sources[start:start + chunk_size] for start in range(0, len(sources), chunk_size)]
+
+
+def _init_worker(state):
+    # Граф и индекс передаются в каждый процесс один раз и дальше только читаются
+    global _worker_state
+    _worker_state = state
+
+
+def surface_chunk(state, sources):
+    """
+    Детур индексы для чанка источников.
+    :param state: словарь с matrix, points, xy, tree, targets, radius, targets_per_source, seed
+    :param sources: индексы вершин-источников
+    :return: pyarrow.Table с колонками COLUMNS
+    """
+    xy, radius = state['xy'], state['radius']
+    low, high = xy[sources].min(axis=0), xy[sources].max(axis=0)
+    local = np.sort(np.asarray(state['tree'].query_ball_point((low + high) / 2,
+                                                              np.linalg.norm(high - low) / 2 + radius),
+                               dtype=np.int64))
+    matrix = state['matrix'][local][:, local]
+    distance = dijkstra(matrix, directed=False, indices=np.searchsorted(local, sources), limit=radius)
+
+    mask = np.isfinite(distance)
+    if state['targets'] is not None:
+        mask &= state['targets'][local][None, :]
+    mask[np.arange(len(sources)), np.searchsorted(local, sources)] = False
+    row, column = np.nonzero(mask)
+
+    if state['targets_per_source'] is not None and len(row):
+        # Случайная выборка целей для каждого источника (детерминированная по seed и номеру вершины)
+        rng = np.random.default_rng([state['seed'], int(sources[0])])
+        order = np.lexsort((rng.random(len(row)), row))
+        row, column = row[order], column[order]
+        start = np.searchsorted(row, row, side='left')
+        keep = np.arange(len(row)) - start < state['targets_per_source']
+        row, column = row[keep], column[keep]
+
+    origin, goal = sources[row], local[column]
+    straight = straight_distances(state['points'], origin, goal)
+    network = distance[row, column]
+    valid = straight > 0
+    row, network, detour = row[valid], network[valid], network[valid] / straight[valid]
+
+    count = np.bincount(row, minlength=len(sources))
+    total = np.bincount(row, weights=detour, minlength=len(sources))
+    smallest = np.full(len(sources), np.inf)
+    np.minimum.at(smallest, row, detour)
+    nearest = np.full(len(sources), np.inf)
+    np.minimum.at(nearest, row, network)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(count > 0, total / count, np.nan)
+    return pa.table({
+        'node': pa.array(sources, type=pa.int64()),
+        'targets': pa.array(count, type=pa.int64()),
+        'mean_detour': mean,
+        'min_detour': np.where(count > 0, smallest, np.nan),
+        'nearest_distance': np.where(count > 0, nearest, np.nan),
+    })
+
+
+def _run_chunk(args):
+    number, sources, path = args
+    table = surface_chunk(_worker_state, sources)
+    # Запись во временный файл и переименование: чанк либо записан целиком, либо отсутствует
+    tmp = path.with_suffix('.tmp')
+    pq.write_table(table, tmp)
+    os.replace(tmp, path)
+    return number, table.num_rows
+
+
+def detour_surface(G, output, node_type='school', radius=1500, weight='length', sources=None, sample=None,
+                   targets_per_source=None, chunk_size=256, workers=None, seed=0):
+    """
+    Карта детур индексов с потоковой записью в Parquet (по файлу на чанк) и продолжением с места остановки.
+    :param G: CompactGraph, NetworkXView или networkx-граф дорожной сети с привязанными объектами
+    :param output: каталог для part-*.parquet и meta.json
+    :param node_type: тип объектов-целей (None - все вершины в радиусе)
+    :param radius: предел расстояния по сети, м
+    :param weight: атрибут рёбер для кратчайших путей
+    :param sources: индексы вершин-источников (по умолчанию - все дорожные вершины)
+    :param sample: случайная выборка из sample источников
+    :param targets_per_source: случайная выборка целей для каждого источника
+    :param chunk_size: число источников в чанке
+    :param workers: число процессов (None - по числу ядер, 1 - без пула)
+    :param seed: зерно выборок
+    :return: список файлов чанков в порядке плана
+    """
+    graph, _ = as_compact(G)
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    if sources is None:
+        sources = graph.nodes_of_type('road')
+    sources = np.asarray(sources, dtype=np.int64)
+    if sample is not None and sample < len(sources):
+        sources = np.sort(np.random.default_rng(seed).choice(sources, sample, replace=False))
+
+    # Параметры запуска сохраняются: продолжать можно только тот же расчёт
+    meta = {'node_type': node_type, 'radius': radius, 'weight': weight, 'sample': sample, 'seed': seed,
+            'targets_per_source': targets_per_source, 'chunk_size': chunk_size,
+            'sources': len(sources), 'nodes': graph.number_of_nodes()}
+    meta_path = output / 'meta.json'
+    if meta_path.exists() and json.loads(meta_path.read_text()) != meta:
+        raise ValueError(f"{output} contains a run with different parameters.")
+    meta_path.write_text(json.dumps(meta))
+
+    if CRS.from_user_input(graph.crs).is_geographic:
+        index = NodeIndex.from_graph(graph, node_type=None)
+        xy, tree = index.xy, index.tree
+    else:
+        # Граф уже в метрической проекции: индекс строится прямо по его координатам
+        xy = np.asarray(graph.coords)
+        tree = cKDTree(xy)
+    state = {
+        'matrix': graph.csr_matrix(weight=weight), 'xy': xy,
+        # Вершины без рёбер: координаты и crs графа для прямых расстояний в процессах пула
+        'points': CompactGraph(graph.coords, crs=graph.crs),
+        'tree': tree, 'radius': radius, 'targets_per_source': targets_per_source, 'seed': seed,
+        'targets': None if node_type is None else graph.node_type == graph.node_types.index(node_type),
+    }
+    chunks = plan_chunks(xy, sources, radius, chunk_size)
+    paths = [output / f'part-{number:06d}.parquet' for number in range(len(chunks))]
+    tasks = [(number, chunk, path) for number, (chunk, path) in enumerate(zip(chunks, paths)) if not path.exists()]
+    print(f"{len(chunks) - len(tasks)} of {len(chunks)} chunks already done")
+
+    workers = workers or os.cpu_count()
+    done = len(chunks) - len(tasks)
+    if workers == 1:
+        _init_worker(state)
+        for task in tasks:
+            _run_chunk(task)
+            done += 1
+            print(f"chunk {task[0]} done ({done}/{len(chunks)})")
+    elif tasks:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(state,)) as pool:
+            for future in as_completed([pool.submit(_run_chunk, task) for task in tasks]):
+                number, _ = future.result()
+                done += 1
+                print(f"chunk {number} done ({done}/{len(chunks)})")
+    return paths
+
+
+def read_surface(output):
+    """
+    Собранная карта детур индексов из каталога detour_surface.
+    """
+    return pq.read_table(sorted(str(path) for path in Path(output).glob('part-*.parquet'))).to_pandas()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Карта детур индексов по городу')
+    parser.add_argument('--graph', required=True, help='каталог графа из GraphStore / save_graph')
+    parser.add_argument('--output', required=True, help='каталог для результатов')
+    parser.add_argument('--type', default='school', help="тип объектов ('none' - все вершины)")
+    parser.add_argument('--radius', type=float, default=1500)
+    parser.add_argument('--weight', default='length')
+    parser.add_argument('--sample', type=int, default=None)
+    parser.add_argument('--targets-per-source', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from utils.graph_store import load_graph
+
+    detour_surface(load_graph(args.graph), args.output, node_type=None if args.type == 'none' else args.type,
+                   radius=args.radius, weight=args.weight, sample=args.sample,
+                   targets_per_source=args.targets_per_source, chunk_size=args.chunk_size,
+                   workers=args.workers, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
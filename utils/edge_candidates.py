@@ -0,0 +1,151 @@
+import networkx as nx
+import numpy as np
+import pandas as pd
+from scipy.sparse.csgraph import dijkstra
+
+from utils.detour_index import network_matrix, node_indices, straight_distances
+
+
+class EdgeCandidates:
+    """
+    Оценка новых дорожек ("что если добавить ребро") по детур индексам набора пар источник - цель
+    без изменения исходного графа.
+
+    Деревья кратчайших путей строятся один раз из всех концов пар. Ребро (u, v) длины w может
+    только сократить путь, и только через себя: d'(s, t) = min(d(s, t), d(s, u) + w + d(v, t),
+    d(s, v) + w + d(u, t)), поэтому оценка кандидата - несколько векторных операций над
+    столбцами u и v деревьев, а не новый поиск.
+    """
+
+    def __init__(self, G, sources, targets, weight='length'):
+        """
+        :param G: CompactGraph, NetworkXView или networkx-граф дорожной сети; прямые расстояния
+            считаются в его crs (EPSG:4326 - на эллипсоиде, метрическая проекция - евклидовы)
+        :param sources: источники пар (ключи вершин)
+        :param targets: цели пар (ключи вершин)
+        :param weight: атрибут рёбер для кратчайших путей
+        """
+        self.graph, self.keys, self.matrix = network_matrix(G, weight=weight)
+        self.weight = weight
+        self.source_index = node_indices(self.graph, self.keys, list(sources))
+        self.target_index = node_indices(self.graph, self.keys, list(targets))
+        if (self.source_index < 0).any() or (self.target_index < 0).any():
+            raise nx.NodeNotFound("Some of the pair nodes are not in the graph.")
+
+        # Деревья из всех концов пар: строка дерева для источника и для цели каждой пары
+        self.ends, inverse = np.unique(np.concatenate([self.source_index, self.target_index]), return_inverse=True)
+        self.source_row, self.target_row = np.split(inverse, 2)
+        self.tree = dijkstra(self.matrix, directed=False, indices=self.ends)
+        self.base = self.tree[self.source_row, self.target_index]
+
+        self.straight = straight_distances(self.graph, self.source_index, self.target_index)
+        self.accepted = []
+
+    def _edges(self, u, v, length):
+        # Ключи концов рёбер в индексы; длина по умолчанию - расстояние между концами
+        u = node_indices(self.graph, self.keys, list(u) if self.keys is not None else list(np.atleast_1d(u)))
+        v = node_indices(self.graph, self.keys, list(v) if self.keys is not None else list(np.atleast_1d(v)))
+        if (u < 0).any() or (v < 0).any():
+            raise nx.NodeNotFound("Some of the candidate edge ends are not in the graph.")
+        if length is None:
+            length = straight_distances(self.graph, u, v)
+        return u, v, np.broadcast_to(np.asarray(length, dtype=np.float64), u.shape)
+
+    def _distances(self, u, v, length):
+        # Длины путей пар (пары, кандидаты) для рёбер, заданных индексами вершин
+        through_uv = self.tree[np.ix_(self.source_row, u)] + length + self.tree[np.ix_(self.target_row, v)]
+        through_vu = self.tree[np.ix_(self.source_row, v)] + length + self.tree[np.ix_(self.target_row, u)]
+        return np.minimum(self.base[:, None], np.minimum(through_uv, through_vu))
+
+    def distances(self, u, v, length=None):
+        """
+        Длины кратчайших путей всех пар после добавления каждого из рёбер по отдельности.
+        :param u: начала рёбер-кандидатов (ключи вершин)
+        :param v: концы рёбер-кандидатов
+        :param length: длины рёбер (None - расстояние между концами)
+        :return: массив (пары, кандидаты)
+        """
+        return self._distances(*self._edges(u, v, length))
+
+    def evaluate(self, u, v, length=None, chunk_size=1024):
+        """
+        Изменение детур индексов пар для каждого ребра-кандидата.
+        :param chunk_size: сколько кандидатов считать за раз (память - пары x chunk_size)
+        :return: DataFrame по кандидатам: u, v, length, improved_pairs (пар стало короче),
+            connected_pairs (пар, у которых появился путь), distance_gain (суммарное сокращение, м),
+            mean_detour_delta (среднее изменение детур индекса по парам с путём до и после)
+        """
+        u_index, v_index, lengths = self._edges(u, v, length)
+        reachable = np.isfinite(self.base)
+        measurable = reachable & (self.straight > 0)
+        base = self.base[:, None]
+        columns = {'improved_pairs': [], 'connected_pairs': [], 'distance_gain': [], 'mean_detour_delta': []}
+        for start in range(0, len(u_index), chunk_size):
+            part = slice(start, start + chunk_size)
+            new = self._distances(u_index[part], v_index[part], lengths[part])
+            columns['improved_pairs'].append((new < base).sum(axis=0))
+            columns['connected_pairs'].append((np.isinf(base) & np.isfinite(new)).sum(axis=0))
+            with np.errstate(invalid='ignore'):
+                gain = np.where(reachable[:, None], base - new, 0)
+            columns['distance_gain'].append(gain.sum(axis=0))
+            if measurable.any():
+                columns['mean_detour_delta'].append((-gain[measurable] / self.straight[measurable][:, None]).mean(axis=0))
+            else:
+                columns['mean_detour_delta'].append(np.full(new.shape[1], np.nan))
+
+        result = pd.DataFrame({'u': list(u) if self.keys is not None else u_index,
+                               'v': list(v) if self.keys is not None else v_index, 'length': lengths})
+        for name, parts in columns.items():
+            result[name] = np.concatenate(parts) if parts else np.empty(0)
+        return result
+
+    def rank(self, u, v, length=None, by='distance_gain'):
+        """
+        Кандидаты, отсортированные по убыванию пользы.
+        """
+        return self.evaluate(u, v, length).sort_values(by, ascending=by == 'mean_detour_delta', kind='stable')
+
+    def detour_index(self):
+        """
+        Текущие детур индексы пар (с учётом принятых рёбер); NaN, если пути нет.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            detour = self.base / self.straight
+        return np.where(np.isfinite(self.base) & (self.straight > 0), detour, np.nan)
+
+    def accept(self, u, v, length=None):
+        """
+        Принимает одно ребро: деревья и длины пар пересчитываются формулой через новое ребро
+        по двум Дейкстрам из его концов. Исходный граф не меняется, ребро хранится в self.accepted.
+        """
+        u_index, v_index, lengths = self._edges([u], [v], None if length is None else [length])
+        a, b, w = int(u_index[0]), int(v_index[0]), float(lengths[0])
+
+        # Матрица с принятым ребром нужна для деревьев из концов следующих рёбер
+        matrix = self.matrix.tolil()
+        current = matrix[a, b]
+        if current == 0 or w < current:
+            matrix[a, b] = matrix[b, a] = max(w, np.finfo(np.float64).tiny)
+        self.matrix = matrix.tocsr()
+
+        from_a, from_b = dijkstra(self.matrix, directed=False, indices=[a, b])
+        self.tree = np.minimum(self.tree, np.minimum(self.tree[:, [a]] + w + from_b[None, :],
+                                                     self.tree[:, [b]] + w + from_a[None, :]))
+        self.base = self.tree[self.source_row, self.target_index]
+        self.accepted.append((u, v, w))
+        return self.detour_index()
+
+    def greedy(self, u, v, length=None, count=1, by='distance_gain'):
+        """
+        Жадный выбор count рёбер: после каждого принятого кандидаты оцениваются заново.
+        :return: DataFrame принятых рёбер с оценками на момент выбора
+        """
+        chosen = []
+        for _ in range(count):
+            ranked = self.rank(u, v, length, by=by)
+            if not len(ranked) or ranked[by].iloc[0] == 0:
+                break
+            best = ranked.index[0]
+            chosen.append(ranked.loc[[best]])
+            self.accept(list(u)[best], list(v)[best], ranked.at[best, 'length'])
+        return pd.concat(chosen) if chosen else pd.DataFrame()
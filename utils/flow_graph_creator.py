@@ -2,10 +2,14 @@ import momepy
 from momepy.datasets import get_path
 import geopandas as gpd
 import networkx as nx
+import numpy as np
+import pandas as pd
+from scipy import sparse
 from geopy.distance import geodesic
 from shapely.geometry import Point
 from rtree import index
-import tqdm
+
+from utils.nearest_facility import NearestFacility
 
 '''
 Количество квартир умножаем на коэффициент 3
@@ -16,6 +20,12 @@ import tqdm
 '''
 
 
+# Доля населения дома, уходящая из узла в зависимости от сезона
+OUTFLOW_SHARE = {True: 0.6, False: 0.5}
+POPULATION_TYPES_SUMMER = {'school': 0.1, 'stop': 0.25, 'metro': 0.25}
+POPULATION_TYPES_WINTER = {'school': 0.1, 'stop': 0.3, 'metro': 0.3}
+
+
 def balance_dict(values):
     """
     Корректирует значения словаря так, чтобы их сумма была равна нулю,
@@ -27,12 +37,12 @@ def balance_dict(values):
     Returns:
         dict: Скорректированный словарь с суммой значений, равной нулю.
     """
-    total_sum = sum(values.values())
+    array = np.fromiter(values.values(), dtype=np.float64, count=len(values))
+    total_sum = array.sum()
 
     # Проверка, требуется ли корректировка
     if total_sum != 0:
-        adjustment = -total_sum / len(values)
-        values = {k: v + adjustment for k, v in values.items()}
+        values = dict(zip(values.keys(), (array - total_sum / len(values)).tolist()))
 
     return values
 
@@ -49,12 +59,139 @@ def shortest_path_to_type(graph,
     return None  # Если такой вершины нет
 
 
+def population_by_node(house_dataframe, facilities):
+    """
+    Население, приписанное к каждой вершине графа, одним группированием по 'Nearest_Node'.
+    :param house_dataframe: датафрейм домов с колонками 'Nearest_Node' и 'Population'
+    :param facilities: NearestFacility графа
+    :return: (население по индексам вершин (N,), индексы вершин-источников)
+    """
+    population = pd.to_numeric(house_dataframe['Population'], errors='coerce').fillna(0)
+    grouped = population.groupby(house_dataframe['Nearest_Node'].to_numpy(), sort=False).sum()
+    sources = facilities.indices_of(grouped.index.to_list())
+    totals = np.zeros(facilities.number_of_nodes)
+    totals[sources] = grouped.to_numpy(dtype=np.float64)
+    return totals, np.unique(sources)
+
+
+def demand_keys(facilities, sources, target_types):
+    """
+    Индексы вершин, для которых считается спрос: источники и все стоки целевых типов.
+    """
+    return np.union1d(sources, np.concatenate([facilities.sinks[node_type] for node_type in target_types]))
+
+
+def demand_vector(population, keys, facilities, target_types, population_types, outflow_share):
+    """
+    Сбалансированный вектор спроса по индексам вершин (ненулевой только в keys).
+    Каждый ключ отдаёт int(outflow_share * население), а ближайший объект каждого типа
+    получает int(population_types[тип] * население).
+    """
+    demand = np.zeros(len(population))
+    key_population = population[keys]
+    demand[keys] -= np.trunc(key_population * outflow_share)
+    for node_type in target_types:
+        target = facilities.nearest_many(keys, node_type)
+        reachable = target >= 0
+        np.add.at(demand, target[reachable], np.trunc(population_types[node_type] * key_population[reachable]))
+
+    # Баланс: сумма спроса по ключам равна нулю
+    demand[keys] -= demand[keys].sum() / len(keys) if len(keys) else 0
+    return demand
+
+
+class DemandScenarios:
+    """
+    Спросы для набора сценариев (сезон, коэффициенты population_types, множитель населения).
+
+    Поиск ближайших объектов, группирование населения и отображение вершин на их объекты
+    выполняются один раз в конструкторе; на каждый набор сценариев остаются только
+    поэлементные операции над матрицей сценарии x ключи и одно разреженное умножение на тип.
+    """
+
+    def __init__(self, G, house_dataframe, target_types=('school', 'stop', 'metro'), facilities=None):
+        """
+        :param G: граф с привязанными объектами
+        :param house_dataframe: датафрейм с ближайшими дорогами для домов
+        :param target_types: категории для стоков
+        :param facilities: готовый NearestFacility для G
+        """
+        self.target_types = tuple(target_types)
+        self.facilities = NearestFacility(G, target_types) if facilities is None else facilities
+        population, sources = population_by_node(house_dataframe, self.facilities)
+        self.index = demand_keys(self.facilities, sources, self.target_types)  # индексы вершин-ключей
+        self.keys = [self.facilities.key_of(key) for key in self.index.tolist()]
+        self.population = population[self.index]
+
+        # Для каждого типа: матрица (ключи x ключи), переносящая спрос ключа в его ближайший объект
+        self.routing = {}
+        for node_type in self.target_types:
+            target = self.facilities.nearest_many(self.index, node_type)
+            reachable = np.flatnonzero(target >= 0)
+            column = np.searchsorted(self.index, target[reachable])
+            self.routing[node_type] = sparse.csr_matrix(
+                (np.ones(len(reachable)), (reachable, column)), shape=(len(self.index), len(self.index)))
+
+    def table(self, scenarios):
+        """
+        Таблица сценариев с заполненными значениями по умолчанию.
+        :param scenarios: DataFrame или список словарей с колонками 'season' (True - лето),
+            'multiplier' (множитель населения), 'outflow' (доля уходящих) и коэффициентами по типам
+        """
+        table = pd.DataFrame(scenarios).reset_index(drop=True)
+        for column, default in (('season', True), ('multiplier', 1.0)):
+            table[column] = table[column].fillna(default) if column in table else default
+        table['season'] = table['season'].astype(bool)
+        if 'outflow' not in table:
+            table['outflow'] = np.nan
+        table['outflow'] = table['outflow'].fillna(table['season'].map(OUTFLOW_SHARE))
+        for node_type in self.target_types:
+            default = table['season'].map(lambda season: (POPULATION_TYPES_SUMMER if season else
+                                                          POPULATION_TYPES_WINTER)[node_type])
+            table[node_type] = table[node_type].fillna(default) if node_type in table else default
+        return table
+
+    def matrix(self, scenarios):
+        """
+        Сбалансированные спросы всех сценариев сразу, как demand_vector для каждой строки.
+        :param scenarios: таблица сценариев (см. table)
+        :return: массив (сценарии, ключи); столбцы соответствуют self.keys
+        """
+        table = self.table(scenarios)
+        population = table['multiplier'].to_numpy(dtype=np.float64)[:, None] * self.population[None, :]
+        demand = -np.trunc(population * table['outflow'].to_numpy(dtype=np.float64)[:, None])
+        for node_type in self.target_types:
+            share = table[node_type].to_numpy(dtype=np.float64)[:, None]
+            demand += np.asarray((self.routing[node_type].T @ np.trunc(share * population).T).T)
+
+        # Баланс: сумма спроса каждого сценария равна нулю
+        if len(self.index):
+            demand -= demand.sum(axis=1, keepdims=True) / len(self.index)
+        return demand
+
+    def demands(self, row):
+        """
+        Строка матрицы спросов в виде словаря {вершина: спрос} для FlowSolver.
+        """
+        return dict(zip(self.keys, np.asarray(row).tolist()))
+
+
+def scenario_demands(G, house_dataframe, scenarios, target_types=('school', 'stop', 'metro'), facilities=None):
+    """
+    Матрица спросов сценарии x вершины за один проход.
+    :return: (массив (сценарии, ключи), список вершин-ключей)
+    """
+    batch = DemandScenarios(G, house_dataframe, target_types=target_types, facilities=facilities)
+    return batch.matrix(scenarios), batch.keys
+
+
 def create_flow_graph(G,
                       house_dataframe,
                       target_types=('school', 'stop', 'metro'),
                       population_types_summer=None,
                       population_types_winter=None,
-                      season=True
+                      season=True,
+                      facilities=None
                       ):
     """
     Create a flow graph from a house df with counted population and nearest roads
@@ -64,63 +201,22 @@ def create_flow_graph(G,
     :param house_dataframe: датафрейм с ближайшими дорогами для домов
     :param target_types: категории для стоков
     :param season: пересчет в зависимости от погоды
+    :param facilities: готовый NearestFacility для G (переиспользуется между вызовами)
     :return: demands
     """
 
     if population_types_summer is None:
-        population_types_summer = {'school': 0.1,
-                                   'stop': 0.25,
-                                   'metro': 0.25}
+        population_types_summer = POPULATION_TYPES_SUMMER
     if population_types_winter is None:
-        population_types_winter = {'school': 0.1,
-                                   'stop': 0.3,
-                                   'metro': 0.3}
-
-    sources = set(house_dataframe['Nearest_Node'].to_list())  # Источники
-    sinks = set([node for node, data in G.nodes(data=True) if data['type'] in target_types])  # Стоки
-    demands_keys = sources | sinks
-    demands = dict.fromkeys(demands_keys, 0)
-    for key in tqdm.tqdm(demands_keys):
-        near = house_dataframe[house_dataframe['Nearest_Node'] == key]
-        near_list = near['Population'].to_list()
-        if season:
-            demands[key] -= int(sum(near_list) * 0.6)
-        else:
-            demands[key] -= int(sum(near_list) * 0.5)
-        if season:
-            population = sum(near['Population'].to_list())
-            target_nodes = dict.fromkeys(demands_keys, None)
-            for node_type in target_types:
-                target_nodes[node_type] = shortest_path_to_type(G, key, node_type)
-            for keys in target_types:
-                try:
-                    demands[target_nodes[keys]] += int(population_types_summer[keys] * population)
-                except:
-                    pass
-        else:
-            population = near['Population'].to_list()
-            target_nodes = dict.fromkeys(demands_keys, None)
-            for node_type in target_types:
-                target_nodes[node_type] = shortest_path_to_type(G, key, node_type)
-            for keys in target_types:
-                demands[target_nodes[keys]] += int(population_types_winter[keys] * population)
-
-    demands = balance_dict(demands)
-    return demands
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        population_types_winter = POPULATION_TYPES_WINTER
+    population_types = population_types_summer if season else population_types_winter
 
+    if facilities is None:
+        facilities = NearestFacility(G, target_types)
 
+    population, sources = population_by_node(house_dataframe, facilities)  # Источники
+    keys = demand_keys(facilities, sources, target_types)  # Источники и стоки
+    demand = demand_vector(population, keys, facilities, target_types, population_types, OUTFLOW_SHARE[season])
 
+    # Словарь только на выходе
+    return dict(zip((facilities.key_of(key) for key in keys.tolist()), demand[keys].tolist()))
@@ -0,0 +1,237 @@
+import networkx as nx
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import dijkstra, maximum_flow
+
+from utils.compact_graph import as_compact
+
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def integer_demands(values, scale=1.0):
+    """
+    Округляет дробные спросы (после balance_dict) до целых с сохранением нулевой суммы
+    методом наибольших остатков.
+    :param values: массив спросов
+    :param scale: множитель перед округлением (например, 10 - точность до 0.1 человека)
+    :return: массив целых спросов с суммой 0 (в масштабе scale)
+    """
+    scaled = np.asarray(values, dtype=np.float64) * scale
+    rounded = np.floor(scaled)
+    # Сколько единиц нужно добавить, чтобы сумма стала нулевой
+    missing = int(round(-rounded.sum()))
+    if missing > 0:
+        order = np.argsort(-(scaled - rounded), kind='stable')
+        rounded[order[:missing]] += 1
+    return rounded
+
+
+class FlowResult:
+    """
+    Результат расчёта потока: поток по рёбрам (положительный - от edge_u к edge_v),
+    потенциалы вершин (для тёплого старта), стоимость и неудовлетворённый спрос.
+    """
+
+    def __init__(self, solver, flow, potential, demand, unmet):
+        self.solver = solver
+        self.flow = flow
+        self.potential = potential
+        self.demand = demand
+        self.unmet = unmet
+        self.cost = float(np.sum(np.abs(flow) * solver.cost))
+
+    def edge_flows(self):
+        """
+        Потоки по рёбрам в виде словаря {(u, v): поток} с ключами вершин исходного графа.
+        """
+        graph, key = self.solver.graph, self.solver.key_of
+        return {(key(u), key(v)): f for u, v, f in zip(graph.edge_u.tolist(), graph.edge_v.tolist(),
+                                                       self.flow.tolist())}
+
+    def edge_loads(self):
+        """
+        Нагрузка на рёбра без учёта направления.
+        """
+        return np.abs(self.flow)
+
+
+class FlowSolver:
+    """
+    Поток минимальной стоимости на неориентированном графе дорог методом последовательных
+    кратчайших путей с потенциалами (primal-dual) на CSR-массивах.
+
+    На каждой итерации один многоисточниковый Дейкстра (scipy) по остаточной сети с приведёнными
+    стоимостями, затем максимальный поток (scipy, Диниц) сразу по всем кратчайшим путям -
+    дугам с нулевой приведённой стоимостью. Итераций столько, сколько различных длин путей.
+    Ребро (u, v) с пропускной способностью c допускает поток в обе стороны: |поток| <= c,
+    стоимость - |поток| * стоимость ребра.
+    """
+
+    def __init__(self, G, weight='coast', capacity='capacity'):
+        """
+        :param G: CompactGraph, NetworkXView или networkx-граф
+        :param weight: атрибут стоимости ребра ('coast' или 'length')
+        :param capacity: атрибут пропускной способности ребра
+        """
+        self.graph, self.keys = as_compact(G)
+        self.position = None if self.keys is None else {key: i for i, key in enumerate(self.keys)}
+        self.cost = np.asarray(self.graph.edge_data[weight], dtype=np.float64)
+        self.capacity = np.asarray(self.graph.edge_data[capacity], dtype=np.float64)
+        if (self.cost < 0).any():
+            raise ValueError("Edge costs must be non-negative.")
+
+        n = self.graph.number_of_nodes()
+        m = self.graph.number_of_edges()
+        # Дуги остаточной сети: 2e - из edge_u в edge_v, 2e + 1 - обратно
+        self.arc_edge = np.repeat(np.arange(m), 2)
+        self.arc_sign = np.tile([1.0, -1.0], m)
+        self.arc_tail = np.empty(2 * m, dtype=np.int64)
+        self.arc_head = np.empty(2 * m, dtype=np.int64)
+        self.arc_tail[0::2], self.arc_tail[1::2] = self.graph.edge_u, self.graph.edge_v
+        self.arc_head[0::2], self.arc_head[1::2] = self.graph.edge_v, self.graph.edge_u
+        self.n = n
+
+    def key_of(self, index):
+        return int(index) if self.keys is None else self.keys[index]
+
+    def demand_array(self, demands, scale=1.0):
+        """
+        Словарь спросов {вершина: спрос} в целочисленный массив по индексам вершин.
+        Отрицательный спрос - источник, положительный - сток (как в nx.network_simplex).
+        """
+        array = np.zeros(self.n)
+        nodes = list(demands)
+        index = np.asarray(nodes if self.position is None else [self.position[node] for node in nodes],
+                           dtype=np.int64)
+        array[index] = np.fromiter(demands.values(), dtype=np.float64, count=len(nodes))
+        return integer_demands(array, scale=scale)
+
+    def _residual(self, flow, potential, capacity):
+        """
+        Дуги остаточной сети: остаток и приведённая стоимость. Каждая дуга берётся в одном тарифе:
+        пока по ребру идёт встречный поток, дуга его отменяет (-c), после - несёт прямой поток (+c).
+        """
+        along = flow[self.arc_edge] * self.arc_sign  # поток по направлению дуги
+        cancel = along < 0
+        residual = np.where(cancel, -along, capacity[self.arc_edge] - along)
+        cost = np.where(cancel, -self.cost[self.arc_edge], self.cost[self.arc_edge])
+        reduced = np.maximum(cost + potential[self.arc_tail] - potential[self.arc_head], 0)
+        arcs = np.flatnonzero(residual > 0)
+        return arcs, residual[arcs], reduced[arcs]
+
+    def _distance_matrix(self, arcs, reduced):
+        """
+        CSR остаточной сети для Дейкстры: из параллельных дуг остаётся самая дешёвая.
+        Нулевые приведённые стоимости - полноценные рёбра, поэтому матрица собирается напрямую.
+        """
+        order = np.lexsort((reduced, self.arc_head[arcs], self.arc_tail[arcs]))
+        tail, head, reduced = self.arc_tail[arcs][order], self.arc_head[arcs][order], reduced[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (tail[1:] != tail[:-1]) | (head[1:] != head[:-1])
+        indptr = np.zeros(self.n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tail[first], minlength=self.n), out=indptr[1:])
+        return sparse.csr_matrix((reduced[first], head[first], indptr), shape=(self.n, self.n))
+
+    def _admissible_flow(self, arcs, residual, excess):
+        """
+        Максимальный поток по допустимым дугам (нулевая приведённая стоимость) из всех вершин
+        с избытком во все вершины с недостатком через общие исток и сток.
+        :return: (дуги, поток по ним)
+        """
+        source, sink = self.n, self.n + 1
+        supply = np.flatnonzero(excess < 0)
+        demand = np.flatnonzero(excess > 0)
+        tail = np.concatenate([self.arc_tail[arcs], np.full(len(supply), source), demand])
+        head = np.concatenate([self.arc_head[arcs], supply, np.full(len(demand), sink)])
+        total = -excess[supply].sum()
+        if total > INT32_MAX:
+            raise ValueError(f"Total supply {total:.0f} exceeds the int32 range of scipy maximum_flow; "
+                             f"use a smaller scale.")
+        capacity = np.concatenate([residual, -excess[supply], excess[demand]])
+        network = sparse.csr_matrix((np.floor(capacity), (tail, head)), shape=(self.n + 2, self.n + 2))
+        network.sum_duplicates()
+        # maximum_flow scipy работает только с int32; через любую дугу не пройдёт больше общего
+        # предложения, поэтому большие пропускные способности обрезаются до него без потери точности
+        network.data = np.minimum(network.data, total).astype(np.int32)
+        pushed = maximum_flow(network, source, sink, method='dinic').flow.tocoo()
+
+        # Поток по паре вершин раскладывается по её параллельным дугам по порядку
+        inner = (pushed.data > 0) & (pushed.row < self.n) & (pushed.col < self.n)
+        pairs = pushed.row[inner].astype(np.int64) * self.n + pushed.col[inner]
+        pair_order = np.argsort(pairs)
+        pairs, pair_flow = pairs[pair_order], pushed.data[inner][pair_order].astype(np.float64)
+        keys = self.arc_tail[arcs] * self.n + self.arc_head[arcs]
+        order = np.argsort(keys, kind='stable')
+        keys, arcs, residual = keys[order], arcs[order], residual[order]
+        found = np.minimum(np.searchsorted(pairs, keys), max(len(pairs) - 1, 0))
+        wanted = np.where(pairs[found] == keys, pair_flow[found], 0) if len(pairs) else np.zeros(len(keys))
+        before = np.cumsum(residual) - residual
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        before -= before[np.maximum.accumulate(np.where(first, np.arange(len(keys)), 0))]
+        amount = np.clip(wanted - before, 0, residual)
+        return arcs[amount > 0], amount[amount > 0]
+
+    def solve(self, demands, warm_start=None, scale=1.0, strict=False, max_rounds=None):
+        """
+        Поток минимальной стоимости, удовлетворяющий спросам.
+        :param demands: словарь {вершина: спрос} (например, из create_flow_graph) или массив по индексам
+        :param warm_start: FlowResult предыдущего расчёта с тем же scale; досчитывается только разница спросов
+        :param scale: множитель спросов и пропускных способностей перед округлением до целых
+        :param strict: бросать nx.NetworkXUnfeasible, если спрос нельзя удовлетворить
+        :param max_rounds: ограничение на число итераций Дейкстры
+        :return: FlowResult (поток в масштабе scale)
+        """
+        demand = self.demand_array(demands, scale) if isinstance(demands, dict) else \
+            integer_demands(demands, scale=scale)
+        capacity = np.floor(self.capacity * scale)
+        if warm_start is None:
+            flow = np.zeros(self.graph.number_of_edges())
+            potential = np.zeros(self.n)
+        else:
+            flow = warm_start.flow.copy()
+            potential = warm_start.potential.copy()
+
+        rounds = 0
+        while True:
+            # Остаток: сколько вершине ещё нужно получить (>0) или отправить (<0) при текущем потоке
+            excess = demand - np.bincount(self.graph.edge_v, weights=flow, minlength=self.n) + \
+                np.bincount(self.graph.edge_u, weights=flow, minlength=self.n)
+            if not (excess < 0).any() or not (excess > 0).any():
+                break
+            if max_rounds is not None and rounds >= max_rounds:
+                break
+            rounds += 1
+
+            arcs, residual, reduced = self._residual(flow, potential, capacity)
+            distance = dijkstra(self._distance_matrix(arcs, reduced), directed=True,
+                                indices=np.flatnonzero(excess < 0), min_only=True)
+            if not np.isfinite(distance[excess > 0]).any():
+                break
+            # Потенциалы сохраняют неотрицательность приведённых стоимостей,
+            # а все кратчайшие пути получают нулевую приведённую стоимость
+            finite = np.isfinite(distance)
+            potential += np.where(finite, distance, distance[finite].max())
+
+            # Дуги с недостижимым концом не участвуют: inf - inf дал бы NaN
+            reachable = finite[self.arc_tail[arcs]] & finite[self.arc_head[arcs]]
+            arcs, residual = arcs[reachable], residual[reachable]
+            reduced = reduced[reachable] + distance[self.arc_tail[arcs]] - distance[self.arc_head[arcs]]
+            admissible = reduced <= 1e-9 * max(1.0, float(np.abs(distance[finite]).max()))
+            moved, amount = self._admissible_flow(arcs[admissible], residual[admissible], excess)
+            if not len(moved):
+                break
+            np.add.at(flow, self.arc_edge[moved], amount * self.arc_sign[moved])
+
+        unmet = float(excess[excess > 0].sum())
+        if unmet > 0 and strict:
+            raise nx.NetworkXUnfeasible(f"Unmet demand {unmet} after {rounds} rounds.")
+        return FlowResult(self, flow, potential, demand, unmet)
+
+
+def solve_flow(G, demands, weight='coast', capacity='capacity', scale=1.0, strict=False):
+    """
+    Потоки по рёбрам графа для спросов create_flow_graph.
+    :return: словарь {(u, v): поток}
+    """
+    return FlowSolver(G, weight=weight, capacity=capacity).solve(demands, scale=scale, strict=strict).edge_flows()
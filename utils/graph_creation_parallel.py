@@ -1,10 +1,8 @@
 import momepy
-from momepy.datasets import get_path
 import geopandas as gpd
 import networkx as nx
-from geopy.distance import geodesic
-from shapely.geometry import Point
-from rtree import index
+
+from utils.snapping import NodeIndex, add_attachments, feature_points
 
 
 def create_road_graph(path):
@@ -26,18 +24,19 @@ def create_road_graph(path):
     # Создаем новый граф, содержащий только вершины и рёбра самой крупной компоненты
     G_largest = G.subgraph(largest_component).copy()
 
-    for node in G.nodes:
-        G.nodes[node]['type'] = 'road'
+    for node in G_largest.nodes:
+        G_largest.nodes[node]['type'] = 'road'
 
     return G_largest
 
 
-def add_nodes_to_graph(G, path, threshold, **kwarg):
+def add_nodes_to_graph(G, path, threshold, workers=None, **kwarg):
     """
-    Добавляем вершины в граф дорог (метро, остановки, школы)
+    Добавляем вершины в граф дорог (метро, остановки, школы), запросы к KD-дереву идут в нескольких потоках
     :param threshold: дистанция для присоединения к вершине
-    :param G: граф дорог
+    :param G: граф дорог (networkx или CompactGraph)
     :param path: путь до файла .shp
+    :param workers: число потоков запросов (None - по числу ядер, 1 - в одном потоке)
     :param kwarg: словарь с id, формой, названием, типом вершины
         stops : {id: TrStopId, geometry: geometry, name: Name, type: stop}
         metro : {id: Number, geometry: geometry, name: Text, type: metro}
@@ -48,113 +47,45 @@ def add_nodes_to_graph(G, path, threshold, **kwarg):
     df = gpd.read_file(path)
     df = df.to_crs(epsg=4326)
 
-    # Создаем индекс R-tree для всех точек в графе
-    idx = index.Index()
-
-    # Добавляем все вершины графа в индекс
-    for i, node in enumerate(G.nodes):
-        point = node  # точки в графе (x, y)
-        idx.insert(i, (point[0], point[1], point[0], point[1]))
+    # Индекс дорожных вершин в метрической проекции
+    idx = NodeIndex.from_graph(G)
 
     if kwarg['type'] != 'school':
-        G = paralell(G, df, threshold, idx, kwarg)
+        G = paralell(G, df, threshold, idx, kwarg, workers=workers)
 
     else:  # для школ
         df = df[df['Type'] == 'Школы']
         df = df.reset_index(drop=True)
-        for i in range(len(df)):
-            centroid = df.loc[i]['geometry'].centroid  # получаем центр школы
-            G.add_node((centroid.x, centroid.y), type=kwarg['type'], name=df.loc[i][kwarg['name']],
-                       id=df.loc[i][kwarg['id']])
-            print(i)
-            # Ищем ближайшие вершины в графе с помощью индекса
-            possible_matches_index = list(idx.nearest((centroid.x, centroid.y, centroid.x, centroid.y), 20))
-
-            matches_found = False
-            for j in possible_matches_index:
-                neighbor = list(G.nodes)[j]
-                distance = geodesic((centroid.y, centroid.x), (neighbor[1], neighbor[0])).meters
-                if distance < threshold and G.nodes[neighbor].get('type', None) == 'road':
-                    G.add_edge((centroid.x, centroid.y), neighbor)
-                    matches_found = True
-
-            # Если не нашли, присоединяем ближайшую вершину
-            if not matches_found:
-                min_distance = float('inf')
-                nearest_node = None
-                for j in range(len(list(G.nodes))):
-                    neighbor = list(G.nodes)[j]
-                    distance = geodesic((centroid.y, centroid.x), (neighbor[1], neighbor[0])).meters
-                    if distance < min_distance:
-                        min_distance = distance
-                        nearest_node = neighbor
-                if nearest_node:
-                    G.add_edge((centroid.x, centroid.y), nearest_node)
+        G = paralell_centroid(G, df, threshold, idx, kwarg, workers=workers)
 
     return G
 
 
-def paralell(G, df, threshold, idx, kwarg):
-    for i in range(len(df)):
-        point = df.loc[i]['geometry']  # получаем точку для каждого объекта в .shp
-        G.add_node((point.x, point.y), type=kwarg['type'], name=df.loc[i][kwarg['name']], id=df.loc[i][kwarg['id']])
-
-        # Ищем ближайшие вершины в графе с помощью индекса
-        possible_matches_index = list(idx.nearest((point.x, point.y, point.x, point.y), 20))
-
-        # Смотрим на все вершины, которые находятся в радиусе 100 метров
-        matches_found = False  # флаг для проверки, нашли ли подходящие вершины
-        for j in possible_matches_index:
-            neighbor = list(G.nodes)[j]  # Получаем точку из графа
-            distance = geodesic((point.y, point.x), (neighbor[1], neighbor[0])).meters  # Вычисляем расстояние
-            if distance < threshold and G.nodes[neighbor].get('type', None) == 'road':
-                G.add_edge((point.x, point.y), neighbor)
-                matches_found = True  # нашли подходящее ребро
-
-        # Если не нашли, присоединяем ближайшую вершину
-        if not matches_found:
-            # Ищем ближайшую вершину в графе
-            min_distance = float('inf')
-            nearest_node = None
-            for j in range(len(list(G.nodes))):
-                neighbor = list(G.nodes)[j]
-                distance = geodesic((point.y, point.x), (neighbor[1], neighbor[0])).meters
-                if distance < min_distance:
-                    min_distance = distance
-                    nearest_node = neighbor
-            # Добавляем ближайшее ребро
-            if nearest_node:
-                G.add_edge((point.x, point.y), nearest_node)
-    return G
+def attach_edges(idx, xy, threshold, workers=None, k=20):
+    """
+    Считает рёбра привязки для точек xy. Запросы к cKDTree распараллеливаются внутри процесса
+    (cKDTree.query(workers=...)), без копирования индекса в процессы; результат от числа потоков
+    не зависит и совпадает с idx.snap(xy, threshold, k).
+    :param idx: NodeIndex дорожных вершин
+    :param xy: координаты точек (K, 2) в проекции индекса
+    :param threshold: дистанция для присоединения к вершине, м
+    :param workers: число потоков (None - по числу ядер, 1 - в одном потоке)
+    :param k: число кандидатов на точку
+    :return: массивы (номер точки, позиция вершины в индексе, расстояние в метрах)
+    """
+    return idx.snap(xy, threshold, k=k, workers=-1 if workers is None else workers)
 
 
-def paralell_centroid(G, df, threshold, idx, kwarg):
-    for i in range(len(df)):
-        centroid = df.loc[i]['geometry'].centroid  # получаем центр школы
-        G.add_node((centroid.x, centroid.y), type=kwarg['type'], name=df.loc[i][kwarg['name']],
-                   id=df.loc[i][kwarg['id']])
-        print(i)
-        # Ищем ближайшие вершины в графе с помощью индекса
-        possible_matches_index = list(idx.nearest((centroid.x, centroid.y, centroid.x, centroid.y), 20))
-
-        matches_found = False
-        for j in possible_matches_index:
-            neighbor = list(G.nodes)[j]
-            distance = geodesic((centroid.y, centroid.x), (neighbor[1], neighbor[0])).meters
-            if distance < threshold and G.nodes[neighbor].get('type', None) == 'road':
-                G.add_edge((centroid.x, centroid.y), neighbor)
-                matches_found = True
-
-        # Если не нашли, присоединяем ближайшую вершину
-        if not matches_found:
-            min_distance = float('inf')
-            nearest_node = None
-            for j in range(len(list(G.nodes))):
-                neighbor = list(G.nodes)[j]
-                distance = geodesic((centroid.y, centroid.x), (neighbor[1], neighbor[0])).meters
-                if distance < min_distance:
-                    min_distance = distance
-                    nearest_node = neighbor
-            if nearest_node:
-                G.add_edge((centroid.x, centroid.y), nearest_node)
-    return G
+def paralell(G, df, threshold, idx, kwarg, workers=None, centroid=False):
+    """
+    Привязка объектов df к графу: рёбра считаются пачкой в нескольких потоках, граф меняется один раз в конце
+    :param idx: NodeIndex дорожных вершин графа
+    :param centroid: привязывать центроиды геометрий
+    """
+    xy, lonlat = feature_points(df, idx.crs, centroid=centroid)
+    point, position, distance = attach_edges(idx, xy, threshold, workers=workers)
+    return add_attachments(G, df, lonlat, idx.nodes, point, position, distance, **kwarg)
+
+
+def paralell_centroid(G, df, threshold, idx, kwarg, workers=None):
+    return paralell(G, df, threshold, idx, kwarg, workers=workers, centroid=True)
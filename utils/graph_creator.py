@@ -6,14 +6,33 @@ from geopy.distance import geodesic
 from shapely.geometry import Point
 from rtree import index
 
+from utils.compact_graph import CompactGraph
+from utils.road_ingest import ingest_road_graph
+from utils.snapping import snap_features
+
+
+def create_road_graph(path, compact=False, crs=32633, foot=1):
+    """
+    Строим граф пешеходных дорог (самую крупную компоненту связности)
+    :param path: путь до файла .shp с дорогами
+    :param compact: вернуть CompactGraph с целочисленными вершинами вместо networkx-графа;
+        граф строится быстрым чтением через Arrow (utils.road_ingest)
+    :param crs: EPSG метрической проекции для длин рёбер (в обоих режимах длина - плоская длина в этой проекции)
+    :param foot: значение колонки 'Foot' у пешеходных дорог
+    :return: граф дорог
+    """
+    if compact:
+        return ingest_road_graph(path, foot=foot, length_crs=crs)
 
-def create_road_graph(path):
     roads = gpd.read_file(path)
     # Преобразуем данные в проекцию, которая использует метры (например, EPSG:32633)
-    roads = roads.to_crs(epsg=32633)
+    roads = roads.to_crs(epsg=crs)
 
     # Фильтрация дорог, где колонка 'Foot' равна 1 (пешеходные дороги)
-    roads_filtered = roads[roads['Foot'] == 1]
+    roads_filtered = roads[roads['Foot'] == foot].copy()
+
+    # Длина ребра в метрах, пока данные в метрической проекции
+    roads_filtered['length'] = roads_filtered.geometry.length
 
     # Преобразуем обратно в EPSG:4326 для отображения на карте
     roads_filtered = roads_filtered.to_crs(epsg=4326)
@@ -40,12 +59,14 @@ def create_road_graph(path):
     return G_largest
 
 
-def add_nodes_to_graph(G, path, threshold, **kwarg):
+def add_nodes_to_graph(G, path, threshold, bulk=False, **kwarg):
     """
     Добавляем вершины в граф дорог (метро, остановки, школы)
     :param threshold: дистанция для присоединения к вершине
     :param G: граф дорог
     :param path: путь до файла .shp
+    :param bulk: привязать все объекты одним векторизованным запросом к KD-дереву
+        дорожных вершин в метрической проекции (обязательно для CompactGraph)
     :param kwarg: словарь с id, формой, названием, типом вершины
         stops : {id: TrStopId, geometry: geometry, name: Name, type: stop}
         metro : {id: Number, geometry: geometry, name: Text, type: metro}
@@ -56,11 +77,18 @@ def add_nodes_to_graph(G, path, threshold, **kwarg):
     df = gpd.read_file(path)
     df = df.to_crs(epsg=4326)
 
+    if bulk or isinstance(G, CompactGraph):
+        centroid = kwarg['type'] == 'school'
+        if centroid:
+            df = df[df['Type'] == 'Школы'].reset_index(drop=True)
+        return snap_features(G, df, threshold, centroid=centroid, **kwarg)
+
     # Создаем индекс R-tree для всех точек в графе
     idx = index.Index()
 
     # Добавляем все вершины графа в индекс
-    for i, node in enumerate(G.nodes):
+    nodes = list(G.nodes)  # индексы R-tree соответствуют позициям в этом списке
+    for i, node in enumerate(nodes):
         point = node  # точки в графе (x, y)
         idx.insert(i, (point[0], point[1], point[0], point[1]))
 
@@ -76,7 +104,7 @@ def add_nodes_to_graph(G, path, threshold, **kwarg):
             # Смотрим на все вершины, которые находятся в радиусе 100 метров
             matches_found = False  # флаг для проверки, нашли ли подходящие вершины
             for j in possible_matches_index:
-                neighbor = list(G.nodes)[j]  # Получаем точку из графа
+                neighbor = nodes[j]  # Получаем точку из графа
                 distance = geodesic((point.y, point.x), (neighbor[1], neighbor[0])).meters  # Вычисляем расстояние
                 if distance < threshold:
                     G.add_edge((point.x, point.y), neighbor, coast=0, capacity=800)
@@ -87,8 +115,7 @@ def add_nodes_to_graph(G, path, threshold, **kwarg):
                 # Ищем ближайшую вершину в графе
                 min_distance = float('inf')
                 nearest_node = None
-                for j in range(len(list(G.nodes))):
-                    neighbor = list(G.nodes)[j]
+                for neighbor in list(G.nodes):
                     distance = geodesic((point.y, point.x), (neighbor[1], neighbor[0])).meters
                     if distance < min_distance:
                         min_distance = distance
@@ -111,7 +138,7 @@ def add_nodes_to_graph(G, path, threshold, **kwarg):
 
             matches_found = False
             for j in possible_matches_index:
-                neighbor = list(G.nodes)[j]
+                neighbor = nodes[j]
                 distance = geodesic((centroid.y, centroid.x), (neighbor[1], neighbor[0])).meters
                 if distance < threshold:
                     G.add_edge((centroid.x, centroid.y), neighbor, coast=0, capacity=800)
@@ -121,8 +148,7 @@ def add_nodes_to_graph(G, path, threshold, **kwarg):
             if not matches_found:
                 min_distance = float('inf')
                 nearest_node = None
-                for j in range(len(list(G.nodes))):
-                    neighbor = list(G.nodes)[j]
+                for neighbor in list(G.nodes):
                     distance = geodesic((centroid.y, centroid.x), (neighbor[1], neighbor[0])).meters
                     if distance < min_distance:
                         min_distance = distance
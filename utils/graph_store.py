@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils.compact_graph import CompactGraph
+from utils.graph_creator import add_nodes_to_graph, create_road_graph
+from utils.nearest_facility import NearestFacility
+from utils.path_index import LandmarkIndex
+
+# Модули, от кода которых зависит построенный граф: их изменение сбрасывает кэш
+SOURCE_FILES = ('compact_graph.py', 'snapping.py', 'graph_creator.py', 'road_ingest.py')
+SHAPEFILE_PARTS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+
+def code_version():
+    """
+    Хэш исходников, участвующих в построении графа.
+    """
+    digest = hashlib.sha256()
+    for name in SOURCE_FILES:
+        digest.update((Path(__file__).parent / name).read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    Хэш содержимого входного файла; для .shp учитываются и сопутствующие файлы (.dbf, .prj, ...).
+    """
+    path = Path(path)
+    parts = [path.with_suffix(suffix) for suffix in SHAPEFILE_PARTS] if path.suffix == '.shp' else [path]
+    digest = hashlib.sha256()
+    for part in parts:
+        if not part.exists():
+            continue
+        digest.update(part.suffix.encode())
+        with open(part, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def graph_key(roads_path, layers=(), crs=32633, foot=1):
+    """
+    Ключ графа: хэш входных файлов, проекции, фильтра 'Foot', порогов привязки и версии кода.
+    :param roads_path: путь до .shp с дорогами
+    :param layers: слои объектов [{'path': ..., 'threshold': ..., 'id': ..., 'name': ..., 'type': ...}, ...]
+    """
+    description = {
+        'roads': file_digest(roads_path),
+        'crs': crs,
+        'foot': foot,
+        'layers': [dict(layer, path=file_digest(layer['path'])) for layer in layers],
+        'code': code_version(),
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+
+def save_graph(graph, directory):
+    """
+    Сохраняет CompactGraph в каталог: числовые массивы - в .npy, атрибуты вершин - в Parquet.
+    Запись идёт во временный каталог и атомарно переименовывается.
+    """
+    directory = Path(directory)
+    directory.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(dir=directory.parent, prefix='.' + directory.name))
+    try:
+        for name, array in graph.arrays().items():
+            np.save(tmp / (name + '.npy'), np.ascontiguousarray(array))
+        if graph.node_data:
+            table = pa.table({key: _arrow_column(col) for key, col in graph.node_data.items()})
+            pq.write_table(table, tmp / 'node_data.parquet')
+        meta = {'crs': graph.crs, 'length_crs': graph.length_crs, 'node_types': graph.node_types,
+                'edge_types': graph.edge_types}
+        (tmp / 'meta.json').write_text(json.dumps(meta))
+        os.rename(tmp, directory)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not directory.exists():
+            raise
+
+
+def _arrow_column(column):
+    # Колонки с разнотипными значениями (например, id-строки и id-числа) сохраняем строками
+    try:
+        return pa.array(column.tolist())
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if value is None else str(value) for value in column.tolist()])
+
+
+def load_graph(directory, mmap=True):
+    """
+    Загружает CompactGraph из каталога save_graph.
+    :param mmap: отображать массивы в память (только чтение, страницы общие для всех процессов)
+    """
+    directory = Path(directory)
+    meta = json.loads((directory / 'meta.json').read_text())
+    arrays = {path.stem: np.load(path, mmap_mode='r' if mmap else None) for path in directory.glob('*.npy')}
+    node_data = {}
+    if (directory / 'node_data.parquet').exists():
+        table = pq.read_table(directory / 'node_data.parquet')
+        node_data = {key: np.array(table.column(key).to_pylist(), dtype=object) for key in table.column_names}
+    graph = CompactGraph.from_arrays(arrays, meta['node_types'], meta['edge_types'], node_data, meta['crs'],
+                                     length_crs=meta.get('length_crs'))
+    # Индекс кратчайших путей, если он был построен для этого графа
+    for path in sorted(directory.glob('landmarks_*')):
+        if (path / 'meta.json').exists():
+            LandmarkIndex.load(path, graph, mmap=mmap)
+    return graph
+
+
+class GraphStore:
+    """
+    Кэш построенных графов на диске, адресуемый по содержимому входных данных.
+    """
+
+    def __init__(self, root='cache/graphs'):
+        self.root = Path(root)
+
+    def path(self, key):
+        return self.root / key
+
+    def __contains__(self, key):
+        return (self.path(key) / 'meta.json').exists()
+
+    def load(self, key, mmap=True):
+        return load_graph(self.path(key), mmap=mmap) if key in self else None
+
+    def save(self, key, graph):
+        if key not in self:
+            save_graph(graph, self.path(key))
+
+    def get_or_build(self, roads_path, layers=(), crs=32633, foot=1, mmap=True):
+        """
+        Граф дорог с привязанными объектами: из кэша, если входные данные не менялись, иначе строится
+        через create_road_graph + add_nodes_to_graph и сохраняется.
+        :param roads_path: путь до .shp с дорогами
+        :param layers: слои объектов [{'path': ..., 'threshold': ..., 'id': ..., 'name': ..., 'type': ...}, ...]
+        :param crs: EPSG метрической проекции (для графа networkx; здесь входит в ключ)
+        :param foot: значение колонки 'Foot' у пешеходных дорог
+        :param mmap: отображать массивы кэша в память
+        :return: CompactGraph
+        """
+        key = graph_key(roads_path, layers, crs=crs, foot=foot)
+        graph = self.load(key, mmap=mmap)
+        if graph is not None:
+            return graph
+
+        graph = create_road_graph(roads_path, compact=True, crs=crs, foot=foot)
+        for layer in layers:
+            layer = dict(layer)
+            graph = add_nodes_to_graph(graph, layer.pop('path'), layer.pop('threshold'), **layer)
+        self.save(key, graph)
+        return self.load(key, mmap=mmap)
+
+    def facilities(self, key, graph, target_types=('school', 'stop', 'metro'), weight=None):
+        """
+        Разбиение NearestFacility для графа key: из каталога графа или строится и сохраняется рядом с ним.
+        :param graph: граф, загруженный по ключу key
+        """
+        directory = self.path(key) / ('facilities_' + '_'.join(target_types) + '_' + (weight or 'hops'))
+        if (directory / 'meta.json').exists():
+            return NearestFacility.load(directory, graph)
+        facilities = NearestFacility(graph, target_types, weight=weight)
+        facilities.save(directory)
+        return facilities
+
+    def build_path_index(self, key, graph, n_landmarks=16, weight='length'):
+        """
+        Строит LandmarkIndex для графа key, сохраняет его рядом с графом и привязывает к graph;
+        при следующих load_graph индекс подхватывается автоматически.
+        """
+        index = LandmarkIndex.build(graph, n_landmarks=n_landmarks, weight=weight)
+        index.save(self.path(key) / f'landmarks_{weight}')
+        return index
@@ -0,0 +1,257 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+from utils.road_ingest import lines_to_graph
+from utils.snapping import NodeIndex, add_attachments, feature_points
+
+DEFAULT_THRESHOLDS = {'stop': 60, 'metro': 100, 'school': 60}
+
+
+class DynamicNodeIndex(NodeIndex):
+    """
+    NodeIndex с вставкой и удалением вершин без перестроения дерева на каждое изменение.
+    Новые вершины копятся в хвосте массивов и проверяются перебором, удалённые помечаются в alive;
+    когда изменений накапливается больше rebuild_fraction от размера индекса, дерево строится заново.
+    """
+
+    def __init__(self, nodes, coords, crs, rebuild_fraction=0.1):
+        super().__init__(np.asarray(nodes, dtype=np.int64), coords, crs)
+        self.rebuild_fraction = rebuild_fraction
+        self.alive = np.ones(len(self.nodes), dtype=bool)
+        self.n_indexed = len(self.nodes)  # сколько первых вершин покрыто деревом
+
+    def pending(self):
+        return len(self.nodes) - self.n_indexed + int((~self.alive[:self.n_indexed]).sum())
+
+    def insert(self, nodes, coords):
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        xy = np.column_stack(self.to_metric.transform(coords[:, 0], coords[:, 1]))
+        self.nodes = np.concatenate([self.nodes, np.asarray(nodes, dtype=np.int64)])
+        self.xy = np.concatenate([self.xy, xy])
+        self.alive = np.concatenate([self.alive, np.ones(len(xy), dtype=bool)])
+        self._maybe_rebuild()
+
+    def remove(self, nodes):
+        self.alive[np.isin(self.nodes, nodes)] = False
+        self._maybe_rebuild()
+
+    def _maybe_rebuild(self):
+        if self.pending() > self.rebuild_fraction * max(len(self.nodes), 1):
+            self.nodes = self.nodes[self.alive]
+            self.xy = self.xy[self.alive]
+            self.alive = np.ones(len(self.nodes), dtype=bool)
+            self.tree = cKDTree(self.xy)
+            self.n_indexed = len(self.nodes)
+
+    def snap(self, xy, threshold, k=20, workers=1):
+        """
+        То же, что NodeIndex.snap, с учётом вставленных и удалённых вершин.
+        """
+        if not self.pending():
+            return super().snap(xy, threshold, k=k, workers=workers)
+
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        tail = np.arange(self.n_indexed, len(self.nodes))[self.alive[self.n_indexed:]]
+        tail_distance = np.linalg.norm(xy[:, None, :] - self.xy[tail][None, :, :], axis=-1)
+        dead = int((~self.alive[:self.n_indexed]).sum())
+
+        point_ids, positions, distances = [], [], []
+        for i, candidates in enumerate(self.tree.query_ball_point(xy, threshold)):
+            candidates = np.asarray(candidates, dtype=np.int64)
+            candidates = candidates[self.alive[candidates]]
+            distance = np.concatenate([np.linalg.norm(self.xy[candidates] - xy[i], axis=1), tail_distance[i]])
+            candidates = np.concatenate([candidates, tail])
+            found = distance < threshold
+            if found.any():
+                order = np.argsort(distance[found], kind='stable')[:k]
+                positions.append(candidates[found][order])
+                distances.append(distance[found][order])
+            else:
+                # Ближайшая живая вершина: в дереве среди dead + 1 ближайших она гарантированно есть
+                tree_distance, tree_position = self.tree.query(xy[i], k=min(dead + 1, self.n_indexed))
+                tree_distance, tree_position = np.atleast_1d(tree_distance), np.atleast_1d(tree_position)
+                keep = self.alive[tree_position]
+                distance = np.concatenate([tree_distance[keep][:1], tail_distance[i]])
+                candidates = np.concatenate([tree_position[keep][:1], tail])
+                best = np.argmin(distance)
+                positions.append(candidates[best:best + 1])
+                distances.append(distance[best:best + 1])
+            point_ids.append(np.full(len(positions[-1]), i))
+
+        if not point_ids:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, np.empty(0)
+        return np.concatenate(point_ids), np.concatenate(positions), np.concatenate(distances)
+
+
+class GraphEditor:
+    """
+    Инкрементальные изменения CompactGraph: добавление и удаление дорог и объектов (POI)
+    без полного перестроения графа.
+
+    После каждого изменения заново привязываются только объекты, в окрестности которых
+    поменялся набор дорожных вершин. Вершины, у которых изменились инцидентные рёбра,
+    накапливаются в dirty, чтобы последующие этапы пересчитывали только их.
+    Удалённые вершины не перенумеровываются, а получают тип 'removed' и остаются изолированными.
+    Длины новых дорог считаются так же, как у базового графа (graph.length_crs). Рёбра меняются
+    через add_edges / remove_edges, поэтому CSR графа пересобирается один раз перед следующим чтением,
+    а не после каждой правки.
+    """
+
+    def __init__(self, graph, thresholds=None, k=20, crs=None):
+        """
+        :param graph: CompactGraph с уже привязанными объектами
+        :param thresholds: дистанции привязки по типам объектов {'stop': 60, ...}, м
+        :param k: число кандидатов на объект, как в add_nodes_to_graph
+        :param crs: метрическая проекция индекса (по умолчанию - зона UTM графа)
+        """
+        self.graph = graph
+        self.k = k
+        self.thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+        self.index = DynamicNodeIndex.from_graph(graph, crs=crs)
+        self.dirty = set()
+
+        skip = [graph.node_types.index(name) for name in ('road', 'removed')]
+        pois = np.flatnonzero(~np.isin(graph.node_type, skip))
+        self.poi_threshold = {int(node): self.thresholds.get(graph.type_of(node), 60) for node in pois}
+
+    def pop_dirty(self):
+        """
+        Изменённые с прошлого вызова вершины (отсортированный массив); список сбрасывается.
+        """
+        dirty = np.array(sorted(self.dirty), dtype=np.int64)
+        self.dirty.clear()
+        return dirty
+
+    # --- дороги ---
+
+    def add_roads(self, lines, tolerance=0.01):
+        """
+        Добавляет дороги; концы, совпадающие с существующими дорожными вершинами
+        (ближе tolerance метров), сливаются с ними.
+        :param lines: LineString в EPSG:4326 (массив или GeoSeries)
+        :return: индексы новых рёбер
+        """
+        lines = np.asarray(getattr(lines, 'values', lines))
+        piece = lines_to_graph(lines, 'EPSG:4326', length_crs=self.graph.length_crs)
+        xy = np.column_stack(self.index.to_metric.transform(piece.coords[:, 0], piece.coords[:, 1]))
+
+        mapping = np.full(piece.number_of_nodes(), -1, dtype=np.int64)
+        if len(self.index.nodes):
+            point, position, distance = self.index.snap(xy, tolerance, k=1)
+            close = distance < tolerance
+            mapping[point[close]] = self.index.nodes[position[close]]
+        fresh = np.flatnonzero(mapping < 0)
+        mapping[fresh] = self.graph.add_nodes(piece.coords[fresh], node_type='road')
+        self.index.insert(mapping[fresh], piece.coords[fresh])
+
+        u, v = mapping[piece.edge_u], mapping[piece.edge_v]
+        edges = self.graph.add_edges(u, v, length=piece.edge_data['length'], edge_type='road')
+        self.dirty.update(u.tolist())
+        self.dirty.update(v.tolist())
+
+        # Новые вершины могут стать кандидатами для соседних объектов
+        self._resnap(self._affected_pois(mapping[fresh]))
+        return edges
+
+    def remove_roads(self, edges):
+        """
+        Удаляет дорожные рёбра по индексам (индексы остальных рёбер после этого сдвигаются).
+        Вершины, у которых не осталось дорожных рёбер, исключаются из привязки,
+        а объекты, привязанные к ним, привязываются заново.
+        """
+        edges = np.asarray(edges, dtype=np.int64)
+        ends = np.unique(np.concatenate([self.graph.edge_u[edges], self.graph.edge_v[edges]]))
+        self.graph.remove_edges(edges)
+        self.dirty.update(ends.tolist())
+
+        road_edge = self.graph.edge_type == self.graph.edge_types.index('road')
+        road_degree = np.bincount(np.concatenate([self.graph.edge_u[road_edge], self.graph.edge_v[road_edge]]),
+                                  minlength=self.graph.number_of_nodes())
+        orphans = ends[road_degree[ends] == 0]
+        orphans = orphans[self.graph.node_type[orphans] == self.graph.node_types.index('road')]
+        if not len(orphans):
+            return
+        self.graph.set_node_type(orphans, 'removed')
+        self.index.remove(orphans)
+        attached = np.unique(np.concatenate([self.graph.neighbors(node) for node in orphans]))
+        self._resnap([node for node in attached.tolist() if node in self.poi_threshold])
+
+    # --- объекты ---
+
+    def add_pois(self, df, threshold, centroid=False, **kwarg):
+        """
+        Добавляет объекты и привязывает их к дорогам, как add_nodes_to_graph.
+        :param df: GeoDataFrame с объектами
+        :param threshold: дистанция для присоединения к вершине, м
+        :param centroid: привязывать центроиды геометрий (для школ)
+        :param kwarg: колонки id, name и тип вершины
+        :return: индексы новых вершин
+        """
+        start = self.graph.number_of_nodes()
+        xy, lonlat = feature_points(df, self.index.crs, centroid=centroid)
+        point, position, distance = self.index.snap(xy, threshold, k=self.k)
+        add_attachments(self.graph, df, lonlat, self.index.nodes, point, position, distance, **kwarg)
+        new_nodes = np.arange(start, self.graph.number_of_nodes())
+        self.poi_threshold.update(dict.fromkeys(new_nodes.tolist(), threshold))
+        self.dirty.update(new_nodes.tolist())
+        self.dirty.update(self.index.nodes[position].tolist())
+        return new_nodes
+
+    def remove_pois(self, nodes):
+        """
+        Отсоединяет объекты от графа и помечает их вершины как 'removed'.
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        edges = self.graph.incident_edges(nodes)
+        self.dirty.update(self.graph.edge_u[edges].tolist())
+        self.dirty.update(self.graph.edge_v[edges].tolist())
+        self.graph.remove_edges(edges)
+        self.graph.set_node_type(nodes, 'removed')
+        for node in nodes.tolist():
+            self.poi_threshold.pop(node, None)
+
+    # --- перепривязка ---
+
+    def _affected_pois(self, changed):
+        """
+        Объекты, у которых одна из вершин changed ближе дистанции привязки
+        или ближе самого длинного из текущих рёбер привязки.
+        """
+        if not len(changed) or not self.poi_threshold:
+            return []
+        pois = np.fromiter(self.poi_threshold, dtype=np.int64)
+        radius = np.fromiter(self.poi_threshold.values(), dtype=np.float64)
+
+        link = np.flatnonzero(self.graph.edge_type == self.graph.edge_types.index('link'))
+        farthest = np.zeros(self.graph.number_of_nodes())
+        for ends in (self.graph.edge_u[link], self.graph.edge_v[link]):
+            np.maximum.at(farthest, ends, self.graph.edge_data['length'][link])
+        radius = np.maximum(radius, farthest[pois])
+
+        coords = self.graph.coords
+        changed_xy = np.column_stack(self.index.to_metric.transform(coords[changed, 0], coords[changed, 1]))
+        poi_xy = np.column_stack(self.index.to_metric.transform(coords[pois, 0], coords[pois, 1]))
+        distance, _ = cKDTree(changed_xy).query(poi_xy, k=1)
+        return pois[distance < radius].tolist()
+
+    def _resnap(self, pois):
+        if not len(pois):
+            return
+        pois = np.asarray(pois, dtype=np.int64)
+        edges = self.graph.incident_edges(pois)
+        self.dirty.update(self.graph.edge_u[edges].tolist())
+        self.dirty.update(self.graph.edge_v[edges].tolist())
+        self.graph.remove_edges(edges)
+
+        coords = self.graph.coords[pois]
+        xy = np.column_stack(self.index.to_metric.transform(coords[:, 0], coords[:, 1]))
+        thresholds = np.array([self.poi_threshold[node] for node in pois.tolist()], dtype=np.float64)
+        for threshold in np.unique(thresholds):
+            group = np.flatnonzero(thresholds == threshold)
+            point, position, distance = self.index.snap(xy[group], threshold, k=self.k)
+            targets = self.index.nodes[position]
+            self.graph.add_edges(pois[group][point], targets, length=distance, coast=0, capacity=800,
+                                 edge_type='link')
+            self.dirty.update(targets.tolist())
+        self.dirty.update(pois.tolist())
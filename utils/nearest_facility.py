@@ -0,0 +1,221 @@
+import heapq
+import json
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import dijkstra
+
+from utils.compact_graph import as_compact
+
+
+class NearestFacility:
+    """
+    Ближайший объект каждого типа (школа, остановка, метро) для всех вершин графа.
+
+    Для каждого типа выполняется один многоисточниковый поиск из всех вершин этого типа,
+    поэтому стоимость - один проход по графу на тип вместо BFS из каждой вершины.
+    Объект можно построить один раз и передавать в create_flow_graph при повторных вызовах.
+
+    По сути это сетевое разбиение Вороного по каждому типу: оно сохраняется рядом с графом (save/load)
+    и обновляется при добавлении или удалении объекта, перемечая только затронутые ячейки.
+    Вершины, добавленные в CompactGraph после построения (новые объекты), получают метки от соседей.
+    Изменения самих дорог между существующими вершинами требуют построения заново.
+    """
+
+    def __init__(self, G, target_types=('school', 'stop', 'metro'), weight=None):
+        """
+        :param G: CompactGraph, NetworkXView или networkx-граф с вершинами-кортежами (x, y)
+        :param target_types: типы объектов
+        :param weight: None - расстояние в рёбрах (как shortest_path_to_type), иначе атрибут ребра ('length')
+        """
+        graph, self.keys = as_compact(G)
+        self.graph = graph
+        self.weight = weight
+        self.position = None if self.keys is None else {key: i for i, key in enumerate(self.keys)}
+        matrix = self.matrix = graph.csr_matrix(weight=weight)
+        self.number_of_nodes = graph.number_of_nodes()
+        self.sinks = {node_type: graph.nodes_of_type(node_type) for node_type in target_types}
+
+        self.facility = {}  # тип -> индекс ближайшего объекта для каждой вершины (-1, если недостижим)
+        self.distance = {}  # тип -> расстояние до него (inf, если недостижим)
+        for node_type in target_types:
+            sources = self.sinks[node_type]
+            if not len(sources):
+                self.facility[node_type] = np.full(graph.number_of_nodes(), -1, dtype=np.int64)
+                self.distance[node_type] = np.full(graph.number_of_nodes(), np.inf)
+                continue
+            distance, _, nearest = dijkstra(matrix, directed=False, indices=sources, unweighted=weight is None,
+                                            min_only=True, return_predecessors=True)
+            self.facility[node_type] = np.where(nearest < 0, -1, nearest).astype(np.int64)
+            self.distance[node_type] = distance
+
+    def index_of(self, node):
+        return node if self.position is None else self.position[node]
+
+    def key_of(self, index):
+        return int(index) if self.keys is None else self.keys[index]
+
+    def nearest(self, node, node_type):
+        """
+        Ближайший объект типа node_type для вершины node (ключ исходного графа) или None.
+        """
+        index = self.facility[node_type][self.index_of(node)]
+        return None if index < 0 else self.key_of(index)
+
+    def indices_of(self, nodes):
+        """
+        Индексы вершин для массива ключей исходного графа.
+        """
+        if self.position is None:
+            return np.asarray(nodes, dtype=np.int64)
+        return np.fromiter((self.position[node] for node in nodes), dtype=np.int64, count=len(nodes))
+
+    def nearest_many(self, nodes, node_type):
+        """
+        Индексы ближайших объектов для массива индексов вершин (-1 - недостижим).
+        """
+        return self.facility[node_type][np.asarray(nodes, dtype=np.int64)]
+
+    # --- инкрементальные изменения ---
+
+    def _sync(self):
+        # Вершины, добавленные в CompactGraph после построения (например, новая остановка):
+        # метки и расстояния им достаются от уже размеченных соседей через поиск по новым вершинам
+        n = self.graph.number_of_nodes()
+        if n == self.number_of_nodes:
+            return
+        self.matrix = self.graph.csr_matrix(weight=self.weight)
+        added = np.arange(self.number_of_nodes, n)
+        for node_type in self.facility:
+            self.facility[node_type] = np.concatenate(
+                [self.facility[node_type], np.full(len(added), -1, dtype=np.int64)])
+            self.distance[node_type] = np.concatenate([self.distance[node_type], np.full(len(added), np.inf)])
+        self.number_of_nodes = n
+        for node_type in self.facility:
+            self._fill(added, node_type)
+
+    def add_facility(self, node, node_type):
+        """
+        Добавляет объект: Дейкстра из новой вершины, который раскрывает вершину, только если
+        новый объект к ней строго ближе текущего. Дальше такой вершины новый объект тоже
+        не выигрывает, поэтому поиск проходит только по новой ячейке и её границе.
+        :param node: ключ вершины исходного графа
+        :return: индексы перемеченных вершин
+        """
+        self._sync()
+        index = self.index_of(node)
+        distance = self.distance[node_type]
+        indptr, indices, data = self.matrix.indptr, self.matrix.indices, self.matrix.data
+        unweighted = self.weight is None
+
+        best = {index: 0.0}
+        heap = [(0.0, index)]
+        while heap:
+            length, current = heapq.heappop(heap)
+            if length > best[current]:
+                continue
+            start, end = indptr[current], indptr[current + 1]
+            for neighbour, weight in zip(indices[start:end].tolist(), data[start:end].tolist()):
+                candidate = length + (1 if unweighted else weight)
+                if candidate < distance[neighbour] and candidate < best.get(neighbour, np.inf):
+                    best[neighbour] = candidate
+                    heapq.heappush(heap, (candidate, neighbour))
+
+        changed = np.fromiter(best, dtype=np.int64, count=len(best))
+        self.facility[node_type][changed] = index
+        distance[changed] = np.fromiter(best.values(), dtype=np.float64, count=len(best))
+        self.sinks[node_type] = np.union1d(self.sinks[node_type], [index])
+        return np.sort(changed)
+
+    def remove_facility(self, node, node_type):
+        """
+        Удаляет объект: вершины его ячейки получают ближайший из оставшихся объектов.
+        Поиск идёт только по ячейке - от её границы, расстояния на которой уже известны.
+        :param node: ключ вершины исходного графа
+        :return: индексы перемеченных вершин
+        """
+        self._sync()
+        index = self.index_of(node)
+        self.sinks[node_type] = self.sinks[node_type][self.sinks[node_type] != index]
+        cell = np.flatnonzero(self.facility[node_type] == index)
+        if len(cell):
+            self._fill(cell, node_type)
+        return cell
+
+    def _fill(self, cell, node_type):
+        """
+        Размечает вершины cell заново по ближайшим объектам соседних ячеек.
+        """
+        facility, distance = self.facility[node_type], self.distance[node_type]
+        inner = np.zeros(self.number_of_nodes, dtype=bool)
+        inner[cell] = True
+        neighbours = self.matrix[cell].indices
+        boundary = np.unique(neighbours[~inner[neighbours] & (facility[neighbours] >= 0)])
+        facility[cell] = -1
+        distance[cell] = np.inf
+        if not len(boundary):
+            return
+
+        # Подграф ячейки с границей и виртуальный исток, связанный с границей рёбрами длиной
+        # в известное расстояние граничной вершины до её объекта
+        nodes = np.concatenate([cell, boundary])
+        k = len(nodes)
+        local = self.matrix[nodes][:, nodes].tocoo()
+        offset = np.where(distance[boundary] > 0, distance[boundary], np.finfo(np.float64).tiny)
+        if self.weight is None:
+            local.data = np.ones(len(local.data))
+        rows = np.concatenate([local.row, np.full(len(boundary), k)])
+        cols = np.concatenate([local.col, np.arange(len(cell), k)])
+        data = np.concatenate([local.data, offset])
+        matrix = sparse.csr_matrix((data, (rows, cols)), shape=(k + 1, k + 1))
+        new_distance, predecessor = dijkstra(matrix, directed=True, indices=k, return_predecessors=True)
+
+        # Граничная вершина, через которую пришёл путь: удвоение указателей до вершин, чей предок - исток
+        root = np.where((predecessor >= 0) & (predecessor != k), predecessor, np.arange(k + 1))
+        while True:
+            jumped = root[root]
+            if np.array_equal(jumped, root):
+                break
+            root = jumped
+        reached = np.isfinite(new_distance[:len(cell)])
+        facility[cell[reached]] = facility[nodes[root[:len(cell)][reached]]]
+        distance[cell[reached]] = new_distance[:len(cell)][reached]
+
+    # --- хранение ---
+
+    def save(self, directory):
+        """
+        Сохраняет разбиение в каталог (например, рядом с графом в GraphStore).
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for node_type in self.facility:
+            np.save(directory / f'facility_{node_type}.npy', self.facility[node_type])
+            np.save(directory / f'distance_{node_type}.npy', self.distance[node_type])
+            np.save(directory / f'sinks_{node_type}.npy', self.sinks[node_type])
+        meta = {'target_types': list(self.facility), 'weight': self.weight, 'number_of_nodes': self.number_of_nodes}
+        (directory / 'meta.json').write_text(json.dumps(meta))
+
+    @classmethod
+    def load(cls, directory, G):
+        """
+        Загружает разбиение, сохранённое save, для того же графа G без поиска.
+        """
+        directory = Path(directory)
+        meta = json.loads((directory / 'meta.json').read_text())
+        facilities = cls.__new__(cls)
+        facilities.graph, facilities.keys = as_compact(G)
+        if facilities.graph.number_of_nodes() != meta['number_of_nodes']:
+            raise ValueError("Saved partition does not match the graph.")
+        facilities.weight = meta['weight']
+        facilities.position = None if facilities.keys is None else \
+            {key: i for i, key in enumerate(facilities.keys)}
+        facilities.matrix = facilities.graph.csr_matrix(weight=facilities.weight)
+        facilities.number_of_nodes = meta['number_of_nodes']
+        facilities.facility, facilities.distance, facilities.sinks = {}, {}, {}
+        for node_type in meta['target_types']:
+            facilities.facility[node_type] = np.load(directory / f'facility_{node_type}.npy')
+            facilities.distance[node_type] = np.load(directory / f'distance_{node_type}.npy')
+            facilities.sinks[node_type] = np.load(directory / f'sinks_{node_type}.npy')
+        return facilities
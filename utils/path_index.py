@@ -0,0 +1,262 @@
+import hashlib
+import heapq
+import json
+from pathlib import Path
+
+import numpy as np
+from scipy.sparse.csgraph import connected_components, dijkstra
+
+from utils.compact_graph import CompactGraph, NetworkXView, as_compact
+
+
+class LandmarkIndex:
+    """
+    Индекс кратчайших путей ALT (A*, landmarks, неравенство треугольника) для статичного графа дорог.
+
+    Предрасчёт - по одному Дейкстре из каждого ориентира. Для пары вершин расстояния до ориентиров
+    дают нижнюю оценку |d(L, s) - d(L, t)| и верхнюю d(L, s) + d(L, t); если они совпадают, ответ
+    получается без поиска, иначе A* с этой оценкой просматривает только узкий коридор вокруг пути.
+    Для далёких пар, где A* на Python раскрывает слишком много вершин, поиск продолжает
+    Дейкстра scipy, остановленный на верхней оценке.
+    Индекс сохраняется в каталог графа и подхватывается load_graph; detour_index использует его сам.
+    Вместе с индексом хранится отпечаток графа (graph_fingerprint); он сверяется один раз при привязке.
+    Дальше актуальность проверяется за O(1) по graph_state: счётчику CompactGraph.version (его увеличивают
+    add_nodes / add_edges / remove_edges, а значит и GraphEditor) и числу вершин и рёбер. У networkx-графа
+    счётчика нет, а число рёбер считается за O(N), поэтому на запрос сверяются G.graph['version'] и число
+    вершин: после правки рёбер networkx-графа на месте нужно увеличить G.graph['version'].
+    Устаревший индекс не используется, и запросы идут обычным Дейкстрой.
+    """
+
+    # Сколько вершин A* раскрывает до перехода на Дейкстру scipy, ограниченный верхней оценкой
+    expansion_budget = 256
+
+    def __init__(self, landmarks, distance, weight='length', fingerprint=None, keys=None):
+        """
+        :param landmarks: индексы вершин-ориентиров
+        :param distance: расстояния от вершин до ориентиров (N, L)
+        :param weight: атрибут рёбер, по которому построен индекс
+        :param fingerprint: отпечаток графа при построении (None - снять при attach)
+        :param keys: ключи вершин networkx-графа по индексам или None
+        """
+        self.landmarks = np.asarray(landmarks, dtype=np.int64)
+        self.distance = distance
+        self.weight = weight
+        self.fingerprint = fingerprint
+        self.keys = keys
+        self.position = None if keys is None else {key: i for i, key in enumerate(keys)}
+        self.matrix = None
+        self.state = None
+
+    @classmethod
+    def build(cls, G, n_landmarks=16, weight='length', seed=0):
+        """
+        Ориентиры выбираются по принципу самой дальней точки внутри наибольшей компоненты связности.
+        :param G: CompactGraph, NetworkXView или networkx-граф
+        :param n_landmarks: число ориентиров
+        :param weight: атрибут длины рёбер
+        :param seed: зерно выбора первой вершины
+        """
+        graph, keys = as_compact(G)
+        matrix = graph.csr_matrix(weight=weight)
+        _, labels = connected_components(matrix, directed=False)
+        component = np.flatnonzero(labels == np.bincount(labels).argmax())
+
+        # Стартовая вершина только задаёт направление: первый ориентир - самая далёкая от неё
+        start = int(np.random.default_rng(seed).choice(component))
+        row = dijkstra(matrix, directed=False, indices=start)
+        current = int(component[np.argmax(row[component])])
+        closest = np.full(graph.number_of_nodes(), np.inf)
+        landmarks, rows = [], []
+        while len(landmarks) < min(n_landmarks, len(component)):
+            row = dijkstra(matrix, directed=False, indices=current)
+            landmarks.append(current)
+            rows.append(row)
+            closest = np.minimum(closest, row)
+            current = int(component[np.argmax(closest[component])])
+            if closest[current] == 0:
+                break
+        index = cls(landmarks, np.ascontiguousarray(np.column_stack(rows)), weight=weight, keys=keys)
+        index.attach(G)
+        return index
+
+    # --- привязка к графу ---
+
+    def attach(self, G):
+        """
+        Связывает индекс с графом: CompactGraph получает атрибут path_index,
+        networkx-граф - G.graph['path_index']. Если отпечаток графа не совпадает с сохранённым,
+        индекс привязывается, но считается устаревшим.
+        """
+        if isinstance(G, NetworkXView):
+            G = G.compact
+        fingerprint = graph_fingerprint(G, weight=self.weight)
+        if self.fingerprint is None:
+            self.fingerprint = fingerprint
+        self.state = graph_state(G) if fingerprint == self.fingerprint else None
+        graph, _ = as_compact(G)
+        self.matrix = graph.csr_matrix(weight=self.weight)
+        if isinstance(G, CompactGraph):
+            G.path_index = self
+        elif hasattr(G, 'graph'):
+            G.graph['path_index'] = self
+
+    def is_valid_for(self, G, count_edges=False):
+        """
+        Граф не менялся после привязки индекса (проверка за O(1), см. graph_state).
+        :param count_edges: сверять и число рёбер networkx-графа (O(N); у CompactGraph - всегда)
+        """
+        if self.matrix is None or self.state is None:
+            return False
+        state = graph_state(G, count_edges=count_edges)
+        return state == self.state[:len(state)]
+
+    def index_of(self, node):
+        return node if self.position is None else self.position.get(node, -1)
+
+    # --- запросы ---
+
+    def bounds(self, source, target):
+        """
+        Нижняя и верхняя оценки расстояния между вершинами (индексами).
+        Если ориентир достижим только из одной из вершин, они в разных компонентах: (inf, inf).
+        """
+        a, b = self.distance[source], self.distance[target]
+        if (np.isfinite(a) != np.isfinite(b)).any():
+            return np.inf, np.inf
+        both = np.isfinite(a)
+        if not both.any():
+            return 0.0, np.inf
+        return float(np.abs(a[both] - b[both]).max()), float((a[both] + b[both]).min())
+
+    def distance_between(self, source, target):
+        """
+        Длина кратчайшего пути между вершинами (ключами графа); inf, если пути нет.
+        """
+        source, target = self.index_of(source), self.index_of(target)
+        if source < 0 or target < 0:
+            return np.inf
+        return self.distance_by_index(source, target)
+
+    def distance_by_index(self, source, target):
+        """
+        То же по индексам вершин CompactGraph.
+        """
+        if source == target:
+            return 0.0
+        lower, upper = self.bounds(source, target)
+        if lower == upper:
+            return lower
+
+        indptr, indices, data = self.matrix.indptr, self.matrix.indices, self.matrix.data
+        landmark_target = self.distance[target]
+        usable = np.isfinite(landmark_target)
+        landmark_distance = self.distance if usable.all() else self.distance[:, usable]
+        landmark_target = landmark_target[usable]
+
+        # Оценка A* считается сразу для всех соседей раскрываемой вершины
+        best = {source: 0.0}
+        heap = [(lower, 0.0, source)]
+        closed = set()
+        while heap:
+            _, length, node = heapq.heappop(heap)
+            if node == target:
+                return length
+            if node in closed:
+                continue
+            closed.add(node)
+            if len(closed) > self.expansion_budget:
+                distance = dijkstra(self.matrix, directed=False, indices=source, limit=upper * (1 + 1e-9))
+                return float(distance[target])
+            start, end = indptr[node], indptr[node + 1]
+            neighbours = indices[start:end]
+            if len(landmark_target):
+                estimate = np.abs(landmark_distance[neighbours] - landmark_target).max(axis=1).tolist()
+            else:
+                estimate = [0.0] * len(neighbours)
+            for neighbour, weight, bound in zip(neighbours.tolist(), data[start:end].tolist(), estimate):
+                candidate = length + weight
+                if candidate < best.get(neighbour, np.inf) and neighbour not in closed:
+                    best[neighbour] = candidate
+                    heapq.heappush(heap, (candidate + bound, candidate, neighbour))
+        return np.inf
+
+    # --- хранение ---
+
+    def save(self, directory):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        np.save(directory / 'landmarks.npy', self.landmarks)
+        np.save(directory / 'distance.npy', self.distance)
+        meta = {'weight': self.weight, 'fingerprint': self.fingerprint}
+        (directory / 'meta.json').write_text(json.dumps(meta))
+
+    @classmethod
+    def load(cls, directory, G=None, mmap=True):
+        """
+        :param G: граф, к которому привязать индекс (None - без привязки)
+        :param mmap: отображать расстояния в память
+        """
+        directory = Path(directory)
+        meta = json.loads((directory / 'meta.json').read_text())
+        keys = None if G is None else as_compact(G)[1]
+        index = cls(np.load(directory / 'landmarks.npy'),
+                    np.load(directory / 'distance.npy', mmap_mode='r' if mmap else None),
+                    weight=meta['weight'], fingerprint=meta.get('fingerprint'), keys=keys)
+        if G is not None:
+            index.attach(G)
+        return index
+
+
+def graph_fingerprint(G, weight='length'):
+    """
+    Отпечаток графа: хэш числа вершин, концов рёбер и весов weight.
+    Меняется при добавлении или удалении вершин и рёбер и при изменении веса любого ребра.
+    Считается за O(E), поэтому только при привязке индекса, а не на каждый запрос.
+    :param G: CompactGraph, NetworkXView или networkx-граф
+    """
+    if isinstance(G, NetworkXView):
+        G = G.compact
+    if isinstance(G, CompactGraph):
+        n = G.number_of_nodes()
+        u, v = G.edge_u, G.edge_v
+        w = np.ones(len(u)) if weight is None else G.edge_data.get(weight, np.full(len(u), np.nan))
+    else:
+        n = G.number_of_nodes()
+        position = {key: i for i, key in enumerate(G.nodes)}
+        edges = np.array([(position[a], position[b], 1 if weight is None else data.get(weight, np.nan))
+                          for a, b, data in G.edges(data=True)], dtype=np.float64).reshape(-1, 3)
+        u, v, w = edges[:, 0], edges[:, 1], edges[:, 2]
+    digest = hashlib.blake2b(np.int64(n).tobytes(), digest_size=16)
+    for column, dtype in ((u, np.int64), (v, np.int64), (w, np.float64)):
+        digest.update(np.ascontiguousarray(column, dtype=dtype).tobytes())
+    return digest.hexdigest()
+
+
+def graph_state(G, count_edges=True):
+    """
+    Дешёвая метка состояния графа: (счётчик изменений, число вершин, число рёбер).
+    Счётчик - CompactGraph.version или G.graph['version'] у networkx-графа.
+    :param count_edges: для networkx-графа считать рёбра (O(N)); иначе метка без числа рёбер
+    """
+    if isinstance(G, NetworkXView):
+        G = G.compact
+    if isinstance(G, CompactGraph):
+        return G.version, G.number_of_nodes(), G.number_of_edges()
+    state = (getattr(G, 'graph', {}).get('version', 0), G.number_of_nodes())
+    return state + (G.number_of_edges(),) if count_edges else state
+
+
+def path_index_of(G, weight='length', count_edges=False):
+    """
+    Индекс, привязанный к графу, построенный по тому же весу и не устаревший после изменений графа, или None.
+    :param count_edges: сверять и число рёбер networkx-графа (для пакетных запросов, где O(N) незаметно)
+    """
+    if isinstance(G, NetworkXView):
+        G = G.compact
+    if isinstance(G, CompactGraph):
+        index = getattr(G, 'path_index', None)
+    else:
+        index = getattr(G, 'graph', {}).get('path_index')
+    if index is None or index.weight != weight or not index.is_valid_for(G, count_edges=count_edges):
+        return None
+    return index
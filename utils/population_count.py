@@ -25,7 +25,8 @@ def count_population_for_houses(path, G):
     idx = index.Index()
 
     # Добавляем все вершины графа в индекс
-    for i, node in enumerate(G.nodes):
+    nodes = list(G.nodes)  # индексы R-tree соответствуют позициям в этом списке
+    for i, node in enumerate(nodes):
         point = node  # точки в графе (x, y)
         idx.insert(i, (point[0], point[1], point[0], point[1]))
     for i in range(len(df)):
@@ -37,7 +38,7 @@ def count_population_for_houses(path, G):
         min_distance = float('inf')
         nearest_node = None
         for j in possible_matches_index:
-            neighbor = list(G.nodes)[j]  # Получаем точку из графа
+            neighbor = nodes[j]  # Получаем точку из графа
             distance = geodesic((point.y, point.x), (neighbor[1], neighbor[0])).meters  # Вычисляем расстояние
             if min(distance, min_distance) < min_distance and G.nodes[neighbor].get('type', None) == 'road':
                 nearest_node = neighbor
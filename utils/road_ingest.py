@@ -0,0 +1,120 @@
+import os
+import time
+
+import geopandas as gpd
+import numpy as np
+import pyogrio
+import shapely
+from pyproj import CRS, Transformer
+
+from utils.compact_graph import CompactGraph, haversine
+
+
+def read_roads(path, foot=1, bbox=None, mask=None, layer=None):
+    """
+    Читает геометрии пешеходных дорог через Arrow без загрузки остальных колонок.
+    Фильтр по 'Foot' и обрезка по bbox / mask выполняются на стороне GDAL.
+    :param path: путь до файла с дорогами (.shp, .gpkg, ...)
+    :param foot: значение колонки 'Foot' у пешеходных дорог (None - без фильтра)
+    :param bbox: (minx, miny, maxx, maxy) в EPSG:4326
+    :param mask: shapely-полигон в EPSG:4326; вместе с bbox читается их пересечение
+    :param layer: слой внутри файла
+    :return: (массив LineString, CRS файла)
+    """
+    if bbox is not None and mask is not None:
+        # GDAL не принимает bbox и mask одновременно, поэтому сводим их к одной маске
+        mask = shapely.intersection(mask, shapely.box(*bbox))
+        bbox = None
+    src_crs = CRS.from_user_input(pyogrio.read_info(path, layer=layer)['crs'] or 'EPSG:4326')
+    if bbox is not None:
+        bbox = tuple(gpd.GeoSeries([shapely.box(*bbox)], crs=4326).to_crs(src_crs).total_bounds)
+    if mask is not None:
+        mask = gpd.GeoSeries([mask], crs=4326).to_crs(src_crs).iloc[0]
+
+    meta, table = pyogrio.read_arrow(path, layer=layer, columns=['Foot'],
+                                     where=None if foot is None else f'"Foot" = {int(foot)}',
+                                     bbox=bbox, mask=mask)
+    geometry = table.column(meta['geometry_name'] or 'wkb_geometry').to_numpy(zero_copy_only=False)
+    # MultiLineString раскладываем на отдельные линии, как это делают перед momepy.gdf_to_nx
+    lines = shapely.get_parts(shapely.from_wkb(geometry))
+    keep = (shapely.get_type_id(lines) == shapely.GeometryType.LINESTRING) & ~shapely.is_empty(lines)
+    return lines[keep], src_crs
+
+
+def lines_to_graph(lines, crs, length_crs=None):
+    """
+    Строит первичный (primal) граф как momepy.gdf_to_nx(multigraph=False, approach='primal'):
+    вершины - концы линий, рёбра - линии. Каждая точка линий проецируется не больше одного раза:
+    без length_crs - в EPSG:4326 (длины по большому кругу), с length_crs - в метрическую проекцию
+    (плоские длины), а в EPSG:4326 переводятся только уникальные концы линий - вершины графа.
+    :param lines: массив LineString
+    :param crs: CRS координат линий
+    :param length_crs: метрическая проекция для длин рёбер (плоские длины, как geometry.length
+        после to_crs); None - длины по большому кругу
+    :return: CompactGraph
+    """
+    coords, line_ids = shapely.get_coordinates(lines, return_index=True)
+    same_line = line_ids[1:] == line_ids[:-1]
+    to_wgs84 = None
+    if not CRS.from_user_input(crs).equals(CRS.from_epsg(4326)):
+        to_wgs84 = Transformer.from_crs(crs, 'EPSG:4326', always_xy=True)
+
+    if length_crs is None:
+        if to_wgs84 is not None:
+            coords = np.column_stack(to_wgs84.transform(coords[:, 0], coords[:, 1]))
+            to_wgs84 = None
+        segments = haversine(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1])
+    else:
+        planar = coords
+        if not CRS.from_user_input(crs).equals(CRS.from_user_input(length_crs)):
+            transformer = Transformer.from_crs(crs, length_crs, always_xy=True)
+            planar = np.column_stack(transformer.transform(coords[:, 0], coords[:, 1]))
+        segments = np.hypot(*np.diff(planar, axis=0).T)
+
+    # Длина линии - сумма длин её сегментов
+    length = np.bincount(line_ids[1:][same_line], weights=segments[same_line], minlength=len(lines))
+
+    # Концы линий и их перенумерация в целочисленные вершины
+    counts = np.bincount(line_ids, minlength=len(lines))
+    last = np.cumsum(counts) - 1
+    first = last - counts + 1
+    ends = np.concatenate([coords[first], coords[last]])
+    nodes, inverse = np.unique(ends, axis=0, return_inverse=True)
+    if to_wgs84 is not None:
+        nodes = np.column_stack(to_wgs84.transform(nodes[:, 0], nodes[:, 1]))
+    u, v = inverse[:len(lines)].ravel(), inverse[len(lines):].ravel()
+
+    # В простом графе momepy кратные рёбра схлопываются, остаётся последнее
+    pair = np.minimum(u, v) * len(nodes) + np.maximum(u, v)
+    _, keep = np.unique(pair[::-1], return_index=True)
+    keep = np.sort(len(pair) - 1 - keep)
+    graph = CompactGraph(nodes, u[keep], v[keep], length=length[keep])
+    if length_crs is not None:
+        graph.length_crs = CRS.from_user_input(length_crs).to_string()
+    return graph
+
+
+def ingest_road_graph(path, foot=1, bbox=None, mask=None, layer=None, length_crs=None, verbose=True):
+    """
+    Быстрое построение графа пешеходных дорог (самой крупной компоненты связности)
+    :param path: путь до файла с дорогами
+    :param foot: значение колонки 'Foot' у пешеходных дорог
+    :param bbox: (minx, miny, maxx, maxy) в EPSG:4326
+    :param mask: shapely-полигон в EPSG:4326 (вместе с bbox - их пересечение)
+    :param layer: слой внутри файла
+    :param length_crs: метрическая проекция (EPSG или CRS) для длин рёбер; None - длины по большому кругу
+    :param verbose: печатать пропускную способность чтения
+    :return: CompactGraph
+    """
+    start = time.perf_counter()
+    lines, crs = read_roads(path, foot=foot, bbox=bbox, mask=mask, layer=layer)
+    read_time = time.perf_counter() - start
+    graph = lines_to_graph(lines, crs, length_crs=length_crs).largest_component()
+    total_time = time.perf_counter() - start
+
+    if verbose:
+        size_mb = os.path.getsize(path) / 2 ** 20
+        print(f"Read {len(lines)} roads in {read_time:.2f} s "
+              f"({len(lines) / max(read_time, 1e-9):.0f} roads/s, {size_mb / max(read_time, 1e-9):.1f} MB/s), "
+              f"graph {graph.number_of_nodes()} nodes / {graph.number_of_edges()} edges in {total_time:.2f} s")
+    return graph
@@ -0,0 +1,137 @@
+import geopandas as gpd
+import numpy as np
+from pyproj import Transformer
+from scipy.spatial import cKDTree
+
+from utils.compact_graph import CompactGraph
+
+
+class NodeIndex:
+    """
+    Пространственный индекс вершин графа в метрической проекции.
+    Строится один раз и отвечает на все запросы по радиусу и ближайшему соседу пачкой.
+    """
+
+    def __init__(self, nodes, coords, crs):
+        """
+        :param nodes: ключи вершин графа (индексы CompactGraph или кортежи networkx)
+        :param coords: координаты вершин (N, 2) в EPSG:4326
+        :param crs: метрическая проекция, в которой считаются расстояния
+        """
+        self.nodes = nodes
+        self.crs = crs
+        self.to_metric = Transformer.from_crs('EPSG:4326', crs, always_xy=True)
+        self.xy = np.column_stack(self.to_metric.transform(coords[:, 0], coords[:, 1]))
+        self.tree = cKDTree(self.xy)
+
+    @classmethod
+    def from_graph(cls, G, crs=None, node_type='road'):
+        """
+        Индекс по вершинам типа node_type (None - по всем вершинам).
+        :param G: CompactGraph или networkx-граф с вершинами-кортежами (x, y)
+        :param crs: метрическая проекция, по умолчанию - зона UTM по центру графа
+        """
+        if isinstance(G, CompactGraph):
+            nodes = np.arange(G.number_of_nodes()) if node_type is None else G.nodes_of_type(node_type)
+            coords = G.coords[nodes]
+        else:
+            nodes = [node for node, data in G.nodes(data=True)
+                     if node_type is None or data.get('type', 'road') == node_type]
+            coords = np.array(nodes, dtype=np.float64).reshape(-1, 2)
+        if crs is None:
+            crs = gpd.GeoSeries(gpd.points_from_xy(coords[:, 0], coords[:, 1]), crs=4326).estimate_utm_crs()
+        return cls(nodes, coords, crs)
+
+    def snap(self, xy, threshold, k=20, workers=1):
+        """
+        Привязка точек к вершинам индекса.
+        Точка присоединяется ко всем из k ближайших вершин, лежащих ближе threshold метров;
+        если таких нет - к одной ближайшей вершине.
+        :param xy: координаты точек (K, 2) в проекции индекса
+        :param threshold: дистанция для присоединения к вершине, м
+        :param k: число кандидатов на точку
+        :param workers: потоки запросов cKDTree (-1 - все ядра); результат от них не зависит
+        :return: массивы (номер точки, позиция вершины в индексе, расстояние в метрах)
+        """
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        k = min(k, len(self.xy))
+        distance, position = self.tree.query(xy, k=k, distance_upper_bound=threshold, workers=workers)
+        distance = distance.reshape(len(xy), k)
+        position = position.reshape(len(xy), k)
+        found = distance < threshold
+        point, column = np.nonzero(found)
+        point_ids = [point]
+        positions = [position[point, column]]
+        distances = [distance[point, column]]
+
+        # Точки без вершин в радиусе присоединяем к ближайшей вершине
+        lonely = np.flatnonzero(~found.any(axis=1))
+        if len(lonely):
+            nearest_distance, nearest_position = self.tree.query(xy[lonely], k=1, workers=workers)
+            point_ids.append(lonely)
+            positions.append(nearest_position)
+            distances.append(nearest_distance)
+
+        point = np.concatenate(point_ids)
+        order = np.argsort(point, kind='stable')
+        return point[order], np.concatenate(positions)[order], np.concatenate(distances)[order]
+
+
+def feature_points(df, crs, centroid=False):
+    """
+    Координаты объектов в проекции crs и в EPSG:4326.
+    Для полигонов (школы) берётся центроид, посчитанный в метрической проекции.
+    :return: (координаты (K, 2) в crs, координаты (K, 2) в EPSG:4326)
+    """
+    geometry = df.geometry.to_crs(crs)
+    lonlat = df.geometry.to_crs(epsg=4326)
+    if centroid:
+        geometry = geometry.centroid
+        lonlat = geometry.to_crs(epsg=4326)
+    xy = np.column_stack([geometry.x.to_numpy(), geometry.y.to_numpy()])
+    return xy, np.column_stack([lonlat.x.to_numpy(), lonlat.y.to_numpy()])
+
+
+def snap_features(G, df, threshold, node_index=None, centroid=False, k=20, **kwarg):
+    """
+    Добавляет объекты df в граф как вершины kwarg['type'] и присоединяет их к дорогам пачкой.
+    :param G: CompactGraph или networkx-граф с вершинами-кортежами (x, y)
+    :param df: GeoDataFrame с объектами
+    :param threshold: дистанция для присоединения к вершине, м
+    :param node_index: готовый NodeIndex по дорожным вершинам (иначе строится по G)
+    :param centroid: присоединять центроиды геометрий (для школ)
+    :param k: число кандидатов на объект
+    :param kwarg: колонки id, name и тип вершины, как в add_nodes_to_graph
+    :return: граф с добавленными вершинами
+    """
+    if node_index is None:
+        node_index = NodeIndex.from_graph(G)
+    xy, lonlat = feature_points(df, node_index.crs, centroid=centroid)
+    point, position, distance = node_index.snap(xy, threshold, k=k)
+    return add_attachments(G, df, lonlat, node_index.nodes, point, position, distance, **kwarg)
+
+
+def add_attachments(G, df, lonlat, nodes, point, position, distance, **kwarg):
+    """
+    Добавляет в граф вершины объектов df и рёбра привязки, посчитанные NodeIndex.snap.
+    :param lonlat: координаты объектов (K, 2) в EPSG:4326
+    :param nodes: ключи вершин индекса (NodeIndex.nodes)
+    :param point: номера объектов
+    :param position: позиции вершин в индексе
+    :param distance: длины рёбер привязки, м
+    """
+    names = df[kwarg['name']].to_numpy()
+    ids = df[kwarg['id']].to_numpy()
+
+    if isinstance(G, CompactGraph):
+        new_nodes = G.add_nodes(lonlat, node_type=kwarg['type'], name=names, id=ids)
+        G.add_edges(new_nodes[point], np.asarray(nodes)[position], length=distance,
+                    coast=0, capacity=800, edge_type='link')
+        return G
+
+    keys = list(map(tuple, lonlat.tolist()))
+    G.add_nodes_from((key, {'type': kwarg['type'], 'name': name, 'id': node_id})
+                     for key, name, node_id in zip(keys, names, ids))
+    G.add_edges_from((keys[p], nodes[j], {'coast': 0, 'capacity': 800, 'length': d})
+                     for p, j, d in zip(point.tolist(), position.tolist(), distance.tolist()))
+    return G